@@ -26,18 +26,53 @@
 # Read files:
  
 #   maxe read [PATH...]
+#     -a --output-archive PATH
+#     -c --catalog PATH
 #     -i --improved
+#     -j --jobs N
 #     -o --output PATH
 #     -r --resource-paths PATH...
+#     -x --xml-option OPTION
+#     --depfile PATH
+#     --deps-json PATH
+#     --doc-cache SIZE
+#     --ext-memo SCOPE
+#     --no-cache
+#     --rst-cache SIZE
+#     --stat-cache MODE
  
 # Apply an XSLT tranform:
  
 #   maxe [transform] XSLT [PATH...]
+#     -a --output-archive PATH
+#     -c --catalog PATH
 #     -i --improved
+#     -j --jobs N
 #     -o --output PATH
 #     -p --param NAME VALUE
 #     -r --resource-paths PATH...
 #     -s --strparam NAME VALUE
+#     -x --xml-option OPTION
+#     --depfile PATH
+#     --deps-json PATH
+#     --doc-cache SIZE
+#     --ext-memo SCOPE
+#     --frag-cache SIZE
+#     --no-cache
+#     --rst-cache SIZE
+#     --stat-cache MODE
+#     --tr-cache SIZE
+
+# Validate XML files:
+
+#   maxe validate PATH...
+#     -c --catalog PATH
+#     -j --jobs N
+#     -o --output PATH
+#     -r --resource-paths PATH...
+#     -s --schema PATH
+#     -x --xml-option OPTION
+#     --no-cache
 
 # The read action is auxiliary to transform; the following commands are
 # equivalent:
@@ -61,9 +96,35 @@
 
 # Options:
  
+#   -a --output-archive PATH
+#     Output to a zip or tar archive; the type is defined by the extension:
+#     '.zip', '.tar', '.tar.gz' or '.tgz', '.tar.bz2' or '.tbz2'. If the result
+#     is a 'maxe:outputs' element, each of its 'maxe:output' children becomes
+#     a separate entry named by its 'path' attribute; this lets a single run
+#     produce many documents with one sequential write:
+#
+#       <maxe:outputs>
+#         <maxe:output path="a/index.html"><html>...</html></maxe:output>
+#         ...
+#       </maxe:outputs>
+#
+#     Any other result is written as a single entry named after the input.
+
 #   -i --improved
 #     Force to use the improved mode.
 
+#   -c --catalog PATH
+#     Resolve DTDs and other external resources with this OASIS XML catalog
+#     before resource paths; may repeat. Catalogs are indexed once and the
+#     index is kept in '$MAXE_CACHE_DIR' or '~/.cache/maxe' until a catalog
+#     file changes. Entries that point to the network are ignored.
+
+#   -j --jobs N
+#     Use up to N threads. With '--output-archive' and N > 1 archive entries
+#     are compressed and written by a separate thread. Directories, read or
+#     scanned with 'mext:scan-directory', are listed by N threads at once,
+#     which helps a lot on network filesystems; the output is the same.
+
 #   -p --param NAME VALUE, -s --strparam NAME VALUE
 #      Set the XSLT parameter. '--strparam' ensures the parameter is passed as
 #      a string. These options only apply to the 'transform' command.
@@ -75,6 +136,87 @@
 #     Output to this path. If omitted, Maxe will output to standard output. 
 #     The path must not exist or be a file.
 
+#   -s --schema PATH
+#     Validate against this schema: a DTD, a W3C XML Schema, or a RELAX NG
+#     schema in XML syntax, by the extension: '.dtd', '.xsd', '.rng'. Without
+#     this option a document is validated against its DTD. This option only
+#     applies to the 'validate' command. The command validates files, or the
+#     '.xml' files in directories, and outputs a 'maxe:validation' report
+#     with a 'maxe:document' for each file that lists validation errors as
+#     'maxe:error' elements. The exit status is 1 if any file is not valid.
+#     With '--jobs N' files are validated by N threads; schemas are compiled
+#     once per thread.
+
+#   -x --xml-option OPTION
+#     Set an option to parse XML inputs and the XSLT: 'NAME' or 'NAME=yes|no'.
+#     The options are the same as in lxml: huge-tree, remove-blank-text,
+#     resolve-entities, no-network, collect-ids, compact. E.g. 
+#     '-x remove-blank-text' makes the parsed trees smaller. 'ids=dtd' makes
+#     the 'id()' function work without validating documents against their
+#     DTDs; 'id-attrs=id,xml:id' makes it use the listed attributes.
+
+#   --depfile PATH
+#     Write what the run depends on as a Makefile rule, for make or ninja:
+#     the files read, the directories listed, and the paths whose stats
+#     were used, e.g. by 'mext:read-file', 'mext:list-directory',
+#     'document()', 'xsl:import', or DTD lookups. The target is the output
+#     file or archive or, if there is none, the depfile itself. Paths inside
+#     the current directory are relative.
+
+#   --deps-json PATH
+#     Write the same dependencies as JSON: an object with 'target', 'files',
+#     'directories', and 'stats' lists. Unlike '--depfile', it also has the
+#     paths that did not exist.
+
+#   --doc-cache SIZE
+#     Set the memory budget of the cache of documents read by 'mext:read-file'
+#     in bytes, with an optional K, M, or G suffix; 64M by default, 0 turns
+#     the cache off. The size of a parsed document is approximate.
+
+#   --ext-memo SCOPE
+#     Set how long results of pure extension functions, such as
+#     'mext:read-text', are memoized: 'off'; 'run', for one XSLT run, the
+#     default; 'process'. The results take at most 64M; the least recently
+#     used ones are dropped first. Extensions that read stats are not pure:
+#     they use the stat cache, see '--stat-cache'.
+
+#   --frag-cache SIZE
+#     Set the disk budget of the cache of fragments output by 'mext:cache',
+#     with an optional K, M, or G suffix; 64M by default, 0 keeps fragments
+#     only in memory, for one run.
+
+#   --no-cache
+#     Do not read or write on-disk caches: converted reST documents,
+#     catalog indexes, fragments, and outputs of transforms. They are kept in
+#     '$MAXE_CACHE_DIR' or '~/.cache/maxe'.
+
+#   --rst-cache SIZE
+#     Set the disk budget of the cache of reST documents converted to XML,
+#     with an optional K, M, or G suffix; 256M by default, 0 turns the cache
+#     off. A document is found by a digest of its text, the docutils version,
+#     and the settings, so unchanged documents are not parsed again; ones
+#     that include other files are not cached.
+
+#   --stat-cache MODE
+#     Set how long stats of paths are cached and shared between extension
+#     functions: 'off'; 'run', for one XSLT run, the default; 'ttl=SECONDS';
+#     'parent' or 'parent=SECONDS', while the mtime of the parent directory
+#     is the same, the parent mtime itself is rechecked after SECONDS, 1 by
+#     default. This mode notices added and removed files, but not changed
+#     ones. Use 'mext:invalidate-path-stat' to drop a stale stat.
+
+#   --tr-cache SIZE
+#     Keep the outputs of transforms on disk, with a budget in bytes with an
+#     optional K, M, or G suffix; 0, the default, turns the cache off. Maxe
+#     records what a transform depends on: the XSLT and the files it
+#     imports, the inputs, and every file read, path stat taken, directory
+#     listed, DTD, or catalog used, with their mtimes and sizes or listings.
+#     Next time, if the arguments are the same and none of these has
+#     changed, the stored output is written without running the transform;
+#     if the output file is already the same, it's not touched. Results that
+#     depend on anything else, e.g. the current time, are not noticed. Does
+#     not apply to '--output-archive' or to input from stdin.
+
 # ----------------------------------------------------------------------------
 # Discarded ideas
 
@@ -91,18 +233,25 @@
 
 from __future__ import absolute_import, print_function
 
-import argparse          as pa   # parses command-line arguments
-import locale            as pl   # get preferred encoding
-import pdb               as pd; pd = pd
-import sys               as ps   # provides access to stdin and stdout
-
-import maxe.path         as mp   # work with paths
-import maxe.strm         as ms   # work with streams
-import maxe.xml          as mx   # read and create XML, apply XSLT.
-import maxe.ext.path     as mep  # read path as XML
-import maxe.ext.read     as mer  # read files
-import maxe.ext.read.rst as merr ; del merr # initialize
-import maxe.ext.read.xml as merx # Ctx to mx.ReadParam
+import argparse             as pa   # parses command-line arguments
+import hashlib              as phl  # transform cache keys
+import locale               as pl   # get preferred encoding
+import multiprocessing.pool as pmp  # ThreadPool to validate files
+import pdb                  as pd; pd = pd
+import pickle               as pkl  # transform cache entries
+import sys                  as ps   # provides access to stdin and stdout
+
+import maxe.cache           as mca  # set cache budgets
+import maxe.dep             as md   # record dependencies
+import maxe.msg             as mm   # exceptions as XML
+import maxe.path            as mp   # work with paths
+import maxe.strm            as ms   # work with streams
+import maxe.xml             as mx   # read and create XML, apply XSLT.
+import maxe.ext.cache       as mec  # cache fragments, set its budget
+import maxe.ext.path        as mep  # read path as XML
+import maxe.ext.read        as mer  # read files
+import maxe.ext.read.rst    as merr # read reST, set its cache
+import maxe.ext.read.xml    as merx # Ctx to mx.ReadParam
 
 # ============================================================================
 # DATA TYPES
@@ -111,15 +260,91 @@ import maxe.ext.read.xml as merx # Ctx to mx.ReadParam
 # Ctx: command-line context.
 #   curPath: current path, mp.Path.
 #   paths: additional resource paths, [mp.Path]
+#   catalogs: XML catalog files, [mp.Path]
+#   readOpts: XML reading options, [(str, str)], see 'mx.SetReadParamOpt'.
 #   Usage:
 #       MakeCtx(pa.Namespace): Ctx
 
 class Ctx(object):
-    __slots__ = "curPath", "paths"
+    __slots__ = "curPath", "paths", "catalogs", "readOpts"
 
 # ============================================================================
 # PROCEDURES
 
+# ----------------------------------------------------------------------------
+# GetCachedTr(pa.Namespace, str): {(md.DepType, str):md.DepFprint} or None
+#   Write the output of a transform from the transform cache, if it's there
+#   and its dependencies have not changed (see '--tr-cache'); if the output
+#   file is the same already, leave it alone. Get the dependencies of the
+#   output or None if it's not written.
+
+def GetCachedTr(args, keyStr):
+    cached = mca.GetDiskCacheVal(TrCache, keyStr)
+    if cached is None:
+        return None
+    try:
+        formatNum, deps, data = pkl.loads(cached)
+    except Exception:
+        return None
+    if formatNum != TrCacheFormat or not md.DepsAreFresh(deps):
+        return None
+    if args.outputPathStr:
+        path = mp.MakePath(args.outputPathStr[0])
+        if mp.PathIsFile(path) and mp.GetPathSize(path) == len(data):
+            strm = ms.MakeIStrmFromPath(path)
+            try:
+                if ms.ReadStrm(strm) == data:
+                    return deps
+            finally:
+                ms.DropStrm(strm)
+        strm = ms.MakeOStrmFromPath(path)
+    else:
+        strm = ms.MakeOStrmFromStdout()
+    try:
+        ms.WriteStrm(strm, data)
+    finally:
+        ms.DropStrm(strm)
+    return deps
+
+# ----------------------------------------------------------------------------
+# GetInputDirPath(pa.Namespace): mp.Path or None
+#   Get the input directory path if the input is a single directory read in
+#   compatible mode (see 'GetInputXml'), else None.
+
+def GetInputDirPath(args):
+    dirPath = None
+    if not args.improved and len(args.files) == 1 and ps.stdin.isatty():
+        inputPath = mp.MakePath(args.files[0])
+        if mp.PathIsDir(inputPath):
+            dirPath = inputPath
+    return dirPath
+
+# ----------------------------------------------------------------------------
+# GetValidatePaths(pa.Namespace): [mp.Path]
+#   Get the paths of the files to validate in the order given: the files
+#   given and the '.xml' files in the directories given and their
+#   subdirectories, walked depth-first in the order of names.
+
+def GetValidatePaths(args):
+    paths = []; i = 0; n = len(args.files)
+    while i < n:
+        subpaths = [mp.MakePath(args.files[i])]; i += 1
+        if not mp.PathIsDir(subpaths[0]):
+            paths.append(subpaths[0])
+            continue
+        while subpaths:
+            subpath = subpaths.pop()
+            if mp.PathIsDir(subpath):
+                # Push in reverse, so the first name is popped first.
+                names = sorted(mp.ListDir(subpath), reverse=True)
+                j = 0; m = len(names)
+                while j < m:
+                    subpaths.append(mp.MakeSubpath(subpath, names[j]))
+                    j += 1
+            elif mp.GetPathExt(subpath).lower() == ".xml":
+                paths.append(subpath)
+    return paths
+
 # ----------------------------------------------------------------------------
 # GetInputXml(mx.Ctx, pa.Namespace): le.Element
 #   Get the input XML for 'transform' and 'read' commands. The parameter is
@@ -148,7 +373,8 @@ def GetInputXml(ctx, args):
         # sensible way to handle non-XML input nor it appears to be of much 
         # use. Besides such robustness would also prolifearte runtime errors 
         # as invalid XML would simply be accepted as text.
-        stdinXml = mx.ReadXml(ms.MakeIStrmFromStdin(), ctx)
+        stdinXml = mx.ReadXml(ms.MakeIStrmFromStdin(),
+                merx.ReadParamCli(ctx))
 
     # Construct XML.
     if improved:
@@ -170,21 +396,21 @@ def GetInputXml(ctx, args):
         # Compatible mode, single input, path.
         inputPath = mp.MakePath(args.files[0])
         if mp.PathIsFile(inputPath):
-            # File; try to read as XML or fall back to giving file stats.
-            try:
-                xml = mer.ReadFileFromCli(inputPath, "", ctx)
-            except Exception:
-                # Fallback: try to parse as XML.
-                # TODO: warn
+            # File; pick the reader by the extension or by sniffing the head
+            # of the file so that the file is read at most once. If there's
+            # no reader or it fails, fall back to giving file stats.
+            xml = None
+            if mer.GetFileReader(inputPath) is not None:
                 try:
-                    xml = mer.ReadFileFromCli(inputPath, "xml", ctx)
-                except:
-                    # Fallback: get path stats.
+                    xml = mer.ReadFileFromCli(inputPath, "", ctx)
+                except Exception:
                     # TODO: warn
-                    xml = mep.GetPathStatAsXml(inputPath)
+                    pass
+            if xml is None:
+                xml = mep.GetPathStatAsXml(inputPath)
         elif mp.PathIsDir(inputPath):
             # For directories scan the whole directory tree.
-            xml = mep.ScanDirAsXml(inputPath)
+            xml = mep.ScanDirAsXml(inputPath, mep.MakeScanParam())
         else:
             # For non-existing paths or other path types read path stats.
             xml = mep.GetPathStatAsXml(inputPath)
@@ -195,6 +421,58 @@ def GetInputXml(ctx, args):
         xml = None
     return xml
 
+# ----------------------------------------------------------------------------
+# GetOutputEnc(str): str
+#   Get the output encoding given the one from the XML or stdout. Both stdout
+#   and XML encodings may be not set.
+
+def GetOutputEnc(enc):
+    if not enc:
+        # Try to get the preferred locale encoding
+        enc = pl.getpreferredencoding()
+    if not enc:
+        # Fall back to UTF-8.
+        enc = "utf-8"
+    return enc
+
+# ----------------------------------------------------------------------------
+# GetResEntryNameStr(pa.Namespace, SCfg): str
+#   Get the archive entry name for a result that is not split into multiple
+#   outputs: the name of the first input (or XSLT) with an extension that
+#   matches the output method.
+
+def GetResEntryNameStr(args, sCfg):
+    if args.files:
+        path = mp.MakePath(args.files[0])
+    else:
+        path = mp.MakePath(args.xslt[0])
+    if sCfg.mtd == "html":
+        extStr = ".html"
+    elif sCfg.mtd == "text":
+        extStr = ".txt"
+    else:
+        extStr = ".xml"
+    return mp.GetPathName(mp.MakePath(mp.GetPathStem(path))) + extStr
+
+# ----------------------------------------------------------------------------
+# GetTrCacheKeyStr(pa.Namespace, Ctx): str or None
+#   Get the transform cache key: a digest of everything on the command line
+#   that may change the output. None if the transform cache is off or does
+#   not apply.
+
+def GetTrCacheKeyStr(args, ctx):
+    if TrCache.budget == 0 or mca.DiskCacheOff or args.outputArchPathStr \
+            or not ps.stdin.isatty():
+        return None
+    # Without '-o' the output is encoded as stdout wants it.
+    encStr = None if args.outputPathStr else ps.stdout.encoding
+    # Relative paths are resolved against the current directory.
+    keyItems = (TrCacheFormat, mp.GetPathStr(ctx.curPath), args.xslt,
+            args.files, args.improved, args.params, args.strParams,
+            args.readOptStrs, args.resPathStrs, args.catalogPathStrs,
+            args.extMemoStr, args.statCacheStr, encStr)
+    return phl.sha1(repr(keyItems).encode("utf-8")).hexdigest()
+
 # ----------------------------------------------------------------------------
 # MakeCtx(pa.Namespace): Ctx
 #   Make a command-line context.
@@ -206,8 +484,33 @@ def MakeCtx(args):
     i = 0; n = len(args.resPathStrs)
     while i < n:
         ctx.paths.append(mp.MakePath(args.resPathStrs[i])); i += 1
+    ctx.catalogs = []
+    i = 0; n = len(args.catalogPathStrs)
+    while i < n:
+        ctx.catalogs.append(mp.MakePath(args.catalogPathStrs[i])); i += 1
+    ctx.readOpts = []
+    i = 0; n = len(args.readOptStrs)
+    while i < n:
+        ctx.readOpts.extend(mx.ParseOptStr(args.readOptStrs[i])); i += 1
     return ctx
 
+# ----------------------------------------------------------------------------
+# MakeOutputStrm(pa.Namespace, SCfg): ms.Strm
+#   Make the output stream, a file or stdout, and set the output encoding in
+#   the SCfg.
+
+def MakeOutputStrm(args, sCfg):
+    if args.outputPathStr:
+        # Use the XML encoding. 
+        enc = sCfg.enc
+        strm = ms.MakeOStrmFromPath(mp.MakePath(args.outputPathStr[0]))
+    else:
+        # The output goes to stdout; use the stdout encoding.
+        enc = ps.stdout.encoding
+        strm = ms.MakeOStrmFromStdout()
+    sCfg.enc = GetOutputEnc(enc)
+    return strm
+
 # ----------------------------------------------------------------------------
 # RunFromCli()
 #   Run from command-line.
@@ -216,11 +519,22 @@ def RunFromCli():
     paParser = pa.ArgumentParser()
     # The default action if no subcommand is present is same as 'transform'.
     #   maxe XSLT PATH...
+    #   -a --output-archive PATH
+    #   -c --catalog PATH
     #   -i --improved
+    #   -j --jobs N
     #   -o --output-path PATH
     #   -p --param NAME VALUE
     #   -r --resource-paths PATH...
     #   -P --strparam NAME VALUE
+    #   -x --xml-option OPTION
+    #   --depfile PATH
+    #   --deps-json PATH
+    #   --doc-cache SIZE
+    #   --ext-memo SCOPE
+    #   --no-cache
+    #   --rst-cache SIZE
+    #   --stat-cache MODE
     # Note: cannot be done with 'argparse'.
 
     # There are two subcommands: transform and read.
@@ -228,17 +542,35 @@ def RunFromCli():
 
     # Transform is same as the default action:
     #   maxe transform XSLT PATH...
+    #   -a --output-archive PATH
+    #   -c --catalog PATH
     #   -i --improved
+    #   -j --jobs N
     #   -o --output-path PATH
     #   -p --param NAME VALUE
     #   -r --resource-paths PATH...
     #   -P --strparam NAME VALUE
+    #   -x --xml-option OPTION
+    #   --depfile PATH
+    #   --deps-json PATH
+    #   --doc-cache SIZE
+    #   --ext-memo SCOPE
+    #   --frag-cache SIZE
+    #   --no-cache
+    #   --rst-cache SIZE
+    #   --stat-cache MODE
+    #   --tr-cache SIZE
     paCmdTr = paCmds.add_parser("transform")
     paCmdTr.set_defaults(func=RunFromCliTr)
     paCmdTr.add_argument("xslt", nargs=1)
     paCmdTr.add_argument("files", nargs="*", default=[])
+    paCmdTr.add_argument("-a", "--output-archive", dest="outputArchPathStr",
+            nargs=1)
+    paCmdTr.add_argument("-c", "--catalog", dest="catalogPathStrs",
+            default=[], action="append")
     paCmdTr.add_argument("-i", "--improved", dest="improved",
            action="store_true", default=False)
+    paCmdTr.add_argument("-j", "--jobs", dest="jobs", type=int, default=1)
     paCmdTr.add_argument("-o", "--output", dest="outputPathStr", nargs=1)
     paCmdTr.add_argument("-p", "--param", dest="params", nargs=2, default=[],
             action="append")
@@ -246,20 +578,84 @@ def RunFromCli():
             default=[])
     paCmdTr.add_argument("-P", "--strparam", dest="strParams", nargs=2,
             default=[], action="append")
+    paCmdTr.add_argument("-x", "--xml-option", dest="readOptStrs", default=[],
+            action="append")
+    paCmdTr.add_argument("--depfile", dest="depfilePathStr")
+    paCmdTr.add_argument("--deps-json", dest="depsJsonPathStr")
+    paCmdTr.add_argument("--doc-cache", dest="docCacheStr", default="64M")
+    paCmdTr.add_argument("--ext-memo", dest="extMemoStr", default="run",
+            choices=sorted(ExtMemoScopes))
+    paCmdTr.add_argument("--frag-cache", dest="fragCacheStr", default="64M")
+    paCmdTr.add_argument("--no-cache", dest="noCache", action="store_true",
+            default=False)
+    paCmdTr.add_argument("--rst-cache", dest="rstCacheStr", default="256M")
+    paCmdTr.add_argument("--stat-cache", dest="statCacheStr", default="run")
+    paCmdTr.add_argument("--tr-cache", dest="trCacheStr", default="0")
 
     # Read is similar to transform, but without XSLT
     #   maxe read PATH...
+    #   -a --output-archive PATH
+    #   -c --catalog PATH
     #   -i --improved
+    #   -j --jobs N
     #   -o --output-path PATH
     #   -r --resource-paths PATH...
+    #   -x --xml-option OPTION
+    #   --depfile PATH
+    #   --deps-json PATH
+    #   --doc-cache SIZE
+    #   --ext-memo SCOPE
+    #   --no-cache
+    #   --rst-cache SIZE
+    #   --stat-cache MODE
     paCmdRd = paCmds.add_parser("read")
     paCmdRd.set_defaults(func=RunFromCliRd)
     paCmdRd.add_argument("files", nargs="+")
+    paCmdRd.add_argument("-a", "--output-archive", dest="outputArchPathStr",
+            nargs=1)
+    paCmdRd.add_argument("-c", "--catalog", dest="catalogPathStrs",
+            default=[], action="append")
     paCmdRd.add_argument("-i", "--improved", dest="improved",
            action="store_true", default=False)
+    paCmdRd.add_argument("-j", "--jobs", dest="jobs", type=int, default=1)
     paCmdRd.add_argument("-o", "--output", dest="outputPathStr", nargs=1)
     paCmdRd.add_argument("-r", "--resources", dest="resPathStrs", nargs="*",
             default=[])
+    paCmdRd.add_argument("-x", "--xml-option", dest="readOptStrs", default=[],
+            action="append")
+    paCmdRd.add_argument("--depfile", dest="depfilePathStr")
+    paCmdRd.add_argument("--deps-json", dest="depsJsonPathStr")
+    paCmdRd.add_argument("--doc-cache", dest="docCacheStr", default="64M")
+    paCmdRd.add_argument("--ext-memo", dest="extMemoStr", default="run",
+            choices=sorted(ExtMemoScopes))
+    paCmdRd.add_argument("--no-cache", dest="noCache", action="store_true",
+            default=False)
+    paCmdRd.add_argument("--rst-cache", dest="rstCacheStr", default="256M")
+    paCmdRd.add_argument("--stat-cache", dest="statCacheStr", default="run")
+
+    # Validate XML files:
+    #   maxe validate PATH...
+    #   -c --catalog PATH
+    #   -j --jobs N
+    #   -o --output-path PATH
+    #   -r --resource-paths PATH...
+    #   -s --schema PATH
+    #   -x --xml-option OPTION
+    #   --no-cache
+    paCmdVl = paCmds.add_parser("validate")
+    paCmdVl.set_defaults(func=RunFromCliVl)
+    paCmdVl.add_argument("files", nargs="+")
+    paCmdVl.add_argument("-c", "--catalog", dest="catalogPathStrs",
+            default=[], action="append")
+    paCmdVl.add_argument("-j", "--jobs", dest="jobs", type=int, default=1)
+    paCmdVl.add_argument("-o", "--output", dest="outputPathStr", nargs=1)
+    paCmdVl.add_argument("-r", "--resources", dest="resPathStrs", nargs="*",
+            default=[])
+    paCmdVl.add_argument("-s", "--schema", dest="schemaPathStr", nargs=1)
+    paCmdVl.add_argument("-x", "--xml-option", dest="readOptStrs", default=[],
+            action="append")
+    paCmdVl.add_argument("--no-cache", dest="noCache", action="store_true",
+            default=False)
 
     args = paParser.parse_args()
     args.func(args)
@@ -269,9 +665,30 @@ def RunFromCli():
 #   Run the 'read' command.
 
 def RunFromCliRd(args):
+    SetDocCacheFromCli(args)
+    SetDiskCachesFromCli(args)
+    mx.SetExtMemoScope(ExtMemoScopes[args.extMemoStr])
+    SetStatCacheFromCli(args)
+    mep.SetScanJobs(args.jobs)
     ctx = MakeCtx(args)
-    inputXml = GetInputXml(ctx, args)
-    SaveResXml(args, inputXml, mx.GetSCfgOfXml(inputXml))
+    if args.depfilePathStr or args.depsJsonPathStr:
+        md.StartDeps()
+    dirPath = GetInputDirPath(args)
+    if dirPath is not None and not args.outputArchPathStr:
+        # A single directory: write the tree while it's being scanned instead
+        # of building it in memory first. Large trees would take gigabytes
+        # and give no output until the scan is over.
+        sCfg = mx.MakeSCfg()
+        strm = MakeOutputStrm(args, sCfg)
+        try:
+            mep.WriteDirAsXml(strm, dirPath, mep.MakeScanParam(), sCfg)
+        finally:
+            ms.DropStrm(strm)
+    else:
+        inputXml = GetInputXml(ctx, args)
+        SaveResXml(args, inputXml, mx.GetSCfgOfXml(inputXml))
+    mep.WriteFileHashes()
+    WriteDepsFromCli(args, md.StopDeps())
 
 # ----------------------------------------------------------------------------
 # RunFromCliTr(pa.Namespace)
@@ -279,7 +696,24 @@ def RunFromCliRd(args):
 
 def RunFromCliTr(args):
     # Read the XSLT XML and compile XSLT. Keep the XML in case we need it.
+    SetDocCacheFromCli(args)
+    SetDiskCachesFromCli(args)
+    mx.SetExtMemoScope(ExtMemoScopes[args.extMemoStr])
+    SetStatCacheFromCli(args)
+    mep.SetScanJobs(args.jobs)
+    mca.SetDiskCacheBudget(TrCache, mca.ParseSizeStr(args.trCacheStr))
+    mca.SetDiskCacheBudget(mec.FragCache,
+            mca.ParseSizeStr(args.fragCacheStr))
     ctx = MakeCtx(args)
+    trCacheKeyStr = GetTrCacheKeyStr(args, ctx)
+    if trCacheKeyStr is not None:
+        deps = GetCachedTr(args, trCacheKeyStr)
+        if deps is not None:
+            WriteDepsFromCli(args, deps)
+            return
+    if trCacheKeyStr is not None or args.depfilePathStr \
+            or args.depsJsonPathStr:
+        md.StartDeps()
     xsltPath = mp.MakePath(args.xslt[0])
     xsltStrm = ms.MakeIStrmFromPath(xsltPath)
     readParam = merx.ReadParamCli(ctx)
@@ -304,7 +738,51 @@ def RunFromCliTr(args):
         # Running in improved mode; add XSLT path as the first arg.
         mx.Insert(inputXml, mep.GetPathAsXml(xsltPath), 0)
     resXml = mx.ApplyXslt(xslt, xsltParams, inputXml)
-    SaveResXml(args, resXml, mx.GetSCfgOfXslt(xslt))
+    # Extensions keep the new file digests in memory; save them once.
+    mep.WriteFileHashes()
+    deps = md.StopDeps()
+    if trCacheKeyStr is None:
+        SaveResXml(args, resXml, mx.GetSCfgOfXslt(xslt))
+    else:
+        SaveResXmlCached(args, resXml, mx.GetSCfgOfXslt(xslt),
+                trCacheKeyStr, deps)
+    WriteDepsFromCli(args, deps)
+
+# ----------------------------------------------------------------------------
+# RunFromCliVl(pa.Namespace)
+#   Run the 'validate' command. Write the report while validating; with N
+#   jobs up to N files are validated at once, but the report keeps the order
+#   of the files.
+
+def RunFromCliVl(args):
+    mca.SetDiskCacheOff(args.noCache)
+    ctx = MakeCtx(args)
+    readParam = merx.ReadParamCli(ctx)
+    schemaPath = None
+    if args.schemaPathStr:
+        schemaPath = mp.MakePath(args.schemaPathStr[0])
+        mx.GetSchemaType(schemaPath)
+    tasks = []; paths = GetValidatePaths(args); i = 0; n = len(paths)
+    while i < n:
+        tasks.append((paths[i], schemaPath, readParam)); i += 1
+    sCfg = mx.MakeSCfg()
+    strm = MakeOutputStrm(args, sCfg)
+    pool = pmp.ThreadPool(max(args.jobs, 1))
+    invalidCount = 0
+    try:
+        writer = mx.MakeXmlWriter(strm, sCfg)
+        mx.BeginXmlWriterElt(writer, mx.MakeElt(mxQNameMaxeValidation))
+        for docElt in pool.imap(ValidatePathAsXml, tasks):
+            if mx.GetAttr(docElt, mxQNameValid) != "yes":
+                invalidCount += 1
+            mx.WriteXmlWriterElt(writer, docElt)
+        mx.EndXmlWriterElt(writer)
+        mx.DropXmlWriter(writer)
+    finally:
+        pool.close()
+        ms.DropStrm(strm)
+    if invalidCount:
+        ps.exit(1)
 
 # ----------------------------------------------------------------------------
 # SaveResXml(pa.Namespace, mx.Xml, sCfg)
@@ -312,24 +790,177 @@ def RunFromCliTr(args):
 #   (lxml.etree._Element)  XML Document (lxml.etree._ElementTree) or 
 
 def SaveResXml(args, resXml, sCfg):
+    if args.outputArchPathStr:
+        # Use the XML encoding.
+        sCfg.enc = GetOutputEnc(sCfg.enc)
+        arch = ms.MakeOArchFromPath(mp.MakePath(args.outputArchPathStr[0]),
+                args.jobs > 1)
+        try:
+            SaveResXmlToArch(args, arch, resXml, sCfg)
+        finally:
+            ms.DropArch(arch)
+    else:
+        strm = MakeOutputStrm(args, sCfg)
+        try:
+            mx.WriteXml(strm, resXml, sCfg)
+        finally:
+            ms.DropStrm(strm)
+
+# ----------------------------------------------------------------------------
+# SaveResXmlCached(pa.Namespace, mx.Xml, SCfg, str,
+#         {(md.DepType, str):md.DepFprint})
+#   Write the XML result into a file or to stdout and keep it in the
+#   transform cache together with its dependencies.
+
+def SaveResXmlCached(args, resXml, sCfg, keyStr, deps):
+    strm = MakeOutputStrm(args, sCfg)
+    try:
+        dataStrm = ms.MakeOStrmInMem()
+        try:
+            mx.WriteXml(dataStrm, resXml, sCfg)
+            data = ms.GetStrmData(dataStrm)
+        finally:
+            ms.DropStrm(dataStrm)
+        ms.WriteStrm(strm, data)
+    finally:
+        ms.DropStrm(strm)
+    mca.PutDiskCacheVal(TrCache, keyStr,
+            pkl.dumps((TrCacheFormat, deps, data), 2))
+
+# ----------------------------------------------------------------------------
+# SaveResXmlToArch(pa.Namespace, ms.Arch, mx.Xml, sCfg)
+#   Write the XML result into an archive. A 'maxe:outputs' result is split
+#   into entries, one per 'maxe:output'; any other result is a single entry.
+
+def SaveResXmlToArch(args, arch, resXml, sCfg):
+    if mx.GetEltQName(resXml) == mxQNameMaxeOutputs:
+        for outputElt in mx.GetEltChildElts(resXml):
+            if mx.GetEltQName(outputElt) != mxQNameMaxeOutput:
+                raise Exception("Expected only 'maxe:output' elements in "
+                        "'maxe:outputs'")
+            nameStr = mx.GetAttr(outputElt, mxQNamePath)
+            if not nameStr:
+                raise Exception("The 'maxe:output' element has no 'path'")
+            childElts = mx.GetEltChildElts(outputElt)
+            if len(childElts) != 1:
+                raise Exception("The 'maxe:output' element '%s' must have a "
+                        "single child element" % nameStr)
+            SaveXmlToArch(arch, nameStr, childElts[0], sCfg)
+    else:
+        SaveXmlToArch(arch, GetResEntryNameStr(args, sCfg), resXml, sCfg)
+
+# ----------------------------------------------------------------------------
+# SaveXmlToArch(ms.Arch, str, mx.Xml, sCfg)
+#   Serialize XML and add it to an archive as an entry.
+
+def SaveXmlToArch(arch, nameStr, xml, sCfg):
+    strm = ms.MakeOStrmInMem()
+    try:
+        mx.WriteXml(strm, xml, sCfg)
+        ms.AddArchEntry(arch, nameStr, ms.GetStrmData(strm))
+    finally:
+        ms.DropStrm(strm)
+
+# ----------------------------------------------------------------------------
+# SetDiskCachesFromCli(pa.Namespace)
+#   Set up on-disk caches from the '--no-cache' and '--rst-cache' options.
+
+def SetDiskCachesFromCli(args):
+    mca.SetDiskCacheOff(args.noCache)
+    mca.SetDiskCacheBudget(merr.RstCache, mca.ParseSizeStr(args.rstCacheStr))
+
+# ----------------------------------------------------------------------------
+# SetDocCacheFromCli(pa.Namespace)
+#   Set the document cache budget from the '--doc-cache' option.
+
+def SetDocCacheFromCli(args):
+    mca.SetLruBudget(mer.DocCache, mca.ParseSizeStr(args.docCacheStr))
+
+# ----------------------------------------------------------------------------
+# SetStatCacheFromCli(pa.Namespace)
+#   Set the shared stat cache mode from the '--stat-cache' option.
+
+def SetStatCacheFromCli(args):
+    nameStr, _, valStr = args.statCacheStr.partition("=")
+    try:
+        mode = StatCacheModes[nameStr]
+        ttl = float(valStr or "1")
+    except (KeyError, ValueError):
+        raise Exception("Unknown stat cache mode '%s'" % args.statCacheStr)
+    mp.SetStatCacheMode(mode, ttl)
+
+# ----------------------------------------------------------------------------
+# ValidatePathAsXml((mp.Path, mp.Path or None, mx.ReadParam)): mx.Xml(Elt)
+#   Validate a file against the schema or, if it's None, against its DTD;
+#   get the result as XML. Takes a single tuple to be used with a pool.
+#
+#       <maxe:document path schema valid="yes|no">
+#         <maxe:error line column level type message>
+
+def ValidatePathAsXml(task):
+    path, schemaPath, readParam = task
+    docElt = mx.MakeElt(mxQNameMaxeDocument)
+    mx.SetAttr(docElt, mxQNamePath, mp.GetPathStr(path))
+    try:
+        strm = ms.MakeIStrmFromPath(path)
+        try:
+            xml = mx.ParseXml(strm, readParam)
+        finally:
+            ms.DropStrm(strm)
+        if schemaPath is None:
+            schemaPath = mx.FindXmlDtdPath(xml, readParam)
+            if schemaPath is None:
+                raise Exception("No schema given and the document has no "
+                        "DTD or it cannot be found")
+            schemaType = mx.SchemaTypeDtd
+        else:
+            schemaType = mx.GetSchemaType(schemaPath)
+        mx.SetAttr(docElt, mxQNameSchema, mp.GetPathStr(schemaPath))
+        errors = mx.ValidateXml(xml, mx.GetSchema(schemaPath, schemaType))
+        i = 0; n = len(errors)
+        while i < n:
+            error = errors[i]; i += 1
+            errorElt = mx.MakeElt(mxQNameMaxeError)
+            mx.SetAttr(errorElt, mxQNameLine, str(error.line))
+            mx.SetAttr(errorElt, mxQNameColumn, str(error.column))
+            mx.SetAttr(errorElt, mxQNameLevel, error.level_name)
+            mx.SetAttr(errorElt, mxQNameType, error.type_name)
+            mx.SetAttr(errorElt, mxQNameMessage, error.message)
+            mx.AppendElt(docElt, errorElt)
+        valid = not errors
+    except Exception as exc:
+        mx.AppendElt(docElt, mm.GetExcAsXml(exc))
+        valid = False
+    mx.SetAttr(docElt, mxQNameValid, valid and "yes" or "no")
+    return docElt
+
+# ----------------------------------------------------------------------------
+# WriteDepsFromCli(pa.Namespace, {(md.DepType, str):md.DepFprint})
+#   Write dependencies into the files of the '--depfile' and '--deps-json'
+#   options, if any.
+
+def WriteDepsFromCli(args, deps):
     if args.outputPathStr:
-        # Use the XML encoding. 
-        enc = sCfg.enc
-        strm = ms.MakeOStrmFromPath(mp.MakePath(args.outputPathStr[0]))
+        targetStr = args.outputPathStr[0]
+    elif args.outputArchPathStr:
+        targetStr = args.outputArchPathStr[0]
     else:
-        # The output goes to stdout; use the stdout encoding.
-        enc = ps.stdout.encoding
-        strm = ms.MakeOStrmFromStdout()
+        targetStr = args.depfilePathStr or args.depsJsonPathStr
+    if args.depfilePathStr:
+        WriteTextToPath(args.depfilePathStr,
+                md.FormatDepfile(targetStr, deps))
+    if args.depsJsonPathStr:
+        WriteTextToPath(args.depsJsonPathStr,
+                md.FormatDepsJson(targetStr, deps))
+
+# ----------------------------------------------------------------------------
+# WriteTextToPath(str, str)
+#   Write text into a file as UTF-8.
+
+def WriteTextToPath(pathStr, text):
+    strm = ms.MakeOStrmFromPath(mp.MakePath(pathStr))
     try:
-        # Both stdout and XML encodings may be not set.
-        if not enc:
-            # Try to get the preferred locale encoding
-            enc = pl.getpreferredencdoing()
-        if not enc:
-            # Fall back to UTF-8.
-            enc = "utf-8"
-        sCfg.enc = enc
-        mx.WriteXml(strm, resXml, sCfg)
+        ms.WriteStrm(strm, text.encode("utf-8"))
     finally:
         ms.DropStrm(strm)
 
@@ -337,9 +968,44 @@ def SaveResXml(args, resXml, sCfg):
 
 # mxNs*, mxQName*: namespaces and QNames.
 
+mxNs     = mx.GetNs("")
 mxNsMaxe = mx.GetNs("urn:onegasoft:Maxe")
-mxQNameMaxeArguments = mx.GetQName(mxNsMaxe, "arguments")
-mxQNameMaxeStdin     = mx.GetQName(mxNsMaxe, "stdin"    )
+mxQNameMaxeArguments  = mx.GetQName(mxNsMaxe, "arguments" )
+mxQNameMaxeDocument   = mx.GetQName(mxNsMaxe, "document"  )
+mxQNameMaxeError      = mx.GetQName(mxNsMaxe, "error"     )
+mxQNameMaxeOutput     = mx.GetQName(mxNsMaxe, "output"    )
+mxQNameMaxeOutputs    = mx.GetQName(mxNsMaxe, "outputs"   )
+mxQNameMaxeStdin      = mx.GetQName(mxNsMaxe, "stdin"     )
+mxQNameMaxeValidation = mx.GetQName(mxNsMaxe, "validation")
+mxQNameColumn         = mx.GetQName(mxNs    , "column"    )
+mxQNameLevel          = mx.GetQName(mxNs    , "level"     )
+mxQNameLine           = mx.GetQName(mxNs    , "line"      )
+mxQNameMessage        = mx.GetQName(mxNs    , "message"   )
+mxQNamePath           = mx.GetQName(mxNs    , "path"      )
+mxQNameSchema         = mx.GetQName(mxNs    , "schema"    )
+mxQNameType           = mx.GetQName(mxNs    , "type"      )
+mxQNameValid          = mx.GetQName(mxNs    , "valid"     )
+
+# ExtMemoScopes: '--ext-memo' scope names.
+
+ExtMemoScopes = {
+    "off"    : mx.ExtMemoScopeOff,
+    "run"    : mx.ExtMemoScopeRun,
+    "process": mx.ExtMemoScopeProc}
+
+# StatCacheModes: '--stat-cache' mode names.
+
+StatCacheModes = {
+    "off"   : mp.StatCacheModeOff,
+    "run"   : mp.StatCacheModeRun,
+    "ttl"   : mp.StatCacheModeTtl,
+    "parent": mp.StatCacheModeParent}
+
+# TrCache: outputs of transforms, see '--tr-cache'; TrCacheFormat is the
+# version of the entries.
+
+TrCache = mca.MakeDiskCache("tr", 0)
+TrCacheFormat = 1
 
 # CODE =======================================================================
 
@@ -0,0 +1,385 @@
+# coding: utf-8
+#
+# maxe.cache: in-memory and on-disk caches.
+#
+# Copyright (C) 2020 Mikhail Edoshin.
+#
+# This file is part of Maxe.
+#
+# Maxe is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Maxe is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Maxe.  If not, see <https://www.gnu.org/licenses/>.
+
+# ============================================================================
+
+from __future__ import absolute_import
+
+# ============================================================================
+# Data types
+
+# ----------------------------------------------------------------------------
+# DiskCache
+#   A content-addressed cache of data in files: the key is a hex digest of
+#   everything the data depends on and the file name. Files are kept in a
+#   subdirectory of the cache directory (see 'GetCacheDirStr') and spread
+#   over subdirectories by the first two characters of the key. A hit
+#   touches the file; when the files take more than the budget, the least
+#   recently touched ones are removed. Knowing the size needs a scan of the
+#   directory, so the scan is done on the first write in a process and then
+#   each time the process has written an eighth of the budget.
+#
+#   nameStr: the subdirectory name, str.
+#   budget: the budget in bytes, int; 0 disables the cache.
+#   written: bytes written since the last scan, None before the first one,
+#     int or None.
+#   hits, misses: counters, int.
+#   lock: guards 'written' and the counters, pth.Lock.
+#
+# Usage:
+#   EvictDiskCache(DiskCache)
+#   GetDiskCacheVal(DiskCache, str): bytes or None
+#   MakeDiskCache(str, int): DiskCache
+#   PutDiskCacheVal(DiskCache, str, bytes)
+#   SetDiskCacheBudget(DiskCache, int)
+
+class DiskCache(object):
+    __slots__ = "nameStr", "budget", "written", "hits", "misses", "lock"
+
+# ----------------------------------------------------------------------------
+# Lru
+#   A least-recently-used cache with a budget in bytes. The sizes of values
+#   are given by the caller and may be approximate. When the total size goes
+#   over the budget, the least recently used values are evicted. A value that
+#   is larger than the whole budget is not cached at all.
+#
+#   budget: the budget in bytes, int; 0 disables the cache.
+#   size: the total size of cached values, int.
+#   entries: cached values and their sizes from the least to the most
+#     recently used, {key:(val, int)} (pcl.OrderedDict).
+#   hits, misses, evictions: counters, int.
+#   lock: guards all of the above, pth.Lock.
+#
+# Usage:
+#   ClearLru(Lru)
+#   GetLruStats(Lru): LruStats
+#   GetLruVal(Lru, key): val or None
+#   MakeLru(int): Lru
+#   PutLruVal(Lru, key, val, int)
+#   SetLruBudget(Lru, int)
+
+class Lru(object):
+    __slots__ = "budget", "size", "entries", "hits", "misses", "evictions", \
+            "lock"
+
+# ----------------------------------------------------------------------------
+# LruStats
+#   A snapshot of Lru counters.
+#
+#   budget, size, count, hits, misses, evictions: int.
+#
+# Usage:
+#   GetLruStats(Lru): LruStats
+
+class LruStats(object):
+    __slots__ = "budget", "size", "count", "hits", "misses", "evictions"
+
+# ============================================================================
+# Functions
+
+# ----------------------------------------------------------------------------
+# ClearLru(Lru)
+#   Drop all cached values; keep the counters.
+
+def ClearLru(lru):
+    with lru.lock:
+        lru.entries.clear()
+        lru.size = 0
+
+# ----------------------------------------------------------------------------
+# EvictDiskCache(DiskCache)
+#   Remove the least recently used files of a DiskCache until the files
+#   take no more than the budget. Files that vanish meanwhile, e.g. removed
+#   by another process, are skipped.
+
+def EvictDiskCache(cache):
+    dirStr = pop.join(GetCacheDirStr(), cache.nameStr)
+    entries = []; size = 0
+    for subdirStr, _, fileNameStrs in po.walk(dirStr):
+        i = 0; n = len(fileNameStrs)
+        while i < n:
+            pathStr = pop.join(subdirStr, fileNameStrs[i]); i += 1
+            try:
+                poStat = po.stat(pathStr)
+            except OSError:
+                continue
+            entries.append((poStat.st_mtime, poStat.st_size, pathStr))
+            size += poStat.st_size
+    if size <= cache.budget:
+        return
+    entries.sort()
+    i = 0; n = len(entries)
+    while i < n and size > cache.budget:
+        _, entrySize, pathStr = entries[i]; i += 1
+        try:
+            po.remove(pathStr)
+        except OSError:
+            continue
+        size -= entrySize
+
+# ----------------------------------------------------------------------------
+# EvictLru(Lru, int)
+#   Evict the least recently used values until the total size is within the
+#   budget. The caller holds the lock.
+
+def EvictLru(lru, budget):
+    while lru.size > budget and lru.entries:
+        _, entry = lru.entries.popitem(last=False)
+        lru.size -= entry[1]; lru.evictions += 1
+
+# ----------------------------------------------------------------------------
+# GetCacheDirStr(): str
+#   Get the directory of on-disk caches: '$MAXE_CACHE_DIR' or
+#   '~/.cache/maxe'. The directory may not exist yet.
+
+def GetCacheDirStr():
+    dirStr = po.environ.get("MAXE_CACHE_DIR")
+    if not dirStr:
+        dirStr = pop.join(pop.expanduser("~"), ".cache", "maxe")
+    return dirStr
+
+# ----------------------------------------------------------------------------
+# GetDiskCachePathStr(DiskCache, str): str
+#   Get the path of the file of a DiskCache key.
+
+def GetDiskCachePathStr(cache, keyStr):
+    return pop.join(GetCacheDirStr(), cache.nameStr, keyStr[:2], keyStr)
+
+# ----------------------------------------------------------------------------
+# GetDiskCacheVal(DiskCache, str): bytes or None
+#   Get the data cached under a key; None if there is none or the cache is
+#   off.
+
+def GetDiskCacheVal(cache, keyStr):
+    if cache.budget == 0 or DiskCacheOff:
+        return None
+    pathStr = GetDiskCachePathStr(cache, keyStr)
+    try:
+        with open(pathStr, "rb") as fhdl:
+            data = fhdl.read()
+        po.utime(pathStr, None)
+    except (IOError, OSError):
+        data = None
+    with cache.lock:
+        if data is None:
+            cache.misses += 1
+        else:
+            cache.hits += 1
+    return data
+
+# ----------------------------------------------------------------------------
+# GetLruStats(Lru): LruStats
+#   Get the Lru counters.
+
+def GetLruStats(lru):
+    stats = LruStats()
+    with lru.lock:
+        stats.budget = lru.budget
+        stats.size = lru.size
+        stats.count = len(lru.entries)
+        stats.hits = lru.hits
+        stats.misses = lru.misses
+        stats.evictions = lru.evictions
+    return stats
+
+# ----------------------------------------------------------------------------
+# GetLruVal(Lru, key): val or None
+#   Get a cached value and mark it as the most recently used.
+
+def GetLruVal(lru, key):
+    with lru.lock:
+        entry = lru.entries.pop(key, None)
+        if entry is None:
+            lru.misses += 1
+            return None
+        lru.entries[key] = entry; lru.hits += 1
+        return entry[0]
+
+# ----------------------------------------------------------------------------
+# MakeDiskCache(str, int): DiskCache
+#   Make a DiskCache by a subdirectory name and a budget in bytes.
+
+def MakeDiskCache(nameStr, budget):
+    cache = DiskCache()
+    cache.nameStr = nameStr
+    cache.budget = budget
+    cache.written = None
+    cache.hits = 0
+    cache.misses = 0
+    cache.lock = pth.Lock()
+    return cache
+
+# ----------------------------------------------------------------------------
+# MakeLru(int): Lru
+#   Make an Lru with a budget in bytes.
+
+def MakeLru(budget):
+    lru = Lru()
+    lru.budget = budget
+    lru.size = 0
+    lru.entries = pcl.OrderedDict()
+    lru.hits = 0
+    lru.misses = 0
+    lru.evictions = 0
+    lru.lock = pth.Lock()
+    return lru
+
+# ----------------------------------------------------------------------------
+# ParseSizeStr(str): int
+#   Parse a size in bytes with an optional 'K', 'M', or 'G' suffix, e.g.
+#   '64M'.
+
+def ParseSizeStr(sizeStr):
+    factor = SizeFactors.get(sizeStr[-1:].upper())
+    try:
+        if factor is None:
+            return int(sizeStr)
+        return int(float(sizeStr[:-1]) * factor)
+    except ValueError:
+        raise Exception("Expected a size like '64M', got '%s'" % sizeStr)
+
+# ----------------------------------------------------------------------------
+# PutDiskCacheVal(DiskCache, str, bytes)
+#   Cache data under a key, see 'DiskCache'. Errors are ignored.
+
+def PutDiskCacheVal(cache, keyStr, data):
+    if cache.budget == 0 or DiskCacheOff or len(data) > cache.budget:
+        return
+    WriteFileAtomic(GetDiskCachePathStr(cache, keyStr), data)
+    with cache.lock:
+        if cache.written is not None:
+            cache.written += len(data)
+            if cache.written < cache.budget >> 3:
+                return
+        cache.written = 0
+    EvictDiskCache(cache)
+
+# ----------------------------------------------------------------------------
+# PutLruVal(Lru, key, val, int)
+#   Cache a value of a given size as the most recently used.
+
+def PutLruVal(lru, key, val, size):
+    with lru.lock:
+        entry = lru.entries.pop(key, None)
+        if entry is not None:
+            lru.size -= entry[1]
+        if size > lru.budget:
+            return
+        EvictLru(lru, lru.budget - size)
+        lru.entries[key] = (val, size); lru.size += size
+
+# ----------------------------------------------------------------------------
+# ReadCacheFile(str): val or None
+#   Read a value that 'WriteCacheFile' saved under a name in the cache
+#   directory; None if there is no such file or it cannot be read. On-disk
+#   caches are optional: a broken or outdated file is the same as a miss.
+
+def ReadCacheFile(nameStr):
+    if DiskCacheOff:
+        return None
+    try:
+        with open(pop.join(GetCacheDirStr(), nameStr), "rb") as fhdl:
+            return pkl.load(fhdl)
+    except Exception:
+        return None
+
+# ----------------------------------------------------------------------------
+# SetDiskCacheBudget(DiskCache, int)
+#   Set the DiskCache budget in bytes; the files are trimmed on the next
+#   write.
+
+def SetDiskCacheBudget(cache, budget):
+    with cache.lock:
+        cache.budget = budget
+        cache.written = None
+
+# ----------------------------------------------------------------------------
+# SetDiskCacheOff(bool)
+#   Turn all on-disk caches off or back on, e.g. to rebuild everything.
+
+def SetDiskCacheOff(off):
+    global DiskCacheOff
+    DiskCacheOff = off
+
+# ----------------------------------------------------------------------------
+# SetLruBudget(Lru, int)
+#   Set the Lru budget in bytes; evict values if needed.
+
+def SetLruBudget(lru, budget):
+    with lru.lock:
+        lru.budget = budget
+        EvictLru(lru, budget)
+
+# ----------------------------------------------------------------------------
+# WriteCacheFile(str, val)
+#   Save a value under a name in the cache directory, see 'ReadCacheFile'.
+#   Errors are ignored.
+
+def WriteCacheFile(nameStr, val):
+    if DiskCacheOff:
+        return
+    WriteFileAtomic(pop.join(GetCacheDirStr(), nameStr),
+            pkl.dumps(val, 2))
+
+# ----------------------------------------------------------------------------
+# WriteFileAtomic(str, bytes)
+#   Write a cache file under a temporary name and rename it, so that readers
+#   never see a partial file; make the directory if needed. Errors are
+#   ignored: on-disk caches are optional.
+
+def WriteFileAtomic(pathStr, data):
+    tmpPathStr = "%s.%d.%d.tmp" % (pathStr, po.getpid(),
+            pth.current_thread().ident)
+    try:
+        dirStr = pop.dirname(pathStr)
+        if not pop.isdir(dirStr):
+            try:
+                po.makedirs(dirStr)
+            except OSError:
+                # Another thread or process may have made it.
+                if not pop.isdir(dirStr):
+                    raise
+        with open(tmpPathStr, "wb") as fhdl:
+            fhdl.write(data)
+        if po.name == "nt" and pop.exists(pathStr):
+            po.remove(pathStr)
+        po.rename(tmpPathStr, pathStr)
+    except (IOError, OSError):
+        try:
+            po.remove(tmpPathStr)
+        except OSError:
+            pass
+
+# CODE =======================================================================
+
+import collections as pcl # OrderedDict
+import os          as po  # environ, getpid, makedirs, remove, rename, walk
+import os.path     as pop # expanduser, join
+import pickle      as pkl # on-disk caches
+import threading   as pth # Lock
+
+# SizeFactors: size suffixes, see 'ParseSizeStr'.
+
+SizeFactors = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+# DiskCacheOff: whether on-disk caches are off, bool. See 'SetDiskCacheOff'.
+
+DiskCacheOff = False
@@ -0,0 +1,399 @@
+# coding: utf-8
+#
+# maxe.catalog: OASIS XML catalogs.
+#
+# Copyright (C) 2020 Mikhail Edoshin.
+#
+# This file is part of Maxe.
+#
+# Maxe is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Maxe is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Maxe.  If not, see <https://www.gnu.org/licenses/>.
+
+# ============================================================================
+
+from __future__ import absolute_import
+
+# ============================================================================
+# Data types
+
+# ----------------------------------------------------------------------------
+# Catalog
+#   An OASIS XML catalog and the catalogs it chains to with 'nextCatalog':
+#   an index per catalog file, in the order the standard looks them up.
+#
+#   stamps: the files and their mtimes and sizes, or None if a file does
+#     not exist; if any of them has changed, the Catalog is outdated,
+#     [(str, float or None, int or None)].
+#   files: the indexes of the catalog files that exist, depth-first, in the
+#     order of 'nextCatalog' entries, [CatalogFile].
+#
+# Usage:
+#   GetCatalog(mp.Path): Catalog
+#   ResolveCatalogEntity(Catalog, str, str): str or None
+#   ResolveCatalogUri(Catalog, str): str or None
+
+class Catalog(object):
+    __slots__ = "stamps", "files"
+
+# ----------------------------------------------------------------------------
+# CatalogFile
+#   An index of the entries of a catalog file. Exact matches are looked up
+#   in dicts; rewrites and suffixes are lists sorted from the longest
+#   string, so the first match is the one the standard requires. When the
+#   file has several entries for the same string, the first one wins.
+#
+#   publics: URIs by public identifier, {str:str}.
+#   preferPublics: same, but only the entries where 'prefer' is 'public'
+#     (the default); they are used when there is a system identifier too,
+#     {str:str}.
+#   systems: URIs by system identifier, {str:str}.
+#   uris: URIs by URI, {str:str}.
+#   systemRewrites, uriRewrites: start strings and rewrite prefixes,
+#     [(str, str)].
+#   systemSuffixes, uriSuffixes: suffixes and URIs, [(str, str)].
+#
+#   The URIs are absolute: relative ones are resolved against the catalog
+#   file and 'xml:base'. Delegation entries are not supported.
+
+class CatalogFile(object):
+    __slots__ = "publics", "preferPublics", "systems", "uris", \
+            "systemRewrites", "uriRewrites", "systemSuffixes", "uriSuffixes"
+
+# ============================================================================
+# Functions
+
+# ----------------------------------------------------------------------------
+# CatalogIsFresh(Catalog): bool
+#   Test if the files of the Catalog have not changed since it was read.
+
+def CatalogIsFresh(catalog):
+    i = 0; n = len(catalog.stamps)
+    while i < n:
+        pathStr, mtime, size = catalog.stamps[i]; i += 1
+        poStat = mp.GetPathStat(mp.MakePath(pathStr)).poStat
+        if poStat is None:
+            if mtime is not None:
+                return False
+        elif poStat.st_mtime != mtime or poStat.st_size != size:
+            return False
+    return True
+
+# ----------------------------------------------------------------------------
+# GetCatalog(mp.Path): Catalog
+#   Get the Catalog of a catalog file. Catalogs are read once and kept in
+#   memory and on disk, in the cache directory (see 'mca.GetCacheDirStr');
+#   both copies are checked by the mtimes and sizes of the catalog files.
+
+def GetCatalog(path):
+    key = mp.GetPathXfrm(path)
+    with CatalogLock:
+        catalog = Catalogs.get(key)
+    if catalog is not None and CatalogIsFresh(catalog):
+        RecordCatalogDeps(catalog)
+        return catalog
+    fileNameStr = "catalog-%s.pickle" % phl.sha1(
+            key.encode("utf-8")).hexdigest()
+    state = mca.ReadCacheFile(fileNameStr)
+    if state is not None and state[0] == CatalogFormat:
+        catalog = MakeCatalog()
+        catalog.stamps = state[1]
+        for fileState in state[2]:
+            catFile = MakeCatalogFile()
+            catFile.publics, catFile.preferPublics, catFile.systems, \
+                    catFile.uris, catFile.systemRewrites, \
+                    catFile.uriRewrites, catFile.systemSuffixes, \
+                    catFile.uriSuffixes = fileState
+            catalog.files.append(catFile)
+        if not CatalogIsFresh(catalog):
+            catalog = None
+    else:
+        catalog = None
+    if catalog is None:
+        catalog = ReadCatalog(path)
+        mca.WriteCacheFile(fileNameStr, (CatalogFormat, catalog.stamps,
+                [(catFile.publics, catFile.preferPublics, catFile.systems,
+                catFile.uris, catFile.systemRewrites, catFile.uriRewrites,
+                catFile.systemSuffixes, catFile.uriSuffixes)
+                for catFile in catalog.files]))
+    with CatalogLock:
+        Catalogs[key] = catalog
+    RecordCatalogDeps(catalog)
+    return catalog
+
+# ----------------------------------------------------------------------------
+# GetEntryLen((str, str)): int
+#   Get the length of the matched string of a rewrite or a suffix entry.
+
+def GetEntryLen(entry):
+    return len(entry[0])
+
+# ----------------------------------------------------------------------------
+# GetUriPathStr(str): str or None
+#   Get the path of a 'nextCatalog' URI, resolved already: a 'file:' URI or
+#   a path, with escapes decoded; None if the URI has another scheme.
+
+def GetUriPathStr(uriStr):
+    if uriStr.startswith("file://"):
+        # Drop the host, e.g. 'localhost'.
+        i = uriStr.find("/", 7)
+        if i < 0:
+            return None
+        uriStr = uriStr[i:]
+    elif uriStr.startswith("file:"):
+        uriStr = uriStr[5:]
+    else:
+        schemeStr, colonStr, _ = uriStr.partition(":")
+        # A one-letter scheme is a Windows drive.
+        if colonStr and len(schemeStr) > 1 and "/" not in schemeStr:
+            return None
+    return mc.UnquoteUriStr(uriStr)
+
+# ----------------------------------------------------------------------------
+# MakeCatalog(): Catalog
+#   Make an empty Catalog.
+
+def MakeCatalog():
+    catalog = Catalog()
+    catalog.stamps = []
+    catalog.files = []
+    return catalog
+
+# ----------------------------------------------------------------------------
+# MakeCatalogFile(): CatalogFile
+#   Make an empty CatalogFile.
+
+def MakeCatalogFile():
+    catFile = CatalogFile()
+    catFile.publics = {}
+    catFile.preferPublics = {}
+    catFile.systems = {}
+    catFile.uris = {}
+    catFile.systemRewrites = []
+    catFile.uriRewrites = []
+    catFile.systemSuffixes = []
+    catFile.uriSuffixes = []
+    return catFile
+
+# ----------------------------------------------------------------------------
+# NormPubIdStr(str): str
+#   Normalize a public identifier: collapse whitespace.
+
+def NormPubIdStr(pubIdStr):
+    return " ".join(pubIdStr.split())
+
+# ----------------------------------------------------------------------------
+# ReadCatalog(mp.Path): Catalog
+#   Read a catalog file and the catalogs it chains to into a Catalog. The
+#   next catalogs of a file are read right after it, before the rest, as
+#   the standard looks them up. The catalog file itself must exist; a next
+#   catalog that does not exist is skipped, as the standard says, but is
+#   stamped, so that the Catalog is outdated once it's created.
+
+def ReadCatalog(path):
+    catalog = MakeCatalog()
+    # Make the path absolute, so are the URIs resolved against it.
+    pathStrs = [pop.abspath(mp.GetPathStr(path))]; seen = set()
+    while pathStrs:
+        pathStr = pathStrs.pop()
+        key = mp.GetPathStatKey(pathStr)
+        if key in seen:
+            continue
+        seen.add(key)
+        poStat = mp.GetPathStat(mp.MakePath(pathStr)).poStat
+        if poStat is None:
+            if not catalog.stamps:
+                raise Exception("The catalog '%s' does not exist"
+                        % mp.GetPathStr(path))
+            catalog.stamps.append((pathStr, None, None))
+            continue
+        catalog.stamps.append((pathStr, poStat.st_mtime, poStat.st_size))
+        catFile = MakeCatalogFile()
+        nextPathStrs = ReadCatalogFile(catFile, pathStr)
+        catFile.systemRewrites.sort(key=GetEntryLen, reverse=True)
+        catFile.uriRewrites.sort(key=GetEntryLen, reverse=True)
+        catFile.systemSuffixes.sort(key=GetEntryLen, reverse=True)
+        catFile.uriSuffixes.sort(key=GetEntryLen, reverse=True)
+        catalog.files.append(catFile)
+        pathStrs.extend(reversed(nextPathStrs))
+    return catalog
+
+# ----------------------------------------------------------------------------
+# ReadCatalogFile(CatalogFile, str): [str]
+#   Add the entries of a catalog file to a CatalogFile; get the paths of
+#   the next catalogs, see 'GetUriPathStr'. The file is parsed without
+#   loading its DTD and with no network access. 'prefer' is inherited from
+#   the enclosing 'group' or 'catalog' and is 'public' by default.
+
+def ReadCatalogFile(catFile, pathStr):
+    nextPathStrs = []
+    parser = le.XMLParser(load_dtd=False, no_network=True,
+            resolve_entities=False)
+    root = le.parse(pathStr, parser).getroot()
+    if root.tag != CatalogJcStr:
+        raise Exception("Expected an OASIS XML catalog in '%s'" % pathStr)
+    for elt in root.iter(le.Element):
+        tag = elt.tag
+        if not tag.startswith(CatalogNsJcStr):
+            continue
+        tag = tag[len(CatalogNsJcStr):]
+        baseStr = elt.base or pathStr
+        if tag == "public":
+            pubIdStr = NormPubIdStr(elt.get("publicId", ""))
+            uriStr = mc.JoinUriStr(baseStr, elt.get("uri", ""))
+            catFile.publics.setdefault(pubIdStr, uriStr)
+            preferElt = elt.getparent()
+            while preferElt.get("prefer") is None and preferElt is not root:
+                preferElt = preferElt.getparent()
+            if preferElt.get("prefer", "public") == "public":
+                catFile.preferPublics.setdefault(pubIdStr, uriStr)
+        elif tag == "system":
+            catFile.systems.setdefault(elt.get("systemId", ""),
+                    mc.JoinUriStr(baseStr, elt.get("uri", "")))
+        elif tag == "uri":
+            catFile.uris.setdefault(elt.get("name", ""),
+                    mc.JoinUriStr(baseStr, elt.get("uri", "")))
+        elif tag == "rewriteSystem":
+            catFile.systemRewrites.append((
+                    elt.get("systemIdStartString", ""),
+                    mc.JoinUriStr(baseStr, elt.get("rewritePrefix", ""))))
+        elif tag == "rewriteURI":
+            catFile.uriRewrites.append((elt.get("uriStartString", ""),
+                    mc.JoinUriStr(baseStr, elt.get("rewritePrefix", ""))))
+        elif tag == "systemSuffix":
+            catFile.systemSuffixes.append((elt.get("systemIdSuffix", ""),
+                    mc.JoinUriStr(baseStr, elt.get("uri", ""))))
+        elif tag == "uriSuffix":
+            catFile.uriSuffixes.append((elt.get("uriSuffix", ""),
+                    mc.JoinUriStr(baseStr, elt.get("uri", ""))))
+        elif tag == "nextCatalog":
+            nextPathStr = GetUriPathStr(mc.JoinUriStr(baseStr,
+                    elt.get("catalog", "")))
+            if nextPathStr is not None:
+                nextPathStrs.append(nextPathStr)
+    return nextPathStrs
+
+# ----------------------------------------------------------------------------
+# RecordCatalogDeps(Catalog)
+#   Record the catalog files as dependencies: what they resolve to may
+#   change. A missing next catalog is a stat dependency: it may be created.
+
+def RecordCatalogDeps(catalog):
+    i = 0; n = len(catalog.stamps)
+    while i < n:
+        pathStr, mtime, _ = catalog.stamps[i]; i += 1
+        if mtime is None:
+            md.RecordDep(md.DepTypeStat, pathStr)
+        else:
+            md.RecordDep(md.DepTypeFile, pathStr)
+
+# ----------------------------------------------------------------------------
+# ResolveCatalogEntity(Catalog, str or None, str or None): str or None
+#   Resolve an external entity, such as a DTD, by its system and public
+#   identifiers; None if the Catalog has no entry for it. Catalog files are
+#   tried in order; in each the system identifier is tried first, then the
+#   public one, but if there is a system identifier, only the public entries
+#   where 'prefer' is 'public' count.
+
+def ResolveCatalogEntity(catalog, sysIdStr, pubIdStr):
+    if pubIdStr:
+        pubIdStr = NormPubIdStr(pubIdStr)
+    i = 0; n = len(catalog.files)
+    while i < n:
+        catFile = catalog.files[i]; i += 1
+        if sysIdStr:
+            uriStr = catFile.systems.get(sysIdStr)
+            if uriStr is None:
+                uriStr = RewriteStr(catFile.systemRewrites,
+                        catFile.systemSuffixes, sysIdStr)
+            if uriStr is not None:
+                return uriStr
+            if pubIdStr:
+                uriStr = catFile.preferPublics.get(pubIdStr)
+                if uriStr is not None:
+                    return uriStr
+        elif pubIdStr:
+            uriStr = catFile.publics.get(pubIdStr)
+            if uriStr is not None:
+                return uriStr
+    return None
+
+# ----------------------------------------------------------------------------
+# ResolveCatalogUri(Catalog, str): str or None
+#   Resolve a URI, e.g. of an imported XSLT; None if the Catalog has no
+#   entry for it. Catalog files are tried in order.
+
+def ResolveCatalogUri(catalog, uriStr):
+    i = 0; n = len(catalog.files)
+    while i < n:
+        catFile = catalog.files[i]; i += 1
+        resolvedStr = catFile.uris.get(uriStr)
+        if resolvedStr is None:
+            resolvedStr = RewriteStr(catFile.uriRewrites,
+                    catFile.uriSuffixes, uriStr)
+        if resolvedStr is not None:
+            return resolvedStr
+    return None
+
+# ----------------------------------------------------------------------------
+# RewriteStr([(str, str)], [(str, str)], str): str or None
+#   Apply the longest matching rewrite or, if none, the longest matching
+#   suffix entry to a string; None if nothing matches.
+
+def RewriteStr(rewrites, suffixes, str_):
+    i = 0; n = len(rewrites)
+    while i < n:
+        startStr, prefixStr = rewrites[i]; i += 1
+        if startStr and str_.startswith(startStr):
+            return prefixStr + str_[len(startStr):]
+    i = 0; n = len(suffixes)
+    while i < n:
+        suffixStr, uriStr = suffixes[i]; i += 1
+        if suffixStr and str_.endswith(suffixStr):
+            return uriStr
+    return None
+
+# CODE =======================================================================
+
+import hashlib     as phl # sha1
+import os.path     as pop # abspath
+import threading   as pth # Lock
+
+import lxml.etree  as le
+
+import maxe.cache  as mca
+import maxe.compat as mc
+import maxe.dep    as md
+import maxe.path   as mp
+
+# ----------------------------------------------------------------------------
+# CatalogFormat: the version of the on-disk Catalog format, int.
+
+CatalogFormat = 3
+
+# ----------------------------------------------------------------------------
+# CatalogLock: guards 'Catalogs', pth.Lock.
+
+CatalogLock = pth.Lock()
+
+# ----------------------------------------------------------------------------
+# CatalogNsJcStr, CatalogJcStr: the catalog namespace and root element in
+# James Clark notation, str.
+
+CatalogNsJcStr = "{urn:oasis:names:tc:entity:xmlns:xml:catalog}"
+CatalogJcStr = CatalogNsJcStr + "catalog"
+
+# ----------------------------------------------------------------------------
+# Catalogs: Catalogs read in this process by the transformed catalog path,
+# {str:Catalog}. See 'GetCatalog'.
+
+Catalogs = {}
@@ -18,7 +18,10 @@
 # You should have received a copy of the GNU General Public License
 # along with Maxe.  If not, see <https://www.gnu.org/licenses/>.
 
-import sys as ps
+import os      as po
+import os.path as pop
+import stat    as pst
+import sys     as ps
 pyVer = ps.version_info.major
 
 # ============================================================================
@@ -87,4 +90,124 @@ elif pyVer == 3:
 
     def MakeFhdlInMem(data):
         return pi.BytesIO(data)
-        
+
+# ----------------------------------------------------------------------------
+# MakeOFhdlInMem():
+#   Make a filelike object to write data into memory.
+
+if pyVer == 2:
+    def MakeOFhdlInMem():
+        return pc.StringIO()
+
+elif pyVer == 3:
+    def MakeOFhdlInMem():
+        return pi.BytesIO()
+
+# ----------------------------------------------------------------------------
+# MakeQueue(int): Queue
+#   Make a thread-safe queue of the given maximum size.
+
+if pyVer == 2:
+    import Queue as pq
+
+    def MakeQueue(maxSize):
+        return pq.Queue(maxSize)
+
+elif pyVer == 3:
+    import queue as pq
+
+    def MakeQueue(maxSize):
+        return pq.Queue(maxSize)
+
+
+# ----------------------------------------------------------------------------
+# ListedDirEntry: a DirEntry made from a name that was listed before; it
+#   reads its stat on first use. Like with 'os.scandir' entries, 'is_dir'
+#   and 'is_file' are False if the path is gone.
+#
+# Usage:
+#   MakeListedDirEntry(str, str): ListedDirEntry
+
+class ListedDirEntry(object):
+    __slots__ = "name", "path", "poStat"
+    def is_dir(self):
+        try:
+            return pst.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+    def is_file(self):
+        try:
+            return pst.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+    def stat(self):
+        if self.poStat is None:
+            self.poStat = po.stat(self.path)
+        return self.poStat
+
+# ----------------------------------------------------------------------------
+# MakeListedDirEntry(str, str): ListedDirEntry
+#   Make a ListedDirEntry for a name in a directory.
+
+def MakeListedDirEntry(dirPathStr, nameStr):
+    entry = ListedDirEntry()
+    entry.name = nameStr
+    entry.path = pop.join(dirPathStr, nameStr)
+    entry.poStat = None
+    return entry
+
+# ----------------------------------------------------------------------------
+# ScanDir(str): iter(DirEntry)
+#   List a directory as entries with names, paths, types, and lazy stats, as
+#   'os.scandir' does. Python 2 uses the 'scandir' package if installed, or
+#   else ListedDirEntries.
+
+if pyVer == 2:
+    try:
+        import scandir as psd
+    except ImportError:
+        psd = None
+
+    def ScanDir(pathStr):
+        if psd is not None:
+            return psd.scandir(pathStr)
+        entries = []
+        for nameStr in po.listdir(pathStr):
+            entries.append(MakeListedDirEntry(pathStr, nameStr))
+        return entries
+
+elif pyVer == 3:
+    def ScanDir(pathStr):
+        return po.scandir(pathStr)
+
+# ----------------------------------------------------------------------------
+# UnquoteUriStr(str): str
+#   Replace %xx escapes in a URI string.
+
+if pyVer == 2:
+    import urllib as pu
+
+    def UnquoteUriStr(uriStr):
+        return pu.unquote(uriStr)
+
+elif pyVer == 3:
+    import urllib.parse as pu
+
+    def UnquoteUriStr(uriStr):
+        return pu.unquote(uriStr)
+
+# ----------------------------------------------------------------------------
+# JoinUriStr(str, str): str
+#   Resolve a URI reference against a base URI or path.
+
+if pyVer == 2:
+    import urlparse as pup
+
+    def JoinUriStr(baseUriStr, uriStr):
+        return pup.urljoin(baseUriStr, uriStr)
+
+elif pyVer == 3:
+    import urllib.parse as pup
+
+    def JoinUriStr(baseUriStr, uriStr):
+        return pup.urljoin(baseUriStr, uriStr)
@@ -0,0 +1,265 @@
+# coding: utf-8
+#
+# maxe.dep: record files and directories a run depends on.
+#
+# Copyright (C) 2020 Mikhail Edoshin.
+#
+# This file is part of Maxe.
+#
+# Maxe is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Maxe is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Maxe.  If not, see <https://www.gnu.org/licenses/>.
+
+# ============================================================================
+
+from __future__ import absolute_import
+
+# ============================================================================
+# Data types
+
+# ----------------------------------------------------------------------------
+# DepRec
+#   Dependencies recorded in this process. Recording is off until
+#   'StartDeps'; while it's off and nothing captures dependencies,
+#   'RecordDep' costs two tests. Each dependency gets a fingerprint when
+#   it's first recorded, i.e. before or right after the data were used, so
+#   a change made during the run is noticed next time.
+#
+#   on: whether to record, bool.
+#   deps: fingerprints by dependency type and absolute path,
+#     {(DepType, str):DepFprint}.
+#   captures: the dependencies of the open captures, see 'CaptureDeps'; the
+#     list is replaced, not changed, so it can be read without the lock,
+#     [{(DepType, str):DepFprint}].
+#   lock: guards 'deps' and 'captures', pth.Lock.
+#
+# Usage:
+#   CaptureDeps(): {(DepType, str):DepFprint}
+#   DepsAreFresh({(DepType, str):DepFprint}): bool
+#   FormatDepfile(str, {(DepType, str):DepFprint}): str
+#   FormatDepsJson(str, {(DepType, str):DepFprint}): str
+#   RecordDep(DepType, str)
+#   RecordDirDep(str, [str])
+#   ReleaseDeps({(DepType, str):DepFprint})
+#   StartDeps()
+#   StopDeps(): {(DepType, str):DepFprint}
+
+class DepRec(object):
+    __slots__ = "on", "deps", "captures", "lock"
+
+# ----------------------------------------------------------------------------
+# DepType: how a run depends on a path.
+#
+# DepFprint: a fingerprint of a path; equal fingerprints mean no change as
+# far as the DepType is concerned. None if the path does not exist.
+#   DepTypeFile, DepTypeStat: (bool, float, int), is a directory, mtime,
+#     size.
+#   DepTypeDir: str, a digest of the sorted names in the directory.
+
+DepTypeFile = 0 # the file was read
+DepTypeStat = 1 # the stat of the path was used
+DepTypeDir  = 2 # the directory was listed
+
+# ============================================================================
+# Functions
+
+# ----------------------------------------------------------------------------
+# AddDep((DepType, str), [str] or None)
+#   Add a dependency to the recorded ones, if recording is on, and to the
+#   open captures that do not have it yet. The fingerprint is taken once:
+#   from the recorded ones, else from the listing of a directory, if given,
+#   else from the path.
+
+def AddDep(key, nameStrs):
+    depMaps = [deps for deps in DepRecInst.captures if key not in deps]
+    recorded = DepRecInst.on and key in DepRecInst.deps
+    if DepRecInst.on and not recorded:
+        depMaps.append(DepRecInst.deps)
+    if not depMaps:
+        return
+    if recorded:
+        fprint = DepRecInst.deps[key]
+    elif nameStrs is None:
+        fprint = GetDepFprint(key[0], key[1])
+    else:
+        fprint = GetDirFprint(nameStrs)
+    with DepRecInst.lock:
+        i = 0; n = len(depMaps)
+        while i < n:
+            depMaps[i].setdefault(key, fprint); i += 1
+
+# ----------------------------------------------------------------------------
+# CaptureDeps(): {(DepType, str):DepFprint}
+#   Start capturing dependencies, e.g. of a part of the run whose result is
+#   cached: until 'ReleaseDeps' the dependencies recorded are also added to
+#   the returned dict, even if they were recorded before or recording is
+#   off. Captures may nest.
+
+def CaptureDeps():
+    deps = {}
+    with DepRecInst.lock:
+        DepRecInst.captures = DepRecInst.captures + [deps]
+    return deps
+
+# ----------------------------------------------------------------------------
+# DepsAreFresh({(DepType, str):DepFprint}): bool
+#   Test if recorded dependencies have not changed.
+
+def DepsAreFresh(deps):
+    for key, fprint in deps.items():
+        if GetDepFprint(key[0], key[1]) != fprint:
+            return False
+    return True
+
+# ----------------------------------------------------------------------------
+# EscapeDepfileStr(str): str
+#   Escape a path for a Makefile rule, as make and ninja read it.
+
+def EscapeDepfileStr(pathStr):
+    pathStr = pathStr.replace("$", "$$").replace("#", "\\#")
+    return pathStr.replace(" ", "\\ ")
+
+# ----------------------------------------------------------------------------
+# FormatDepfile(str, {(DepType, str):DepFprint}): str
+#   Format dependencies as a Makefile rule for a target, as 'gcc -MD' does:
+#   the files read, the directories listed, and the paths whose stats were
+#   used. Paths that did not exist are left out: make would stop on them.
+
+def FormatDepfile(targetStr, deps):
+    pathStrs = GetDepPathStrs(deps, (DepTypeFile, DepTypeDir, DepTypeStat),
+            True)
+    lineStrs = [EscapeDepfileStr(targetStr) + ":"]
+    i = 0; n = len(pathStrs)
+    while i < n:
+        lineStrs.append("  " + EscapeDepfileStr(pathStrs[i])); i += 1
+    return " \\\n".join(lineStrs) + "\n"
+
+# ----------------------------------------------------------------------------
+# FormatDepsJson(str, {(DepType, str):DepFprint}): str
+#   Format dependencies of a target as JSON: an object with the 'target',
+#   'files' read, 'directories' listed, and 'stats' used, missing paths
+#   included.
+
+def FormatDepsJson(targetStr, deps):
+    return pjs.dumps({
+        "target"     : targetStr,
+        "files"      : GetDepPathStrs(deps, (DepTypeFile,), False),
+        "directories": GetDepPathStrs(deps, (DepTypeDir,), False),
+        "stats"      : GetDepPathStrs(deps, (DepTypeStat,), False)},
+        indent=2, sort_keys=True) + "\n"
+
+# ----------------------------------------------------------------------------
+# GetDepFprint(DepType, str): DepFprint
+#   Get the current fingerprint of a path.
+
+def GetDepFprint(depType, pathStr):
+    if depType == DepTypeDir:
+        try:
+            nameStrs = po.listdir(pathStr)
+        except OSError:
+            return None
+        return GetDirFprint(nameStrs)
+    try:
+        poStat = po.stat(pathStr)
+    except OSError:
+        return None
+    return (pst.S_ISDIR(poStat.st_mode), poStat.st_mtime, poStat.st_size)
+
+# ----------------------------------------------------------------------------
+# GetDepPathStrs({(DepType, str):DepFprint}, (DepType...), bool): [str]
+#   Get the sorted paths of dependencies of the given types, relative to the
+#   current directory if they are inside it, optionally only the ones that
+#   existed.
+
+def GetDepPathStrs(deps, depTypes, existing):
+    curDirStr = po.getcwd()
+    pathStrs = set()
+    for key, fprint in deps.items():
+        if key[0] not in depTypes or existing and fprint is None:
+            continue
+        pathStr = key[1]
+        if pathStr.startswith(curDirStr + pop.sep):
+            pathStr = pathStr[len(curDirStr) + 1:]
+        pathStrs.add(pathStr)
+    return sorted(pathStrs)
+
+# ----------------------------------------------------------------------------
+# GetDirFprint([str]): str
+#   Get the fingerprint of a directory listing.
+
+def GetDirFprint(nameStrs):
+    data = "\0".join(sorted(nameStrs))
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8", "backslashreplace")
+    return phl.sha1(data).hexdigest()
+
+# ----------------------------------------------------------------------------
+# RecordDep(DepType, str)
+#   Record that the run depends on a path. Directories use 'RecordDirDep'.
+
+def RecordDep(depType, pathStr):
+    if DepRecInst.on or DepRecInst.captures:
+        AddDep((depType, pop.abspath(pathStr)), None)
+
+# ----------------------------------------------------------------------------
+# RecordDirDep(str, [str])
+#   Record that the run listed a directory; the names are the listing.
+
+def RecordDirDep(pathStr, nameStrs):
+    if DepRecInst.on or DepRecInst.captures:
+        AddDep((DepTypeDir, pop.abspath(pathStr)), nameStrs)
+
+# ----------------------------------------------------------------------------
+# ReleaseDeps({(DepType, str):DepFprint})
+#   Stop a capture started by 'CaptureDeps'.
+
+def ReleaseDeps(deps):
+    with DepRecInst.lock:
+        DepRecInst.captures = [capture for capture in DepRecInst.captures
+                if capture is not deps]
+
+# ----------------------------------------------------------------------------
+# StartDeps()
+#   Start recording dependencies; forget the ones recorded before.
+
+def StartDeps():
+    with DepRecInst.lock:
+        DepRecInst.deps = {}
+        DepRecInst.on = True
+
+# ----------------------------------------------------------------------------
+# StopDeps(): {(DepType, str):DepFprint}
+#   Stop recording dependencies; get the recorded ones.
+
+def StopDeps():
+    with DepRecInst.lock:
+        DepRecInst.on = False
+        deps = DepRecInst.deps
+        DepRecInst.deps = {}
+    return deps
+
+# CODE =======================================================================
+
+import hashlib     as phl # sha1
+import json        as pjs # dumps
+import os          as po  # getcwd, listdir, stat
+import os.path     as pop # abspath
+import stat        as pst # S_ISDIR
+import threading   as pth # Lock
+
+# The dependency recorder of this process.
+
+DepRecInst = DepRec()
+DepRecInst.on = False
+DepRecInst.deps = {}
+DepRecInst.captures = []
+DepRecInst.lock = pth.Lock()
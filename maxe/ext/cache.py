@@ -0,0 +1,288 @@
+# coding: utf-8
+#
+# maxe.ext.cache: XSLT extension to cache output fragments across runs.
+#
+# Copyright (C) 2020 Mikhail Edoshin.
+#
+# This file is part of Maxe.
+#
+# Maxe is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Maxe is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Maxe.  If not, see <https://www.gnu.org/licenses/>.
+
+# Declarations ===============================================================
+
+# ----------------------------------------------------------------------------
+# Frag: an output fragment, an le.Element, whose text and children are the
+# output of the body of a 'mext:cache' element. Frags are kept in memory
+# in 'FragMemo' and on disk in 'FragCache', serialized, with the
+# dependencies the body recorded, {(md.DepType, str):md.DepFprint}.
+
+# ----------------------------------------------------------------------------
+# AppendFrag(Frag, le._AppendOnlyElementProxy)
+#   Append copies of the text and nodes of a Frag to the output.
+
+def AppendFrag(frag, outputElt):
+    if frag.text:
+        outputElt.text = (outputElt.text or "") + frag.text
+    for node in frag:
+        outputElt.append(node)
+
+# ----------------------------------------------------------------------------
+# CopyProxy(le._ReadOnlyProxy, le.Element or None): le.Element
+#   Copy a node of the output, which extensions can only read through a
+#   proxy, with its tail. A copied element is appended to the parent and
+#   declares only the namespaces that the parent does not.
+
+def CopyProxy(proxy, parentElt):
+    if proxy.tag is le.Comment:
+        node = le.Comment(proxy.text)
+        if parentElt is not None:
+            parentElt.append(node)
+    elif proxy.tag is le.ProcessingInstruction:
+        node = le.ProcessingInstruction(proxy.target, proxy.text)
+        if parentElt is not None:
+            parentElt.append(node)
+    else:
+        nsMap = {}
+        parentNsMap = {} if parentElt is None else parentElt.nsmap
+        for pfxStr, uriStr in proxy.nsmap.items():
+            if parentNsMap.get(pfxStr) != uriStr:
+                nsMap[pfxStr] = uriStr
+        if parentElt is None:
+            node = le.Element(proxy.tag, dict(proxy.items()), nsMap)
+        else:
+            node = le.SubElement(parentElt, proxy.tag, dict(proxy.items()),
+                    nsMap)
+        node.text = proxy.text
+        for childProxy in proxy.iterchildren():
+            CopyProxy(childProxy, node)
+    node.tail = proxy.tail
+    return node
+
+# ----------------------------------------------------------------------------
+# GetBodyDigestStr(le._ReadOnlyElementProxy): str
+#   Get a digest of the XSLT body of an extension element, so that a changed
+#   body does not reuse fragments of the old one.
+
+def GetBodyDigestStr(selfElt):
+    hashObj = phl.sha1(); proxies = [selfElt]
+    while proxies:
+        proxy = proxies.pop()
+        if callable(proxy.tag):
+            # A comment or a processing instruction.
+            hashObj.update(repr((proxy.tag.__name__, proxy.text,
+                    proxy.tail)).encode("utf-8"))
+            continue
+        hashObj.update(repr((proxy.tag, sorted(proxy.items()), proxy.text,
+                proxy.tail)).encode("utf-8"))
+        proxies.extend(reversed(list(proxy.iterchildren())))
+    return hashObj.hexdigest()
+
+# ----------------------------------------------------------------------------
+# GetFragKeyStr(le._ReadOnlyElementProxy, le._ReadOnlyElementProxy): str
+#   Get the cache key of a 'mext:cache' element: a digest of its body, the
+#   value of its 'key' expression, and the mtimes and sizes of the paths in
+#   its 'deps'. The paths are recorded as dependencies of the run.
+
+def GetFragKeyStr(selfElt, inputElt):
+    keyExprStr = selfElt.get("key")
+    if keyExprStr is None:
+        raise Exception("The 'mext:cache' element has no 'key'")
+    keyStr = GetKeyXPath(keyExprStr, selfElt.nsmap)(GetKeyCtxElt(inputElt))
+    fprints = []; depPathStrs = (selfElt.get("deps") or "").split()
+    i = 0; n = len(depPathStrs)
+    while i < n:
+        pathStr = depPathStrs[i]; i += 1
+        md.RecordDep(md.DepTypeFile, pathStr)
+        poStat = mp.GetPathStat(mp.MakePath(pathStr)).poStat
+        if poStat is None:
+            fprints.append((pathStr, None))
+        else:
+            fprints.append((pathStr, poStat.st_mtime, poStat.st_size))
+    keyItems = (FragCacheFormat, GetBodyDigestStr(selfElt), keyStr, fprints)
+    return phl.sha1(repr(keyItems).encode("utf-8")).hexdigest()
+
+# ----------------------------------------------------------------------------
+# GetKeyCtxElt(le._ReadOnlyElementProxy): le.Element
+#   Get the context node for the 'key' expression: a copy of the current
+#   element and its ancestors with their attributes and text, but no other
+#   children. lxml cannot evaluate XPath on the input of an extension
+#   element, so the expression sees only what's copied.
+
+def GetKeyCtxElt(inputElt):
+    proxies = []; proxy = inputElt
+    while proxy is not None and not callable(proxy.tag):
+        proxies.append(proxy); proxy = proxy.getparent()
+    elt = None
+    while proxies:
+        proxy = proxies.pop()
+        if elt is None:
+            elt = le.Element(proxy.tag, dict(proxy.items()), proxy.nsmap)
+        else:
+            elt = le.SubElement(elt, proxy.tag, dict(proxy.items()))
+        elt.text = proxy.text
+    if elt is None:
+        elt = le.Element("root")
+    return elt
+
+# ----------------------------------------------------------------------------
+# GetKeyXPath(str, {str:str}): le.XPath
+#   Get the compiled 'key' expression of a 'mext:cache' element with the
+#   namespaces in scope; it's compiled once per text and namespaces, see
+#   'KeyXPathMemo'.
+
+def GetKeyXPath(keyExprStr, nsMap):
+    nsItems = tuple(sorted((pfxStr, uriStr)
+            for pfxStr, uriStr in nsMap.items() if pfxStr))
+    memoKey = (keyExprStr, nsItems)
+    keyXPath = KeyXPathMemo.get(memoKey)
+    if keyXPath is None:
+        keyXPath = KeyXPathMemo[memoKey] = le.XPath(
+                "string(%s)" % keyExprStr, namespaces=dict(nsItems))
+    return keyXPath
+
+# ----------------------------------------------------------------------------
+# GetOutputFrag(XSLTExtension, _XSLTContext, le._AppendOnlyElementProxy):
+#         Frag
+#   Run the body of an extension element into the output and get a Frag of
+#   what it added. Attributes added to the output element are not a part
+#   of the Frag.
+
+def GetOutputFrag(ext, leCtx, outputElt):
+    childProxies = list(outputElt.iterchildren()); n = len(childProxies)
+    if n:
+        oldText = childProxies[-1].tail or ""
+    else:
+        oldText = outputElt.text or ""
+    ext.process_children(leCtx, outputElt)
+    childProxies = list(outputElt.iterchildren())
+    if n:
+        text = childProxies[n - 1].tail or ""
+    else:
+        text = outputElt.text or ""
+    frag = le.Element("fragment")
+    frag.text = text[len(oldText):] or None
+    i = n; n = len(childProxies)
+    while i < n:
+        frag.append(CopyProxy(childProxies[i], None)); i += 1
+    return frag
+
+# ----------------------------------------------------------------------------
+# ReadCachedFrag(str): (Frag, {(md.DepType, str):md.DepFprint}) or None
+#   Read a Frag and its dependencies from 'FragCache' and keep them in
+#   'FragMemo'; None if there is none or its dependencies have changed.
+
+def ReadCachedFrag(keyStr):
+    data = mca.GetDiskCacheVal(FragCache, keyStr)
+    if data is None:
+        return None
+    try:
+        fragData, deps = pkl.loads(data)
+    except Exception:
+        return None
+    if not md.DepsAreFresh(deps):
+        return None
+    cached = (le.fromstring(fragData), deps)
+    mca.PutLruVal(FragMemo, keyStr, cached, len(fragData))
+    return cached
+
+# Extensions =================================================================
+
+# ----------------------------------------------------------------------------
+# XCache(XSLTExtension, _XSLTContext, le._ReadOnlyElementProxy,
+#         le._ReadOnlyElementProxy, le._AppendOnlyElementProxy)
+#   XSLT extension element to cache the output of its body in memory and on
+#   disk, see 'FragCache':
+#
+#       <mext:cache key="expression" deps="path...">body</mext:cache>
+#
+#   key: an XPath expression; its string value tells apart outputs of the
+#     same body. It's evaluated against the current element and its
+#     ancestors with their attributes and text only; variables and other
+#     nodes are not visible.
+#   deps: paths, separated by spaces, that the body depends on; they are
+#     checked by mtime and size. The body itself is always a part of the
+#     key, but templates it calls are not: list the XSLT in 'deps' to
+#     rebuild fragments when it changes.
+#
+#   The body runs only if there is no fragment for the key; otherwise a
+#   copy of the fragment is output and the dependencies the body recorded
+#   when it ran, e.g. files it read, are recorded again. A fragment on disk
+#   is not used if these dependencies have changed. A body that adds
+#   attributes to the output element must not be cached. Text at the start
+#   of a fragment can only be output if the output element has no children
+#   yet; else the body runs again.
+
+def XCache(ext, leCtx, selfElt, inputElt, outputElt):
+    try:
+        keyStr = GetFragKeyStr(selfElt, inputElt)
+        cached = mca.GetLruVal(FragMemo, keyStr)
+        if cached is None:
+            cached = ReadCachedFrag(keyStr)
+        if cached is not None and (not cached[0].text
+                or len(outputElt) == 0):
+            frag, deps = cached
+            AppendFrag(frag, outputElt)
+            for depType, pathStr in deps:
+                md.RecordDep(depType, pathStr)
+        else:
+            deps = md.CaptureDeps()
+            try:
+                frag = GetOutputFrag(ext, leCtx, outputElt)
+            finally:
+                md.ReleaseDeps(deps)
+            fragData = le.tostring(frag)
+            mca.PutLruVal(FragMemo, keyStr, (frag, deps), len(fragData))
+            mca.PutDiskCacheVal(FragCache, keyStr,
+                    pkl.dumps((fragData, deps), 2))
+    except Exception as exc:
+        outputElt.append(mm.GetExcAsXml(exc))
+
+# CODE =======================================================================
+
+import hashlib     as phl # sha1
+import pdb         as pd; pd = pd # debugger
+import pickle      as pkl # dumps, loads
+
+import lxml.etree  as le
+
+import maxe.cache  as mca
+import maxe.dep    as md
+import maxe.msg    as mm
+import maxe.path   as mp
+import maxe.xml    as mx
+
+# ----------------------------------------------------------------------------
+# FragCache: fragments output by 'mext:cache' on disk; FragCacheFormat is
+# the version of the entries.
+
+FragCache = mca.MakeDiskCache("frag", 64 << 20)
+FragCacheFormat = 2
+
+# ----------------------------------------------------------------------------
+# FragMemo: Frags of this process and their dependencies by their keys,
+# (Frag, {(md.DepType, str):md.DepFprint}); the budget is in bytes of the
+# serialized Frags.
+
+FragMemo = mca.MakeLru(64 << 20)
+
+# ----------------------------------------------------------------------------
+# KeyXPathMemo: compiled 'key' expressions by their text and namespaces,
+# {(str, ((str, str)...)):le.XPath}.
+
+KeyXPathMemo = {}
+
+# Register extensions.
+
+mx.RegExts("urn:onegasoft:Maxe/Ext",
+    "cache", mx.ExtElt, XCache)
@@ -21,6 +21,625 @@
 
 # Declarations ===============================================================
 
+# ----------------------------------------------------------------------------
+# DuAgg: totals of a directory tree for 'mext:disk-usage'.
+#
+#   size: the sum of the file sizes, int.
+#   files, dirs: the number of files and of directories, int.
+#   mtime: the newest mtime of the directory and the entries, float.
+#   exts: sizes and numbers of files by extension, {str:[int, int]}.
+#   elt: the element of the totals, Xml(Elt).
+#
+# Usage:
+#   AddDuAggFile(DuAgg, str, os.stat_result)
+#   EndDuAgg(DuAgg, DuAgg or None)
+#   MakeDuAgg(str, float): DuAgg
+
+class DuAgg(object):
+    __slots__ = "size", "files", "dirs", "mtime", "exts", "elt"
+
+# ----------------------------------------------------------------------------
+# ScanParam: what 'IterDirScan' and 'mext:list-directory' output. Excluded
+#   and ignored subtrees are pruned: they are never listed or statted.
+#
+#   depth: how deep to walk; 0 is only the root, 1 its entries, etc.;
+#     None is no limit, int or None.
+#   includes: name or path patterns; if any, only files and other entries
+#     that match one are output; directories are always walked,
+#     [ScanPattern].
+#   excludes: name or path patterns of entries to skip, [ScanPattern].
+#   types: the entry types to output: 'file', 'dir', 'other'; a scan
+#     always outputs the directories it walks, set([str]).
+#   ignoreFileNameStr: the name of '.gitignore'-style files to read in each
+#     directory, str or None; see 'ReadScanIgnores'.
+#   attrs: the attributes to output besides 'path', see 'ScanAttrNames',
+#     set([str]).
+#   needsStat: whether 'attrs' need a stat; if not, the types come from the
+#     listing, bool.
+#   jobs: how many directories to list and stat at once; see 'ScanRun',
+#     int.
+#   snapPathStr: where to write a ScanSnap of the walked tree, str or None.
+#   sortStr: how 'mext:list-directory' sorts the entries, see
+#     'ListSortKeys', str.
+#   reverse: whether to sort in the descending order, bool.
+#   offset, limit: which entries of the sorted listing to output; 'limit'
+#     is None for all, int.
+#
+#   A pattern with a slash matches the path relative to the scanned
+#   directory, else the name; see 'CompileScanPattern'.
+#
+# Usage:
+#   IterDirScan(mp.Path, ScanParam): iter((ScanEvt, Xml(Elt)))
+#   MakeScanParam(): ScanParam
+#   ScanParamXArg(XArg or None): ScanParam
+#   SetScanParamOpt(ScanParam, str, str)
+
+class ScanParam(object):
+    __slots__ = "depth", "includes", "excludes", "types", \
+            "ignoreFileNameStr", "attrs", "needsStat", "jobs", "snapPathStr", \
+            "sortStr", "reverse", "offset", "limit"
+
+# ----------------------------------------------------------------------------
+# ScanIgnore: a rule of an ignore file: the directory of the file relative
+#   to the scanned one, whether the rule is negated ('!'), whether it is for
+#   directories only (a trailing '/'), whether it matches the path relative
+#   to the directory rather than the name, and the pattern,
+#   (str, bool, bool, bool, re).
+
+# ----------------------------------------------------------------------------
+# ScanPattern: a pattern of 'include' or 'exclude': whether it matches the
+#   path relative to the scanned directory rather than the name, and the
+#   pattern, (bool, re).
+
+# ----------------------------------------------------------------------------
+# ScanDir: a directory to list in a scan.
+#
+#   pathStr: the path, str.
+#   relStr: the path relative to the scanned directory, str.
+#   depth: the depth of its entries; the scanned directory is 0, int.
+#   ignores: the ignore rules of its parents, [ScanIgnore].
+#   result: the listing being read by a thread, pmp.AsyncResult or None.
+#   snapDir: the ScanSnapDir of the listing, if the ScanRun needs one.
+#
+# ScanItem: an entry of a listed ScanDir that passed the filters: the entry,
+# its element name, and, if it's a directory to walk, its ScanDir,
+# (mp.DirEntry, QName, ScanDir or None).
+
+class ScanDir(object):
+    __slots__ = "pathStr", "relStr", "depth", "ignores", "result", "snapDir"
+
+# ----------------------------------------------------------------------------
+# ScanRun: the state of a single scan.
+#
+#   With more than one job directories are listed and their entries statted
+#   by a pool of threads: each listing submits its subdirectories, so the
+#   threads run ahead of the walk, breadth first; the walk takes the
+#   listings in the order of names and waits if a listing is not there yet.
+#   On a network filesystem a listing is a round trip, so this makes the
+#   scan up to 'jobs' times faster; the output is the same. Elements are
+#   made by the walk, not by the threads.
+#
+#   scanParam: the options, ScanParam.
+#   rootStr: the path of the scanned directory, str.
+#   pool: the threads or None if there is one job, pmp.ThreadPool.
+#   lock: guards 'ahead' and the 'result' of ScanDirs, pth.Lock.
+#   ahead: how many listings are submitted, but not taken by the walk yet,
+#     int.
+#   maxAhead: the limit of 'ahead'; it bounds the memory, int.
+#   snap: the ScanSnap being recorded or None.
+#   baseSnap: a ScanSnap to compare with or None; unchanged directories in
+#     it are not listed again, see 'ListScanDirEntries'.
+#
+# Usage:
+#   MakeScanRun(mp.Path, ScanParam): ScanRun
+#   TakeScanDir(ScanRun, ScanDir): [ScanItem]
+#   DropScanRun(ScanRun)
+
+class ScanRun(object):
+    __slots__ = "scanParam", "rootStr", "pool", "lock", "ahead", \
+            "maxAhead", "snap", "baseSnap"
+
+# ----------------------------------------------------------------------------
+# ScanSnap: a snapshot of a scanned tree, to find changes later (see
+#   'GetDirChangesAsXml'); it's kept on disk pickled.
+#
+#   time: when the scan began, as 'time.time', float.
+#   filterKey: the filters of the scan, see 'GetScanFilterKey'; a ScanSnap
+#     can only be compared with a scan with the same filters, tuple.
+#   dirs: the listed directories by the path relative to the scanned one,
+#     {str:ScanSnapDir}.
+#
+# ScanSnapDir: a listed directory: its mtime and inode, the names in it,
+# and the ScanFprints of the entries that passed the filters,
+# (float, int, [str], {str:ScanFprint}).
+#
+# ScanFprint: an entry: type ('file', 'dir', 'other'; None if it's gone),
+# size, mtime, and inode, (str or None, int, float, int).
+#
+# Usage:
+#   ReadScanSnap(mp.Path): ScanSnap
+#   WriteScanSnap(str, ScanSnap)
+
+class ScanSnap(object):
+    __slots__ = "time", "filterKey", "dirs"
+
+# ----------------------------------------------------------------------------
+# ScanEvt: directory scan event.
+#   Usage: IterDirScan(mp.Path, ScanParam): iter((ScanEvt, Xml(Elt)))
+
+ScanEvtBegin = 0 # a directory element; its entries follow up to ScanEvtEnd
+ScanEvtEnd   = 1 # end of the last begun directory; the element is None
+ScanEvtEntry = 2 # an element of any other path type
+
+# ----------------------------------------------------------------------------
+# AddDuAggFile(DuAgg, str, os.stat_result)
+#   Add a file to a DuAgg.
+
+def AddDuAggFile(duAgg, nameStr, poStat):
+    duAgg.size += poStat.st_size
+    duAgg.files += 1
+    duAgg.mtime = max(duAgg.mtime, poStat.st_mtime)
+    extStr = pop.splitext(nameStr)[1]
+    ext = duAgg.exts.get(extStr)
+    if ext is None:
+        duAgg.exts[extStr] = [poStat.st_size, 1]
+    else:
+        ext[0] += poStat.st_size; ext[1] += 1
+
+# ----------------------------------------------------------------------------
+# AddScanDirChanges(ScanRun, ScanDir, [ScanItem], [(tuple, Xml(Elt))])
+#   Compare a listed directory with the one in the base ScanSnap of the
+#   ScanRun; add the changed entries to a list with their sort keys.
+
+def AddScanDirChanges(scanRun, scanDir, scanItems, changes):
+    baseSnapDir = scanRun.baseSnap.dirs.get(scanDir.relStr)
+    baseFprints = {} if baseSnapDir is None else baseSnapDir[3]
+    fprints = scanDir.snapDir[3]
+    i = 0; n = len(scanItems)
+    while i < n:
+        entry, qName, _ = scanItems[i]; i += 1
+        baseFprint = baseFprints.get(entry.name)
+        if baseFprint is None:
+            changeStr = "added"
+        elif baseFprint[0] != fprints[entry.name][0]:
+            AddSnapDeletions(scanRun, scanDir.relStr, entry.name,
+                    baseFprint, changes)
+            changeStr = "added"
+        elif baseFprint[0] != "dir" and baseFprint != fprints[entry.name]:
+            changeStr = "modified"
+        else:
+            continue
+        entryElt = GetEntryStatAsXml(entry, qName, scanRun.scanParam)
+        mx.SetAttr(entryElt, mxQNameChange, changeStr)
+        changes.append((GetScanPathKey(
+                JoinScanRelStr(scanDir.relStr, entry.name)), entryElt))
+    for nameStr, baseFprint in baseFprints.items():
+        if nameStr not in fprints:
+            AddSnapDeletions(scanRun, scanDir.relStr, nameStr, baseFprint,
+                    changes)
+
+# ----------------------------------------------------------------------------
+# AddSnapDeletions(ScanRun, str, str, ScanFprint, [(tuple, Xml(Elt))])
+#   Add an entry of the base ScanSnap that is gone to a list of changes;
+#   for a directory add all its entries in the ScanSnap too. The attributes
+#   are those of 'GetEntryStatAsXml', but 'ctime' and 'atime', which the
+#   ScanFprint does not keep.
+
+def AddSnapDeletions(scanRun, dirRelStr, nameStr, fprint, changes):
+    relStr = JoinScanRelStr(dirRelStr, nameStr)
+    typeStr = fprint[0]
+    entryElt = mx.MakeElt(ScanTypeQNames.get(typeStr, mxQNameMxPath))
+    pathStr = pop.join(scanRun.rootStr, relStr)
+    mx.SetAttr(entryElt, mxQNamePath, pathStr)
+    attrs = scanRun.scanParam.attrs
+    if typeStr == "file" or typeStr == "dir":
+        if "name" in attrs:
+            mx.SetAttr(entryElt, mxQNameName, nameStr)
+        if "mtime" in attrs:
+            mx.SetAttr(entryElt, mxQNameMtime, str(fprint[2]))
+        if typeStr == "file":
+            stemStr, extStr = pop.splitext(pathStr)
+            if "size" in attrs:
+                mx.SetAttr(entryElt, mxQNameSize, str(fprint[1]))
+            if "stem" in attrs:
+                mx.SetAttr(entryElt, mxQNameStem, stemStr)
+            if "ext" in attrs:
+                mx.SetAttr(entryElt, mxQNameExt, extStr)
+    mx.SetAttr(entryElt, mxQNameChange, "deleted")
+    changes.append((GetScanPathKey(relStr), entryElt))
+    baseSnapDir = scanRun.baseSnap.dirs.get(relStr)
+    if typeStr == "dir" and baseSnapDir is not None:
+        for childNameStr, childFprint in baseSnapDir[3].items():
+            AddSnapDeletions(scanRun, relStr, childNameStr, childFprint,
+                    changes)
+
+# ----------------------------------------------------------------------------
+# CompileScanPattern(str): re
+#   Compile a glob pattern that matches a name or a relative path. As in
+#   '.gitignore' '*' and '?' do not match a slash, '**' matches anything,
+#   and '**/' matches any number of directories, including none; '[...]'
+#   is a class and '[!...]' a negated one. Unlike in 'fnmatch' the case
+#   always matters.
+
+def CompileScanPattern(patternStr):
+    reStrs = []; i = 0; n = len(patternStr)
+    while i < n:
+        charStr = patternStr[i]; i += 1
+        if charStr == "*":
+            if patternStr.startswith("*/", i):
+                reStrs.append("(?:.*/)?"); i += 2
+            elif patternStr.startswith("*", i):
+                reStrs.append(".*"); i += 1
+            else:
+                reStrs.append("[^/]*")
+        elif charStr == "?":
+            reStrs.append("[^/]")
+        elif charStr == "[":
+            j = i
+            if patternStr.startswith("!", j):
+                j += 1
+            if patternStr.startswith("]", j):
+                j += 1
+            j = patternStr.find("]", j)
+            if j < 0:
+                reStrs.append("\\[")
+            else:
+                classStr = patternStr[i:j].replace("\\", "\\\\")
+                if classStr.startswith("!"):
+                    classStr = "^" + classStr[1:]
+                elif classStr.startswith("^"):
+                    classStr = "\\" + classStr
+                reStrs.append("[%s]" % classStr); i = j + 1
+        else:
+            reStrs.append(pre.escape(charStr))
+    return pre.compile("(?s)%s\\Z" % "".join(reStrs))
+
+# ----------------------------------------------------------------------------
+# DropScanRun(ScanRun)
+#   Stop the threads of a ScanRun. Listings that are not taken are dropped.
+
+def DropScanRun(scanRun):
+    if scanRun.pool is not None:
+        scanRun.pool.terminate()
+        scanRun.pool.join()
+
+# ----------------------------------------------------------------------------
+# EndDuAgg(DuAgg, DuAgg or None)
+#   Set the totals of a DuAgg to its element and add them to the DuAgg of
+#   the parent directory, if any. The breakdown by extension goes before the
+#   elements of the subdirectories.
+
+def EndDuAgg(duAgg, parentDuAgg):
+    elt = duAgg.elt
+    mx.SetAttr(elt, mxQNameSize, str(duAgg.size))
+    mx.SetAttr(elt, mxQNameFiles, str(duAgg.files))
+    mx.SetAttr(elt, mxQNameDirectories, str(duAgg.dirs))
+    mx.SetAttr(elt, mxQNameMtime, str(duAgg.mtime))
+    extStrs = sorted(duAgg.exts); i = 0; n = len(extStrs)
+    while i < n:
+        extStr = extStrs[i]; size, files = duAgg.exts[extStr]
+        extElt = mx.MakeElt(mxQNameMxExtension)
+        mx.SetAttr(extElt, mxQNameExt, extStr)
+        mx.SetAttr(extElt, mxQNameSize, str(size))
+        mx.SetAttr(extElt, mxQNameFiles, str(files))
+        mx.Insert(elt, extElt, i); i += 1
+    if parentDuAgg is not None:
+        parentDuAgg.size += duAgg.size
+        parentDuAgg.files += duAgg.files
+        parentDuAgg.dirs += duAgg.dirs
+        parentDuAgg.mtime = max(parentDuAgg.mtime, duAgg.mtime)
+        for extStr, (size, files) in duAgg.exts.items():
+            ext = parentDuAgg.exts.get(extStr)
+            if ext is None:
+                parentDuAgg.exts[extStr] = [size, files]
+            else:
+                ext[0] += size; ext[1] += files
+
+# ----------------------------------------------------------------------------
+# FindDupsAsXml(mp.Path, ScanParam, int, str): Xml(Elt)
+#   Find files with the same data in a directory tree:
+#
+#   <maxe:duplicates path groups wasted>
+#     <maxe:duplicate-group size hash>
+#       <maxe:file path name .../>...
+#     </maxe:duplicate-group>...
+#   </maxe:duplicates>
+#
+#   Files are grouped by size first; only the files that share a size are
+#   read: first the head of each ('DupHeadSize'), then, if the heads match,
+#   the whole file. Files are hashed by 'jobs' threads. Files smaller than
+#   'minSize' are skipped, and so are other links to a file already seen.
+#   Groups go in the order of the scan of their first files; 'wasted' is
+#   the size of all files but one in each group.
+
+def FindDupsAsXml(path, scanParam, minSize, algoStr):
+    scanParam.needsStat = True
+    entriesBySize = {}; linkKeys = set()
+    scanRun = MakeScanRun(path, scanParam)
+    try:
+        for entry, qName in IterScanEntries(scanRun):
+            if qName is not mxQNameMxFile:
+                continue
+            poStat = mp.ReadEntryPoStat(entry)
+            if poStat.st_size < minSize:
+                continue
+            if poStat.st_nlink > 1:
+                linkKey = (poStat.st_dev, poStat.st_ino)
+                if linkKey in linkKeys:
+                    continue
+                linkKeys.add(linkKey)
+            entriesBySize.setdefault(poStat.st_size, []).append(entry)
+    finally:
+        DropScanRun(scanRun)
+    # Hash the heads of the files that share a size, then the whole files
+    # that share a head; a file no larger than the head is hashed already.
+    groups = GroupDupEntries([entries for entries in entriesBySize.values()
+            if len(entries) > 1], algoStr, DupHeadSize, scanParam.jobs)
+    headGroups = groups; groups = []; bigEntryLists = []
+    i = 0; n = len(headGroups)
+    while i < n:
+        group = headGroups[i]; i += 1
+        if mp.ReadEntryPoStat(group[1][0]).st_size <= DupHeadSize:
+            groups.append(group)
+        else:
+            bigEntryLists.append(group[1])
+    groups.extend(GroupDupEntries(bigEntryLists, algoStr, None,
+            scanParam.jobs))
+    groups.sort(key=GetDupGroupKey)
+    dupsElt = mx.MakeElt(mxQNameMxDuplicates)
+    mx.SetAttr(dupsElt, mxQNamePath, mp.GetPathStr(path))
+    wasted = 0; i = 0; n = len(groups)
+    while i < n:
+        hashStr, entries = groups[i]; i += 1
+        size = mp.ReadEntryPoStat(entries[0]).st_size
+        wasted += size * (len(entries) - 1)
+        groupElt = mx.MakeElt(mxQNameMxDuplicateGroup)
+        mx.SetAttr(groupElt, mxQNameSize, str(size))
+        mx.SetAttr(groupElt, mxQNameHash, hashStr)
+        j = 0; m = len(entries)
+        while j < m:
+            entry = entries[j]; j += 1
+            mx.AppendElt(groupElt, GetEntryStatAsXml(entry, mxQNameMxFile,
+                    scanParam))
+        mx.AppendElt(dupsElt, groupElt)
+    mx.SetAttr(dupsElt, mxQNameGroups, str(n))
+    mx.SetAttr(dupsElt, mxQNameWasted, str(wasted))
+    return dupsElt
+
+# ----------------------------------------------------------------------------
+# GetDirChangesAsXml(mp.Path, ScanSnap, ScanParam): Xml(Elt)
+#   Walk the directory tree and compare it with a ScanSnap made with the
+#   same filters, else it's an error; get the entries added, modified, or
+#   deleted since, in the order of a scan. Directories are reported as
+#   added or deleted only, with all their entries; an entry whose type
+#   changed is reported as deleted and added.
+#
+#   <maxe:changes path="...">
+#     <maxe:file change="added|modified|deleted" path name .../>
+#     ...
+#   </maxe:changes>
+#
+#   Directories whose mtime and inode have not changed are not listed, the
+#   names come from the ScanSnap; each entry still costs a stat, since a
+#   file changed in place does not change the mtime of the directory.
+
+def GetDirChangesAsXml(path, baseSnap, scanParam):
+    if baseSnap.filterKey != GetScanFilterKey(scanParam):
+        raise Exception("The snapshot was written with other filters: "
+                "'depth', 'include', 'exclude', 'type', and 'ignore-file' "
+                "must be the same")
+    scanRun = MakeScanRun(path, scanParam)
+    scanRun.baseSnap = baseSnap
+    changes = []
+    try:
+        scanDirs = [MakeScanDir(scanRun.rootStr, "", 1, [])]
+        while scanDirs:
+            scanDir = scanDirs.pop()
+            scanItems = TakeScanDir(scanRun, scanDir)
+            AddScanDirChanges(scanRun, scanDir, scanItems, changes)
+            i = len(scanItems)
+            while i > 0:
+                i -= 1
+                if scanItems[i][2] is not None:
+                    scanDirs.append(scanItems[i][2])
+    finally:
+        DropScanRun(scanRun)
+    if scanParam.snapPathStr is not None:
+        WriteScanSnap(scanParam.snapPathStr, scanRun.snap)
+    changes.sort(key=GetScanChangeKey)
+    changesElt = mx.MakeElt(mxQNameMxChanges)
+    mx.SetAttr(changesElt, mxQNamePath, scanRun.rootStr)
+    i = 0; n = len(changes)
+    while i < n:
+        mx.AppendElt(changesElt, changes[i][1]); i += 1
+    return changesElt
+
+# ----------------------------------------------------------------------------
+# GetDiskUsageAsXml(mp.Path, int, ScanParam): Xml(Elt)
+#   Walk the directory tree and get the totals of it and of subdirectories
+#   down to a depth (0 is only the directory itself):
+#
+#   <maxe:disk-usage path size files directories mtime>
+#     <maxe:extension ext size files/>...
+#     <maxe:disk-usage path ...>...</maxe:disk-usage>...
+#   </maxe:disk-usage>
+#
+#   Sizes are the sizes of files, as in 'stat'; a file with several hard
+#   links is counted once. No elements are made for the entries, so the
+#   memory depends on the depth and the number of extensions, not on the
+#   number of files, save for the identities of hard-linked files.
+
+def GetDiskUsageAsXml(path, depth, scanParam):
+    scanParam.needsStat = True
+    rootPoStat = mp.GetPathStat(path).poStat
+    if rootPoStat is None or not pst.S_ISDIR(rootPoStat.st_mode):
+        raise Exception("Expected a directory: '%s'" % mp.GetPathStr(path))
+    rootDuAgg = MakeDuAgg(mp.GetPathStr(path), rootPoStat.st_mtime)
+    linkKeys = set()
+    scanRun = MakeScanRun(path, scanParam)
+    try:
+        stack = [(iter(TakeScanDir(scanRun,
+                MakeScanDir(scanRun.rootStr, "", 1, []))), rootDuAgg, True)]
+        while stack:
+            scanItems, duAgg, ownsDuAgg = stack[-1]
+            for entry, qName, scanDir in scanItems:
+                md.RecordDep(md.DepTypeStat, entry.path)
+                poStat = mp.ReadEntryPoStat(entry)
+                if qName is mxQNameMxFile:
+                    if poStat.st_nlink > 1:
+                        linkKey = (poStat.st_dev, poStat.st_ino)
+                        if linkKey in linkKeys:
+                            continue
+                        linkKeys.add(linkKey)
+                    AddDuAggFile(duAgg, entry.name, poStat)
+                elif qName is mxQNameMxDirectory:
+                    duAgg.dirs += 1
+                    if scanDir is None:
+                        duAgg.mtime = max(duAgg.mtime, poStat.st_mtime)
+                    elif scanDir.depth - 1 <= depth:
+                        subdirDuAgg = MakeDuAgg(entry.path, poStat.st_mtime)
+                        mx.AppendElt(duAgg.elt, subdirDuAgg.elt)
+                        stack.append((iter(TakeScanDir(scanRun, scanDir)),
+                                subdirDuAgg, True))
+                        break
+                    else:
+                        duAgg.mtime = max(duAgg.mtime, poStat.st_mtime)
+                        stack.append((iter(TakeScanDir(scanRun, scanDir)),
+                                duAgg, False))
+                        break
+            else:
+                stack.pop()
+                if ownsDuAgg:
+                    EndDuAgg(duAgg, stack[-1][1] if stack else None)
+    finally:
+        DropScanRun(scanRun)
+    return rootDuAgg.elt
+
+# ----------------------------------------------------------------------------
+# GetDupGroupKey((str, [mp.DirEntry])): tuple
+#   Get the sort key of a group of duplicates: the path of the first file.
+
+def GetDupGroupKey(group):
+    return GetScanPathKey(group[1][0].path)
+
+# ----------------------------------------------------------------------------
+# GetEntryMtimeKey(mp.DirEntry): (float, str)
+#   Get the sort key of an entry by mtime, then name; an entry that is gone
+#   sorts as the oldest.
+
+def GetEntryMtimeKey(entry):
+    poStat = mp.ReadEntryPoStat(entry)
+    return (0.0 if poStat is None else poStat.st_mtime, entry.name)
+
+# ----------------------------------------------------------------------------
+# GetEntryNameKey(mp.DirEntry): str
+#   Get the sort key of an entry by name.
+
+def GetEntryNameKey(entry):
+    return entry.name
+
+# ----------------------------------------------------------------------------
+# GetEntryNaturalKey(mp.DirEntry): (tuple, str)
+#   Get the sort key of an entry by name in the natural order: numbers in
+#   names are compared by value and letters regardless of case, so 'a2'
+#   sorts before 'A10'. The name itself breaks ties.
+
+def GetEntryNaturalKey(entry):
+    # The parts alternate: text, number, text, ...; so are compared parts
+    # always of the same type.
+    partStrs = ScanNumRe.split(entry.name.lower()); i = 1; n = len(partStrs)
+    while i < n:
+        partStrs[i] = int(partStrs[i]); i += 2
+    return (tuple(partStrs), entry.name)
+
+# ----------------------------------------------------------------------------
+# GetEntryQName(mp.DirEntry, bool): QName
+#   Get the element name for a directory entry: directory, file, unknown
+#   path type, or, if it no longer exists or is a broken symlink, path. The
+#   type comes from the listing; without a stat an entry that is gone since
+#   it was listed still gets its old type.
+
+def GetEntryQName(entry, needsStat):
+    if entry.is_dir():
+        qName = mxQNameMxDirectory
+    elif entry.is_file():
+        qName = mxQNameMxFile
+    else:
+        qName = mxQNameMxUnknownPathType
+    if (needsStat or qName is mxQNameMxUnknownPathType) \
+            and mp.ReadEntryPoStat(entry) is None:
+        qName = mxQNameMxPath
+    return qName
+
+# ----------------------------------------------------------------------------
+# GetEntrySizeKey(mp.DirEntry): (int, str)
+#   Get the sort key of an entry by size, then name.
+
+def GetEntrySizeKey(entry):
+    poStat = mp.ReadEntryPoStat(entry)
+    return (0 if poStat is None else poStat.st_size, entry.name)
+
+# ----------------------------------------------------------------------------
+# GetEntryStatAsXml(mp.DirEntry, QName, ScanParam): Xml(Elt)
+#   Get stat of a directory entry as XML; same as 'GetPathStatAsXml', but
+#   with the attributes of the ScanParam only. The type comes from the
+#   listing (see 'GetEntryQName') and the stat, if needed, is read once.
+
+def GetEntryStatAsXml(entry, qName, scanParam):
+    md.RecordDep(md.DepTypeStat, entry.path)
+    pathElt = mx.MakeElt(qName)
+    mx.SetAttr(pathElt, mxQNamePath, entry.path)
+    if qName is mxQNameMxFile or qName is mxQNameMxDirectory:
+        attrs = scanParam.attrs
+        if scanParam.needsStat:
+            poStat = mp.ReadEntryPoStat(entry)
+        if "name" in attrs:
+            mx.SetAttr(pathElt, mxQNameName, entry.name)
+        if "ctime" in attrs:
+            mx.SetAttr(pathElt, mxQNameCtime, str(poStat.st_ctime))
+        if "mtime" in attrs:
+            mx.SetAttr(pathElt, mxQNameMtime, str(poStat.st_mtime))
+        if qName is mxQNameMxFile:
+            stemStr, extStr = pop.splitext(entry.path)
+            if "atime" in attrs:
+                mx.SetAttr(pathElt, mxQNameAtime, str(poStat.st_atime))
+            if "size" in attrs:
+                mx.SetAttr(pathElt, mxQNameSize, str(poStat.st_size))
+            if "stem" in attrs:
+                mx.SetAttr(pathElt, mxQNameStem, stemStr)
+            if "ext" in attrs:
+                mx.SetAttr(pathElt, mxQNameExt, extStr)
+    return pathElt
+
+# ----------------------------------------------------------------------------
+# GetFileHash((str, str)): str or None
+#   Get the digest of a file by its path and 'hashlib' algorithm, from
+#   'FileHashes' if the file has the same size, mtime, and inode as when it
+#   was hashed; get None if the path is not a file. A file modified less
+#   than 'FileHashRacyTime' seconds ago is hashed, but not remembered: a
+#   change in the same tick of the clock would keep the mtime.
+
+def GetFileHash(hashArg):
+    global FileHashesDirty
+    pathStr, algoStr = hashArg
+    poStat = mp.GetPathStat(mp.MakePath(pathStr)).poStat
+    if poStat is None or not pst.S_ISREG(poStat.st_mode):
+        return None
+    md.RecordDep(md.DepTypeFile, pathStr)
+    key = (mp.GetPathStatKey(pathStr), algoStr)
+    fprint = (poStat.st_size, poStat.st_mtime, poStat.st_ino)
+    with FileHashLock:
+        cached = FileHashes.get(key)
+    if cached is not None and cached[0] == fprint:
+        return cached[1]
+    hashStr = HashDupFile((pathStr, algoStr, None))
+    if hashStr is not None \
+            and poStat.st_mtime < pti.time() - FileHashRacyTime:
+        with FileHashLock:
+            FileHashes[key] = (fprint, hashStr)
+            FileHashesDirty = True
+    return hashStr
+
 # ----------------------------------------------------------------------------
 # GetPathAsXml(mp.Path): Xml(Elt)
 #   Get path as XML (without stats).
@@ -44,6 +663,7 @@ def GetPathAsXml(path):
 #   The function does not scan directories; see 'ScanDirAsXml'.
 
 def GetPathStatAsXml(path):
+    md.RecordDep(md.DepTypeStat, mp.GetPathStr(path))
     if not mp.PathExists(path):
         qName = mxQNameMxPath
     elif mp.PathIsDir(path):
@@ -66,30 +686,919 @@ def GetPathStatAsXml(path):
     return pathElt
 
 # ----------------------------------------------------------------------------
-# ScanDirAsXml(mp.Path): le.Element
+# GetScanChangeKey((tuple, Xml(Elt))): tuple
+#   Get the sort key of a change, see 'GetScanPathKey'.
+
+def GetScanChangeKey(change):
+    return change[0]
+
+# ----------------------------------------------------------------------------
+# GetScanFilterKey(ScanParam): tuple
+#   Get the options of a ScanParam that decide what a scan lists, in a form
+#   that does not depend on their order: the depth, the patterns, the
+#   types, and the ignore file.
+
+def GetScanFilterKey(scanParam):
+    return (scanParam.depth,
+            sorted(set((anchored, pattern.pattern)
+            for anchored, pattern in scanParam.includes)),
+            sorted(set((anchored, pattern.pattern)
+            for anchored, pattern in scanParam.excludes)),
+            sorted(scanParam.types), scanParam.ignoreFileNameStr)
+
+# ----------------------------------------------------------------------------
+# GetScanFprint(mp.DirEntry, QName): ScanFprint
+#   Get the ScanFprint of an entry; the stat is read already.
+
+def GetScanFprint(entry, qName):
+    if qName is mxQNameMxPath:
+        return (None, 0, 0.0, 0)
+    poStat = mp.ReadEntryPoStat(entry)
+    if qName is mxQNameMxDirectory:
+        typeStr = "dir"
+    elif qName is mxQNameMxFile:
+        typeStr = "file"
+    else:
+        typeStr = "other"
+    return (typeStr, poStat.st_size, poStat.st_mtime, poStat.st_ino)
+
+# ----------------------------------------------------------------------------
+# GetScanPathKey(str): tuple
+#   Get the sort key of a relative path: the names in it, so that paths are
+#   sorted in the order of a scan.
+
+def GetScanPathKey(relStr):
+    return tuple(relStr.split(pop.sep))
+
+# ----------------------------------------------------------------------------
+# GetScanRelStr(str, str): str
+#   Get the path of an entry relative to the scanned directory.
+
+def GetScanRelStr(rootStr, pathStr):
+    return pathStr[len(rootStr):].lstrip(pop.sep)
+
+# ----------------------------------------------------------------------------
+# GroupDupEntries([[mp.DirEntry]], str, int or None, int):
+#         [(str, [mp.DirEntry])]
+#   Split lists of files by the digests of their heads of 'size' bytes or,
+#   if 'size' is None, of their data; get the groups of more than one file
+#   with their digests. Files are hashed by 'jobs' threads; files that are
+#   gone are dropped.
+
+def GroupDupEntries(entryLists, algoStr, size, jobs):
+    hashArgs = []; i = 0; n = len(entryLists)
+    while i < n:
+        entries = entryLists[i]; i += 1
+        j = 0; m = len(entries)
+        while j < m:
+            hashArgs.append((entries[j].path, algoStr, size)); j += 1
+    if jobs > 1 and len(hashArgs) > 1:
+        pool = pmp.ThreadPool(min(jobs, len(hashArgs)))
+        try:
+            hashStrs = pool.map(HashDupFile, hashArgs)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        hashStrs = list(map(HashDupFile, hashArgs))
+    groups = []; k = 0; i = 0; n = len(entryLists)
+    while i < n:
+        entries = entryLists[i]; i += 1
+        entriesByHash = {}; hashStrsInOrder = []
+        j = 0; m = len(entries)
+        while j < m:
+            entry = entries[j]; j += 1
+            hashStr = hashStrs[k]; k += 1
+            if hashStr is None:
+                continue
+            if hashStr not in entriesByHash:
+                entriesByHash[hashStr] = []
+                hashStrsInOrder.append(hashStr)
+            entriesByHash[hashStr].append(entry)
+        j = 0; m = len(hashStrsInOrder)
+        while j < m:
+            hashStr = hashStrsInOrder[j]; j += 1
+            if len(entriesByHash[hashStr]) > 1:
+                groups.append((hashStr, entriesByHash[hashStr]))
+    return groups
+
+# ----------------------------------------------------------------------------
+# HashDupFile((str, str, int or None)): str or None
+#   Hash a file, or its head, for 'GroupDupEntries'; get None if the file is
+#   gone.
+
+def HashDupFile(hashArg):
+    pathStr, algoStr, size = hashArg
+    try:
+        strm = ms.MakeIStrmFromPath(mp.MakePath(pathStr))
+    except Exception:
+        if pop.isfile(pathStr):
+            raise
+        return None
+    try:
+        return ms.HashStrm(strm, algoStr, size)
+    finally:
+        ms.DropStrm(strm)
+
+# ----------------------------------------------------------------------------
+# HashFilesAsXml([str], str, int): [Xml(Elt)]
+#   Get digests of files as XML, in the order of the paths:
+#
+#       <maxe:file path hash>
+#
+#   Paths that are not files get 'maxe:path', 'maxe:directory', or
+#   'maxe:unknown-path-type' elements with no 'hash'. Each distinct path is
+#   hashed once, by up to 'jobs' threads (hashlib releases the GIL on large
+#   reads); digests of unchanged files come from 'FileHashes', which is
+#   kept in the cache directory between runs, see 'WriteFileHashes'.
+
+def HashFilesAsXml(pathStrs, algoStr, jobs):
+    ReadFileHashes()
+    hashArgs = []; hashStrs = {}; i = 0; n = len(pathStrs)
+    while i < n:
+        pathStr = pathStrs[i]; i += 1
+        if pathStr not in hashStrs:
+            hashStrs[pathStr] = None
+            hashArgs.append((pathStr, algoStr))
+    if jobs > 1 and len(hashArgs) > 1:
+        jobs = min(jobs, len(hashArgs))
+        pool = pmp.ThreadPool(jobs)
+        try:
+            # Batches keep warm runs, which only stat, cheap.
+            digests = pool.map(GetFileHash, hashArgs,
+                    max(len(hashArgs) // (jobs * 4), 1))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        digests = [GetFileHash(hashArg) for hashArg in hashArgs]
+    i = 0; n = len(hashArgs)
+    while i < n:
+        hashStrs[hashArgs[i][0]] = digests[i]; i += 1
+    result = []; i = 0; n = len(pathStrs)
+    while i < n:
+        pathStr = pathStrs[i]; i += 1
+        path = mp.MakePath(pathStr); hashStr = hashStrs[pathStr]
+        if hashStr is not None or mp.PathIsFile(path):
+            qName = mxQNameMxFile
+        elif not mp.PathExists(path):
+            qName = mxQNameMxPath
+        elif mp.PathIsDir(path):
+            qName = mxQNameMxDirectory
+        else:
+            qName = mxQNameMxUnknownPathType
+        elt = mx.MakeElt(qName)
+        mx.SetAttr(elt, mxQNamePath, pathStr)
+        if hashStr is not None:
+            mx.SetAttr(elt, mxQNameHash, hashStr)
+        result.append(elt)
+    return result
+
+# ----------------------------------------------------------------------------
+# IterDirScan(mp.Path, ScanParam): iter((ScanEvt, Xml(Elt)))
+#   Walk the directory tree in the order of names and yield path elements as
+#   scan events (see 'ScanEvt'). The walk is iterative and keeps only the
+#   listings of the directories on the current branch and the ones read
+#   ahead (see 'ScanRun'), so consumers that don't keep the elements (e.g.
+#   'WriteDirAsXml') use bounded memory. Directories are listed with
+#   'mp.ListDirEntries', so each entry costs at most a single stat; entries
+#   the ScanParam filters out cost none and excluded directories are not
+#   listed.
+
+def IterDirScan(path, scanParam):
+    yield ScanEvtBegin, ProjectStatAttrs(GetPathStatAsXml(path), scanParam)
+    scanRun = MakeScanRun(path, scanParam)
+    try:
+        if scanParam.depth == 0:
+            stack = []
+            yield ScanEvtEnd, None
+        else:
+            stack = [iter(TakeScanDir(scanRun,
+                    MakeScanDir(scanRun.rootStr, "", 1, [])))]
+        while stack:
+            for entry, qName, scanDir in stack[-1]:
+                entryElt = GetEntryStatAsXml(entry, qName, scanParam)
+                if qName is not mxQNameMxDirectory:
+                    yield ScanEvtEntry, entryElt
+                elif scanDir is None:
+                    yield ScanEvtBegin, entryElt
+                    yield ScanEvtEnd, None
+                else:
+                    yield ScanEvtBegin, entryElt
+                    stack.append(iter(TakeScanDir(scanRun, scanDir)))
+                    break
+            else:
+                stack.pop()
+                yield ScanEvtEnd, None
+    finally:
+        DropScanRun(scanRun)
+    if scanParam.snapPathStr is not None:
+        WriteScanSnap(scanParam.snapPathStr, scanRun.snap)
+
+# ----------------------------------------------------------------------------
+# IterScanEntries(ScanRun): iter((mp.DirEntry, QName))
+#   Walk the directory tree of a ScanRun in the order of a scan and yield
+#   the entries that pass the filters with their element names, without
+#   making elements.
+
+def IterScanEntries(scanRun):
+    stack = [iter(TakeScanDir(scanRun,
+            MakeScanDir(scanRun.rootStr, "", 1, [])))]
+    while stack:
+        for entry, qName, scanDir in stack[-1]:
+            yield entry, qName
+            if scanDir is not None:
+                stack.append(iter(TakeScanDir(scanRun, scanDir)))
+                break
+        else:
+            stack.pop()
+
+# ----------------------------------------------------------------------------
+# JoinScanRelStr(str, str): str
+#   Join a relative directory path and a name.
+
+def JoinScanRelStr(dirRelStr, nameStr):
+    return pop.join(dirRelStr, nameStr) if dirRelStr else nameStr
+
+# ----------------------------------------------------------------------------
+# JobsXArg(XArg or None): int
+#   Get the number of threads from the options of an XPath function that
+#   only takes 'jobs=N'; the default is 'ScanJobs'.
+
+def JobsXArg(optsArg):
+    jobs = ScanJobs
+    opts = [] if optsArg is None else mx.GetXArgAsOpts(optsArg)
+    i = 0; n = len(opts)
+    while i < n:
+        nameStr, valStr = opts[i]; i += 1
+        if nameStr != "jobs":
+            raise Exception("Unknown option '%s'" % nameStr)
+        jobs = max(ParseScanCountStr(nameStr, valStr), 1)
+    return jobs
+
+# ----------------------------------------------------------------------------
+# ListDirPage(mp.Path, ScanParam): [mp.DirEntry]
+#   List the entries of a directory that pass the filters of a ScanParam,
+#   sorted, and get the page of them set by 'offset' and 'limit'. With a
+#   limit only 'offset + limit' entries are selected, with a heap, instead
+#   of sorting all of them; entries are statted only if the sort key or the
+#   attributes need it.
+
+def ListDirPage(path, scanParam):
+    pathStr = mp.GetPathStr(path)
+    ignores = ReadScanIgnores(pathStr, "", [], scanParam)
+    entries = mp.ListDirEntries(path)
+    keptEntries = []; i = 0; n = len(entries)
+    while i < n:
+        entry = entries[i]; i += 1
+        if ScanEntryIsKept(scanParam, entry, entry.name, ignores, False):
+            keptEntries.append(entry)
+    keyFunc = ListSortKeys[scanParam.sortStr]
+    if scanParam.limit is None:
+        if keyFunc is not GetEntryNameKey or scanParam.reverse:
+            # The listing is sorted by name already.
+            keptEntries.sort(key=keyFunc, reverse=scanParam.reverse)
+        return keptEntries[scanParam.offset:]
+    count = scanParam.offset + scanParam.limit
+    if scanParam.reverse:
+        keptEntries = phq.nlargest(count, keptEntries, key=keyFunc)
+    else:
+        keptEntries = phq.nsmallest(count, keptEntries, key=keyFunc)
+    return keptEntries[scanParam.offset:]
+
+# ----------------------------------------------------------------------------
+# ListScanDir(ScanRun, ScanDir): [ScanItem]
+#   List a directory, filter and stat its entries. With threads, submit the
+#   subdirectories to be listed next, as long as the ScanRun is not too far
+#   ahead of the walk.
+
+def ListScanDir(scanRun, scanDir):
+    scanParam = scanRun.scanParam
+    ignores = ReadScanIgnores(scanDir.pathStr, scanDir.relStr,
+            scanDir.ignores, scanParam)
+    entries = ListScanDirEntries(scanRun, scanDir)
+    needsStat = scanParam.needsStat or scanDir.snapDir is not None
+    scanItems = []; subdirs = []
+    i = 0; n = len(entries)
+    while i < n:
+        entry = entries[i]; i += 1
+        relStr = GetScanRelStr(scanRun.rootStr, entry.path)
+        if not ScanEntryIsKept(scanParam, entry, relStr, ignores, True):
+            continue
+        # This reads the stat, if needed; the entry keeps it for the walk.
+        qName = GetEntryQName(entry, needsStat)
+        if scanDir.snapDir is not None:
+            scanDir.snapDir[3][entry.name] = GetScanFprint(entry, qName)
+        subdir = None
+        if qName is mxQNameMxDirectory and (scanParam.depth is None
+                or scanDir.depth < scanParam.depth):
+            subdir = MakeScanDir(entry.path, relStr, scanDir.depth + 1,
+                    ignores)
+            subdirs.append(subdir)
+        scanItems.append((entry, qName, subdir))
+    if scanRun.pool is not None:
+        i = 0; n = len(subdirs)
+        while i < n and SubmitScanDir(scanRun, subdirs[i], False):
+            i += 1
+    return scanItems
+
+# ----------------------------------------------------------------------------
+# ListScanDirEntries(ScanRun, ScanDir): [mp.DirEntry]
+#   List the entries of a ScanDir, sorted by name. If the ScanRun records a
+#   ScanSnap or compares with one, make the ScanSnapDir too (and stat the
+#   entries, see 'ListScanDir'). If the base
+#   ScanSnap has the directory with the same mtime and inode, the names come
+#   from there; but not if the mtime is too close to the time of the base,
+#   see 'ScanSnapRacyTime'.
+
+def ListScanDirEntries(scanRun, scanDir):
+    if scanRun.snap is None and scanRun.baseSnap is None:
+        return mp.ListDirEntries(mp.MakePath(scanDir.pathStr))
+    poStat = mp.GetPathStat(mp.MakePath(scanDir.pathStr)).poStat
+    baseSnapDir = None
+    if scanRun.baseSnap is not None and poStat is not None:
+        baseSnapDir = scanRun.baseSnap.dirs.get(scanDir.relStr)
+    if baseSnapDir is not None and baseSnapDir[0] == poStat.st_mtime \
+            and baseSnapDir[1] == poStat.st_ino \
+            and poStat.st_mtime < scanRun.baseSnap.time - ScanSnapRacyTime:
+        nameStrs = baseSnapDir[2]
+        md.RecordDirDep(scanDir.pathStr, nameStrs)
+        entries = []; i = 0; n = len(nameStrs)
+        while i < n:
+            entries.append(mc.MakeListedDirEntry(scanDir.pathStr,
+                    nameStrs[i])); i += 1
+    else:
+        entries = mp.ListDirEntries(mp.MakePath(scanDir.pathStr))
+        nameStrs = []; i = 0; n = len(entries)
+        while i < n:
+            nameStrs.append(entries[i].name); i += 1
+    if poStat is None:
+        scanDir.snapDir = (0.0, 0, nameStrs, {})
+    else:
+        scanDir.snapDir = (poStat.st_mtime, poStat.st_ino, nameStrs, {})
+    return entries
+
+# ----------------------------------------------------------------------------
+# MakeDuAgg(str, float): DuAgg
+#   Make an empty DuAgg of a directory with its element.
+
+def MakeDuAgg(pathStr, mtime):
+    duAgg = DuAgg()
+    duAgg.size = 0
+    duAgg.files = 0
+    duAgg.dirs = 0
+    duAgg.mtime = mtime
+    duAgg.exts = {}
+    duAgg.elt = mx.MakeElt(mxQNameMxDiskUsage)
+    mx.SetAttr(duAgg.elt, mxQNamePath, pathStr)
+    return duAgg
+
+# ----------------------------------------------------------------------------
+# MakeScanDir(str, str, int, [ScanIgnore]): ScanDir
+#   Make a ScanDir.
+
+def MakeScanDir(pathStr, relStr, depth, ignores):
+    scanDir = ScanDir()
+    scanDir.pathStr = pathStr
+    scanDir.relStr = relStr
+    scanDir.depth = depth
+    scanDir.ignores = ignores
+    scanDir.result = None
+    scanDir.snapDir = None
+    return scanDir
+
+# ----------------------------------------------------------------------------
+# MakeScanParam(): ScanParam
+#   Make a ScanParam that outputs everything, as before there were options.
+
+def MakeScanParam():
+    scanParam = ScanParam()
+    scanParam.depth = None
+    scanParam.includes = []
+    scanParam.excludes = []
+    scanParam.types = set(ScanTypeNames)
+    scanParam.ignoreFileNameStr = None
+    scanParam.attrs = set(ScanAttrNames)
+    scanParam.needsStat = True
+    scanParam.jobs = ScanJobs
+    scanParam.snapPathStr = None
+    scanParam.sortStr = "name"
+    scanParam.reverse = False
+    scanParam.offset = 0
+    scanParam.limit = None
+    return scanParam
+
+# ----------------------------------------------------------------------------
+# MakeScanRun(mp.Path, ScanParam): ScanRun
+#   Make a ScanRun; start the threads, if there is more than one job.
+
+def MakeScanRun(path, scanParam):
+    scanRun = ScanRun()
+    scanRun.scanParam = scanParam
+    scanRun.rootStr = mp.GetPathStr(path)
+    if scanParam.jobs > 1:
+        scanRun.pool = pmp.ThreadPool(scanParam.jobs)
+    else:
+        scanRun.pool = None
+    scanRun.lock = pth.Lock()
+    scanRun.ahead = 0
+    scanRun.maxAhead = scanParam.jobs * ScanAheadPerJob
+    if scanParam.snapPathStr is not None:
+        scanRun.snap = MakeScanSnap(GetScanFilterKey(scanParam))
+    else:
+        scanRun.snap = None
+    scanRun.baseSnap = None
+    return scanRun
+
+# ----------------------------------------------------------------------------
+# MakeScanSnap(tuple): ScanSnap
+#   Make an empty ScanSnap of a scan with the filters that begins now.
+
+def MakeScanSnap(filterKey):
+    snap = ScanSnap()
+    snap.time = pti.time()
+    snap.filterKey = filterKey
+    snap.dirs = {}
+    return snap
+
+# ----------------------------------------------------------------------------
+# ParseScanCountStr(str, str): int
+#   Parse the value of a scan option that is a number, not negative.
+
+def ParseScanCountStr(nameStr, valStr):
+    try:
+        count = int(valStr)
+    except (TypeError, ValueError):
+        count = -1
+    if count < 0:
+        raise Exception("Expected a number in '%s': '%s'" % (nameStr, valStr))
+    return count
+
+# ----------------------------------------------------------------------------
+# PathStrsXArg(XArg): [str]
+#   Get paths from an argument of an XPath function: the string values of
+#   the nodes of a node-set, or a single string.
+
+def PathStrsXArg(pathsArg):
+    if not isinstance(pathsArg, list):
+        return [mx.GetXArgAsStr(pathsArg)]
+    pathStrs = []; i = 0; n = len(pathsArg)
+    while i < n:
+        pathStrs.append(mx.GetXArgAsStr([pathsArg[i]])); i += 1
+    return pathStrs
+
+# ----------------------------------------------------------------------------
+# ProjectStatAttrs(Xml(Elt), ScanParam): Xml(Elt)
+#   Remove the attributes the ScanParam does not want from a path element.
+
+def ProjectStatAttrs(pathElt, scanParam):
+    i = 0; n = len(ScanAttrNames)
+    while i < n:
+        nameStr = ScanAttrNames[i]; i += 1
+        if nameStr not in scanParam.attrs:
+            mx.DelAttr(pathElt, ScanAttrQNames[nameStr])
+    return pathElt
+
+# ----------------------------------------------------------------------------
+# ReadFileHashes()
+#   Read 'FileHashes' from the cache directory, once in a process.
+
+def ReadFileHashes():
+    global FileHashes
+    with FileHashLock:
+        if FileHashes is None:
+            state = mca.ReadCacheFile(FileHashCacheNameStr)
+            if state is not None and state[0] == FileHashFormat:
+                FileHashes = state[1]
+            else:
+                FileHashes = {}
+
+# ----------------------------------------------------------------------------
+# ReadScanIgnores(str, str, [ScanIgnore], ScanParam): [ScanIgnore]
+#   Add the rules of the ignore file in a directory, if there is one, to the
+#   rules of its parents. The syntax is a subset of '.gitignore': blank lines
+#   and '#' comments are skipped; '!' negates a rule; a trailing '/' makes
+#   it match directories only; a pattern with a slash, other than a
+#   trailing one or a leading '**/', matches the path relative to the
+#   directory of the file, else the name; the globs are those of
+#   'CompileScanPattern'. The last matching rule wins.
+
+def ReadScanIgnores(dirPathStr, dirRelStr, ignores, scanParam):
+    if scanParam.ignoreFileNameStr is None:
+        return ignores
+    path = mp.MakePath(pop.join(dirPathStr, scanParam.ignoreFileNameStr))
+    if not mp.PathIsFile(path):
+        return ignores
+    strm = ms.MakeIStrmFromPath(path)
+    try:
+        text = ms.ReadText(strm, "utf-8")
+    finally:
+        ms.DropStrm(strm)
+    ignores = list(ignores)
+    lineStrs = text.splitlines(); i = 0; n = len(lineStrs)
+    while i < n:
+        lineStr = lineStrs[i].rstrip(); i += 1
+        if not lineStr or lineStr.startswith("#"):
+            continue
+        negated = lineStr.startswith("!")
+        if negated:
+            lineStr = lineStr[1:]
+        dirOnly = lineStr.endswith("/")
+        lineStr = lineStr.rstrip("/")
+        if lineStr.startswith("**/"):
+            lineStr = lineStr[3:]
+        anchored = "/" in lineStr
+        ignores.append((dirRelStr, negated, dirOnly, anchored,
+                CompileScanPattern(lineStr.lstrip("/"))))
+    return ignores
+
+# ----------------------------------------------------------------------------
+# ReadScanSnap(mp.Path): ScanSnap
+#   Read a ScanSnap written by 'WriteScanSnap'.
+
+def ReadScanSnap(path):
+    strm = ms.MakeIStrmFromPath(path)
+    try:
+        data = ms.ReadStrm(strm)
+    finally:
+        ms.DropStrm(strm)
+    try:
+        state = pkl.loads(data)
+    except Exception:
+        state = None
+    if not isinstance(state, tuple) or len(state) != 5 \
+            or state[0] != ScanSnapMagicStr or state[1] != ScanSnapFormat:
+        raise Exception("Expected a scan snapshot in '%s'"
+                % mp.GetPathStr(path))
+    snap = ScanSnap()
+    _, _, snap.time, snap.filterKey, snap.dirs = state
+    return snap
+
+# ----------------------------------------------------------------------------
+# ScanDirAsXml(mp.Path, ScanParam): le.Element
 #   Read the directory tree as XML.
 #
 #   <maxe:directory path name ctime mtime>...</maxe:directory>
 
-def ScanDirAsXml(path):
-    dirElt = GetPathStatAsXml(path)
-    ScanDirEltAsXml(path, dirElt)
+def ScanDirAsXml(path, scanParam):
+    dirElt = None; dirElts = []
+    for scanEvt, elt in IterDirScan(path, scanParam):
+        if scanEvt == ScanEvtBegin:
+            if dirElts:
+                mx.AppendElt(dirElts[-1], elt)
+            else:
+                dirElt = elt
+            dirElts.append(elt)
+        elif scanEvt == ScanEvtEnd:
+            dirElts.pop()
+        else: # ScanEvtEntry
+            mx.AppendElt(dirElts[-1], elt)
     return dirElt
 
 # ----------------------------------------------------------------------------
-# ScanDirEltAsXml(mp.Path, le.Element)
-#   Read the directory tree as XML, actual worker.
+# ScanEntryIsKept(ScanParam, mp.DirEntry, str, [ScanIgnore], bool): bool
+#   Test if a directory entry passes the filters of a ScanParam; 'relStr' is
+#   its path relative to the scanned directory. In a scan directories are
+#   kept whatever their type, since they hold the tree.
+
+def ScanEntryIsKept(scanParam, entry, relStr, ignores, inScan):
+    isDir = entry.is_dir()
+    nameStr = entry.name
+    i = 0; n = len(scanParam.excludes)
+    while i < n:
+        anchored, pattern = scanParam.excludes[i]; i += 1
+        if pattern.match(relStr if anchored else nameStr):
+            return False
+    ignored = False; i = 0; n = len(ignores)
+    while i < n:
+        baseStr, negated, dirOnly, anchored, pattern = ignores[i]; i += 1
+        if dirOnly and not isDir:
+            continue
+        if anchored:
+            subjectStr = relStr[len(baseStr) + 1:] if baseStr else relStr
+        else:
+            subjectStr = nameStr
+        if pattern.match(subjectStr):
+            ignored = not negated
+    if ignored:
+        return False
+    if isDir:
+        return inScan or "dir" in scanParam.types
+    if scanParam.includes:
+        i = 0; n = len(scanParam.includes)
+        while i < n:
+            anchored, pattern = scanParam.includes[i]; i += 1
+            if pattern.match(relStr if anchored else nameStr):
+                break
+        else:
+            return False
+    if entry.is_file():
+        return "file" in scanParam.types
+    return "other" in scanParam.types
+
+# ----------------------------------------------------------------------------
+# ScanParamXArg(XArg or None): ScanParam
+#   Get a ScanParam from the options of an XPath function, see
+#   'mx.GetXArgAsOpts' and 'SetScanParamOpt'.
+
+def ScanParamXArg(xArg):
+    scanParam = MakeScanParam()
+    if xArg is not None:
+        opts = mx.GetXArgAsOpts(xArg); i = 0; n = len(opts)
+        while i < n:
+            nameStr, valStr = opts[i]; i += 1
+            SetScanParamOpt(scanParam, nameStr, valStr)
+    return scanParam
+
+# ----------------------------------------------------------------------------
+# SetScanParamOpt(ScanParam, str, str)
+#   Set a ScanParam option by name:
+#
+#     depth=N: walk N levels deep; 0 is only the directory itself.
+#     include=GLOB,...: output only files and other entries that match.
+#     exclude=GLOB,...: skip matching entries; directories are not walked.
+#     type=TYPE,...: output only 'file', 'dir', or 'other' entries.
+#     ignore-file=NAME: read '.gitignore'-style rules from files NAME.
+#     attrs=NAME,...: output only these attributes besides 'path': 'name',
+#       'ctime', 'mtime', 'atime', 'size', 'stem', 'ext'. Without 'ctime',
+#       'mtime', 'atime', and 'size' entries are not statted.
+#     jobs=N: list and stat up to N directories at once; the default is
+#       'ScanJobs'.
+#     snapshot=PATH: write a snapshot of the walked tree to PATH for
+#       'mext:changed-since'; entries are statted.
+#
+#   Options of 'mext:list-directory' only:
+#
+#     sort=KEY: sort by 'name' (the default), 'natural' name, 'mtime', or
+#       'size'; ties are sorted by name.
+#     order=ORDER: 'ascending' (the default) or 'descending'.
+#     offset=N: skip the first N entries.
+#     limit=N: output at most N entries; e.g. 'sort=mtime order=descending
+#       limit=20' gets the 20 newest entries without sorting the rest.
+
+def SetScanParamOpt(scanParam, nameStr, valStr):
+    itemStrs = [itemStr for itemStr in (valStr or "").split(",") if itemStr]
+    if nameStr == "depth":
+        scanParam.depth = ParseScanCountStr(nameStr, valStr)
+    elif nameStr == "include" or nameStr == "exclude":
+        patterns = scanParam.includes if nameStr == "include" \
+                else scanParam.excludes
+        i = 0; n = len(itemStrs)
+        while i < n:
+            patternStr = itemStrs[i]; i += 1
+            patterns.append(("/" in patternStr,
+                    CompileScanPattern(patternStr)))
+    elif nameStr == "type":
+        if not set(itemStrs) <= set(ScanTypeNames):
+            raise Exception("Unknown entry type in 'type': '%s'" % valStr)
+        scanParam.types = set(itemStrs)
+    elif nameStr == "ignore-file":
+        scanParam.ignoreFileNameStr = valStr or None
+    elif nameStr == "attrs":
+        if not set(itemStrs) <= set(ScanAttrNames):
+            raise Exception("Unknown attribute in 'attrs': '%s'" % valStr)
+        scanParam.attrs = set(itemStrs)
+        scanParam.needsStat = bool(scanParam.attrs & set(ScanStatAttrNames))
+    elif nameStr == "jobs":
+        scanParam.jobs = max(ParseScanCountStr(nameStr, valStr), 1)
+    elif nameStr == "snapshot":
+        scanParam.snapPathStr = valStr or None
+    elif nameStr == "sort":
+        if valStr not in ListSortKeys:
+            raise Exception("Unknown sort key in 'sort': '%s'" % valStr)
+        scanParam.sortStr = valStr
+    elif nameStr == "order":
+        if valStr != "ascending" and valStr != "descending":
+            raise Exception("Expected 'ascending' or 'descending' in "
+                    "'order': '%s'" % valStr)
+        scanParam.reverse = valStr == "descending"
+    elif nameStr == "offset":
+        scanParam.offset = ParseScanCountStr(nameStr, valStr)
+    elif nameStr == "limit":
+        scanParam.limit = ParseScanCountStr(nameStr, valStr)
+    else:
+        raise Exception("Unknown scan option '%s'" % nameStr)
+
+# ----------------------------------------------------------------------------
+# SetScanJobs(int)
+#   Set the default number of scan jobs, see 'ScanJobs'.
+
+def SetScanJobs(jobs):
+    global ScanJobs
+    ScanJobs = max(jobs, 1)
+
+# ----------------------------------------------------------------------------
+# StatPathsAsXml([str], int): [Xml(Elt)]
+#   Get stats of paths as XML, as 'GetPathStatAsXml' does, in the same
+#   order. Each distinct path is statted once, by up to 'jobs' threads; the
+#   elements are made after that, one for each path given.
+
+def StatPathsAsXml(pathStrs, jobs):
+    pathsByStr = {}; paths = []; i = 0; n = len(pathStrs)
+    while i < n:
+        pathStr = pathStrs[i]; i += 1
+        if pathStr not in pathsByStr:
+            pathsByStr[pathStr] = mp.MakePath(pathStr)
+            paths.append(pathsByStr[pathStr])
+    if jobs > 1 and len(paths) > 1:
+        jobs = min(jobs, len(paths))
+        pool = pmp.ThreadPool(jobs)
+        try:
+            # Each thread takes paths in batches: the stats are short.
+            pool.map(mp.GetPathStat, paths,
+                    max(len(paths) // (jobs * 4), 1))
+        finally:
+            pool.terminate()
+            pool.join()
+    result = []; i = 0
+    while i < n:
+        result.append(GetPathStatAsXml(pathsByStr[pathStrs[i]])); i += 1
+    return result
+
+# ----------------------------------------------------------------------------
+# SubmitScanDir(ScanRun, ScanDir, bool): bool
+#   Submit a ScanDir to be listed by a thread; if not 'force', only if the
+#   ScanRun is not too far ahead. Get whether it's submitted, now or before.
+
+def SubmitScanDir(scanRun, scanDir, force):
+    with scanRun.lock:
+        if scanDir.result is None:
+            if not force and scanRun.ahead >= scanRun.maxAhead:
+                return False
+            scanRun.ahead += 1
+            scanDir.result = scanRun.pool.apply_async(ListScanDir,
+                    (scanRun, scanDir))
+    return True
+
+# ----------------------------------------------------------------------------
+# TakeScanDir(ScanRun, ScanDir): [ScanItem]
+#   Get the listing of a ScanDir for the walk: list it now or wait for the
+#   thread that lists it. Errors of the thread are raised here. Add the
+#   ScanSnapDir to the ScanSnap of the ScanRun, if it records one.
+
+def TakeScanDir(scanRun, scanDir):
+    if scanRun.pool is None:
+        scanItems = ListScanDir(scanRun, scanDir)
+    else:
+        SubmitScanDir(scanRun, scanDir, True)
+        scanItems = scanDir.result.get()
+        with scanRun.lock:
+            scanRun.ahead -= 1
+            scanDir.result = None
+    if scanRun.snap is not None:
+        scanRun.snap.dirs[scanDir.relStr] = scanDir.snapDir
+    return scanItems
+
+# ----------------------------------------------------------------------------
+# WriteDirAsXml(ms.Strm, mp.Path, ScanParam, mx.SCfg)
+#   Write the directory tree as XML to a stream while it is being scanned.
+#   The output is the same as of 'ScanDirAsXml', but starts immediately and
+#   the tree is never kept in memory.
 
-def ScanDirEltAsXml(path, pathElt):
-    for name in mp.ListDir(path):
-        subpath = mp.MakeSubpath(path, name)
-        subpathElt = GetPathStatAsXml(subpath)
-        if mp.PathIsDir(subpath):
-            ScanDirEltAsXml(subpath, subpathElt)
-        mx.AppendElt(pathElt, subpathElt)
+def WriteDirAsXml(strm, path, scanParam, sCfg):
+    writer = mx.MakeXmlWriter(strm, sCfg)
+    try:
+        for scanEvt, elt in IterDirScan(path, scanParam):
+            if scanEvt == ScanEvtBegin:
+                mx.BeginXmlWriterElt(writer, elt)
+            elif scanEvt == ScanEvtEnd:
+                mx.EndXmlWriterElt(writer)
+            else: # ScanEvtEntry
+                mx.WriteXmlWriterElt(writer, elt)
+    finally:
+        mx.DropXmlWriter(writer)
         
+# ----------------------------------------------------------------------------
+# WriteFileHashes()
+#   Save 'FileHashes' to the cache directory if new digests were added and
+#   drop the digests of paths that no longer exist. 'mext:file-hash' only
+#   marks the digests as not saved, so that a run with many calls pickles
+#   them once; the command line calls this at the end of a run.
+
+def WriteFileHashes():
+    global FileHashesDirty
+    with FileHashLock:
+        if FileHashesDirty:
+            for key in list(FileHashes):
+                if not pop.exists(key[0]):
+                    del FileHashes[key]
+            mca.WriteCacheFile(FileHashCacheNameStr,
+                    (FileHashFormat, FileHashes))
+            FileHashesDirty = False
+
+# ----------------------------------------------------------------------------
+# WriteScanSnap(str, ScanSnap)
+#   Write a ScanSnap to a file, pickled; the file is replaced at once, so
+#   a failed scan leaves the old one.
+
+def WriteScanSnap(pathStr, snap):
+    tmpPathStr = "%s.%d.tmp" % (pathStr, po.getpid())
+    strm = ms.MakeOStrmFromPath(mp.MakePath(tmpPathStr))
+    try:
+        ms.WriteStrm(strm, pkl.dumps((ScanSnapMagicStr, ScanSnapFormat,
+                snap.time, snap.filterKey, snap.dirs), 2))
+    finally:
+        ms.DropStrm(strm)
+    if po.name == "nt" and pop.exists(pathStr):
+        po.remove(pathStr)
+    po.rename(tmpPathStr, pathStr)
+
 # Extensions =================================================================
 
+# ----------------------------------------------------------------------------
+# XChangedSince(_, pathArg, snapArg, optsArg?): le._Element
+#   XPath function to find what changed in a directory tree since a scan,
+#   see 'GetDirChangesAsXml'.
+#
+#   path: path, string or element.
+#   snap: path of the snapshot, written by 'mext:scan-directory' or
+#     'mext:changed-since' with the 'snapshot' option.
+#   opts: scan options, see 'SetScanParamOpt'; the filters must be the same
+#     as when the snapshot was written, else it's an error. With 'snapshot'
+#     a new snapshot is written, e.g. over the old one for the next run.
+
+def XChangedSince(_, pathArg, snapArg, optsArg=None):
+    try:
+        pathStr = mx.GetXArgAsStr(pathArg)
+        snapPathStr = mx.GetXArgAsStr(snapArg)
+        scanParam = ScanParamXArg(optsArg)
+        baseSnap = ReadScanSnap(mp.MakePath(snapPathStr))
+        result = GetDirChangesAsXml(mp.MakePath(pathStr), baseSnap,
+                scanParam)
+    except Exception as exc:
+        result = mm.GetExcAsXml(exc)
+    return result
+
+# ---------------------------------------------------------------------------
+# XDiskUsage(_, pathArg, depthArg?, optsArg?): le._Element
+#   XPath function to get the totals of a directory tree, see
+#   'GetDiskUsageAsXml'.
+#
+#   path: path, string or element.
+#   depth: how deep to break the totals down by directory; 0, the default,
+#     is only the totals of the whole tree.
+#   opts: scan options, see 'SetScanParamOpt'; e.g. 'exclude=.git jobs=8'.
+#     'depth' here limits the walk, not the breakdown.
+
+def XDiskUsage(_, pathArg, depthArg=None, optsArg=None):
+    try:
+        pathStr = mx.GetXArgAsStr(pathArg)
+        depth = 0 if depthArg is None else mx.GetXArgAsInt(depthArg)
+        result = GetDiskUsageAsXml(mp.MakePath(pathStr), depth,
+                ScanParamXArg(optsArg))
+    except Exception as exc:
+        result = mm.GetExcAsXml(exc)
+    return result
+
+# ---------------------------------------------------------------------------
+# XFileHash(_, pathsArg, algoArg?, optsArg?): [le._Element]
+#   XPath function to get digests of files, e.g. to fingerprint assets,
+#   see 'HashFilesAsXml'.
+#
+#   paths: node-set of paths (attributes, text, or elements), or a string.
+#   algo: the 'hashlib' algorithm, 'sha1' by default.
+#   opts: 'jobs=N', the number of threads; the default is 'ScanJobs'.
+
+def XFileHash(_, pathsArg, algoArg=None, optsArg=None):
+    try:
+        pathStrs = PathStrsXArg(pathsArg)
+        algoStr = "sha1" if algoArg is None else mx.GetXArgAsStr(algoArg)
+        result = HashFilesAsXml(pathStrs, algoStr, JobsXArg(optsArg))
+    except Exception as exc:
+        result = mm.GetExcAsXml(exc)
+    return result
+
+# ---------------------------------------------------------------------------
+# XFindDuplicates(_, pathArg, optsArg?): le._Element
+#   XPath function to find files with the same data in a directory tree,
+#   see 'FindDupsAsXml'.
+#
+#   path: path, string or element.
+#   opts: scan options, see 'SetScanParamOpt', and:
+#     min-size=N: skip files smaller than N bytes; the default is 1, so
+#       empty files are skipped.
+#     algo=NAME: the 'hashlib' algorithm, 'sha1' by default.
+
+def XFindDuplicates(_, pathArg, optsArg=None):
+    try:
+        pathStr = mx.GetXArgAsStr(pathArg)
+        scanParam = MakeScanParam(); minSize = 1; algoStr = "sha1"
+        opts = [] if optsArg is None else mx.GetXArgAsOpts(optsArg)
+        i = 0; n = len(opts)
+        while i < n:
+            nameStr, valStr = opts[i]; i += 1
+            if nameStr == "min-size":
+                minSize = ParseScanCountStr(nameStr, valStr)
+            elif nameStr == "algo":
+                algoStr = valStr
+            else:
+                SetScanParamOpt(scanParam, nameStr, valStr)
+        result = FindDupsAsXml(mp.MakePath(pathStr), scanParam, minSize,
+                algoStr)
+    except Exception as exc:
+        result = mm.GetExcAsXml(exc)
+    return result
+
 # ----------------------------------------------------------------------------
 # XGetPathStat(_, path): Xml(Elt)
 #   XPath function to get stats of a path. 
@@ -104,70 +1613,234 @@ def XGetPathStat(_, pathArg):
         result = mm.GetExcAsXml(exc)
     return result
 
+# ----------------------------------------------------------------------------
+# XGetStatCacheStats(_): Xml(Elt)
+#   XPath function to get the shared stat cache counters (see 'mp.StatCache').
+#
+#       <maxe:stat-cache hits misses size>
+
+def XGetStatCacheStats(_):
+    try:
+        hits, misses, size = mp.GetStatCacheCounts()
+        result = mx.MakeElt(mxQNameMxStatCache)
+        mx.SetAttr(result, mxQNameHits, str(hits))
+        mx.SetAttr(result, mxQNameMisses, str(misses))
+        mx.SetAttr(result, mxQNameSize, str(size))
+    except Exception as exc:
+        result = mm.GetExcAsXml(exc)
+    return result
+
+# ----------------------------------------------------------------------------
+# XInvalidatePathStat(_, path): [Xml(Elt)]
+#   XPath function to drop the cached stat of a path; use it after the path
+#   was changed to get its current stat. Returns an empty node set.
+#
+#   path: path, string or element.
+
+def XInvalidatePathStat(_, pathArg):
+    try:
+        mp.InvalidatePathStat(mp.MakePath(mx.GetXArgAsStr(pathArg)))
+        result = []
+    except Exception as exc:
+        result = mm.GetExcAsXml(exc)
+    return result
+
 # ---------------------------------------------------------------------------
-# XListDirectory(_, pathArg): [le._Element]
+# XListDirectory(_, pathArg, optsArg?): [le._Element]
 #   XPath function to list a directory.
 #
 #   path: path, string or element.
+#   opts: scan options, see 'SetScanParamOpt'; 'depth' does not apply.
+#
+#   Elements are made only for the entries of the requested page, see
+#   'ListDirPage'.
 
-def XListDirectory(_, pathArg):
+def XListDirectory(_, pathArg, optsArg=None):
     try:
         pathStr = mx.GetXArgAsStr(pathArg)
-        path = mp.MakePath(pathStr)
-        result = []
-        for name in mp.ListDir(path):
-            result.append(GetPathStatAsXml(mp.MakeSubpath(path, name)))
+        scanParam = ScanParamXArg(optsArg)
+        entries = ListDirPage(mp.MakePath(pathStr), scanParam)
+        result = []; i = 0; n = len(entries)
+        while i < n:
+            entry = entries[i]; i += 1
+            result.append(GetEntryStatAsXml(entry,
+                    GetEntryQName(entry, scanParam.needsStat), scanParam))
     except Exception as exc:
         result = mm.GetExcAsXml(exc)
     return result
 
 # ---------------------------------------------------------------------------
-# XScanDirectory(_, pathArg): le._Element
+# XScanDirectory(_, pathArg, optsArg?): le._Element
 #   XPath function to get a directory tree.
 #
 #   path: path, string or element.
+#   opts: scan options, see 'SetScanParamOpt', e.g. 'depth=2
+#     exclude=.git,node_modules attrs=name,mtime'.
 
-def XScanDirectory(leCtx, pathArg):
+def XScanDirectory(leCtx, pathArg, optsArg=None):
     try:
         pathStr = mx.GetXArgAsStr(pathArg)
-        result = ScanDirAsXml(mp.MakePath(pathStr))
+        result = ScanDirAsXml(mp.MakePath(pathStr), ScanParamXArg(optsArg))
+    except Exception as exc:
+        result = mm.GetExcAsXml(exc)
+    return result
+
+# ---------------------------------------------------------------------------
+# XStatMany(_, pathsArg, optsArg?): [le._Element]
+#   XPath function to get stats of many paths at once, in the order of the
+#   paths, see 'StatPathsAsXml'; same as 'mext:get-path-stat' for each, but
+#   with a single call and the stats read by several threads.
+#
+#   paths: node-set of paths (attributes, text, or elements), or a string.
+#   opts: 'jobs=N', the number of threads; the default is 'ScanJobs'.
+
+def XStatMany(_, pathsArg, optsArg=None):
+    try:
+        result = StatPathsAsXml(PathStrsXArg(pathsArg), JobsXArg(optsArg))
     except Exception as exc:
         result = mm.GetExcAsXml(exc)
     return result
 
 # CODE =======================================================================
 
+import heapq     as phq # nlargest, nsmallest
+import multiprocessing.pool as pmp # ThreadPool
+import os        as po  # getpid, name, remove, rename
+import os.path   as pop # exists, join, sep, splitext
 import pdb       as pd; pd = pd # debugger
+import pickle    as pkl # dumps, loads
+import re        as pre # compile, escape
+import stat      as pst # S_ISDIR
+import threading as pth # Lock
+import time      as pti # time
 
-import maxe.msg  as mm
-import maxe.path as mp
-import maxe.xml  as mx
+import maxe.cache  as mca
+import maxe.compat as mc
+import maxe.dep    as md
+import maxe.msg    as mm
+import maxe.path   as mp
+import maxe.strm   as ms
+import maxe.xml    as mx
 
 # mxNs and QNames.
 
 mxNs   = mx.GetNs("")
 mxNsMx = mx.GetNs("urn:onegasoft:Maxe")
 
+mxQNameMxChanges         = mx.GetQName(mxNsMx, "changes"          )
 mxQNameMxDirectory       = mx.GetQName(mxNsMx, "directory"        )
+mxQNameMxDiskUsage       = mx.GetQName(mxNsMx, "disk-usage"       )
+mxQNameMxDuplicateGroup  = mx.GetQName(mxNsMx, "duplicate-group"  )
+mxQNameMxDuplicates      = mx.GetQName(mxNsMx, "duplicates"       )
+mxQNameMxExtension       = mx.GetQName(mxNsMx, "extension"        )
 mxQNameMxFile            = mx.GetQName(mxNsMx, "file"             )
 mxQNameMxPath            = mx.GetQName(mxNsMx, "path"             )
+mxQNameMxStatCache       = mx.GetQName(mxNsMx, "stat-cache"       )
 mxQNameMxUnknownPathType = mx.GetQName(mxNsMx, "unknown-path-type")
 
 mxQNameAtime             = mx.GetQName(mxNs  , "atime"            )
+mxQNameChange            = mx.GetQName(mxNs  , "change"           )
 mxQNameCtime             = mx.GetQName(mxNs  , "ctime"            )
+mxQNameDirectories       = mx.GetQName(mxNs  , "directories"      )
 mxQNameExt               = mx.GetQName(mxNs  , "ext"              )
+mxQNameFiles             = mx.GetQName(mxNs  , "files"            )
+mxQNameGroups            = mx.GetQName(mxNs  , "groups"           )
+mxQNameHash              = mx.GetQName(mxNs  , "hash"             )
+mxQNameHits              = mx.GetQName(mxNs  , "hits"             )
 mxQNameMessage           = mx.GetQName(mxNs  , "message"          )
+mxQNameMisses            = mx.GetQName(mxNs  , "misses"           )
 mxQNameMtime             = mx.GetQName(mxNs  , "mtime"            )
 mxQNameName              = mx.GetQName(mxNs  , "name"             )
 mxQNamePath              = mx.GetQName(mxNs  , "path"             )
 mxQNameSize              = mx.GetQName(mxNs  , "size"             )
 mxQNameStem              = mx.GetQName(mxNs  , "stem"             )
+mxQNameWasted            = mx.GetQName(mxNs  , "wasted"           )
 mxQNameType              = mx.GetQName(mxNs  , "type"             )
 
+# ScanAttrNames: the attributes of path elements besides 'path', in the
+# order they are output; ScanAttrQNames: their QNames by name;
+# ScanStatAttrNames: the ones that need a stat.
+
+ScanAttrNames = "name", "ctime", "mtime", "atime", "size", "stem", "ext"
+ScanAttrQNames = {
+    "name" : mxQNameName,
+    "ctime": mxQNameCtime,
+    "mtime": mxQNameMtime,
+    "atime": mxQNameAtime,
+    "size" : mxQNameSize,
+    "stem" : mxQNameStem,
+    "ext"  : mxQNameExt}
+ScanStatAttrNames = "ctime", "mtime", "atime", "size"
+
+# ScanTypeNames: entry types for the 'type' scan option.
+
+ScanTypeNames = "file", "dir", "other"
+
+# ScanJobs: the default number of directories a scan lists at once; see
+# 'SetScanJobs'. ScanAheadPerJob: how many listings a scan may read ahead
+# per job.
+
+ScanJobs = 1
+ScanAheadPerJob = 64
+
+# ScanSnapMagicStr, ScanSnapFormat: the marker and the version of ScanSnap
+# files. ScanSnapRacyTime: directories modified less than this many seconds
+# before a ScanSnap began are listed again: a change in the same tick of the
+# clock would keep the mtime.
+
+ScanSnapMagicStr = "maxe-scan-snapshot"
+ScanSnapFormat = 2
+ScanSnapRacyTime = 2.0
+
+# FileHashes: digests of files by stat cache key and algorithm, with the
+# size, mtime, and inode of the file when it was hashed, {(str, str):
+# ((int, float, int), str)}; None until read, see 'ReadFileHashes'.
+# FileHashesDirty: whether 'FileHashes' has digests that are not saved.
+# FileHashLock: guards both, pth.Lock. FileHashCacheNameStr,
+# FileHashFormat: the cache file and the version of its format.
+# FileHashRacyTime: see 'GetFileHash'.
+
+FileHashes = None
+FileHashesDirty = False
+FileHashLock = pth.Lock()
+FileHashCacheNameStr = "file-hash.pickle"
+FileHashFormat = 1
+FileHashRacyTime = 2.0
+
+# DupHeadSize: how many bytes of a file 'FindDupsAsXml' compares first.
+
+DupHeadSize = 64 << 10
+
+# ListSortKeys: key functions for the 'sort' option by name.
+
+ListSortKeys = {
+    "name"   : GetEntryNameKey,
+    "natural": GetEntryNaturalKey,
+    "mtime"  : GetEntryMtimeKey,
+    "size"   : GetEntrySizeKey}
+
+# ScanNumRe: numbers in names, for 'GetEntryNaturalKey'.
+
+ScanNumRe = pre.compile(r"([0-9]+)")
+
+# ScanTypeQNames: element names of ScanFprint types.
+
+ScanTypeQNames = {
+    "file" : mxQNameMxFile,
+    "dir"  : mxQNameMxDirectory,
+    "other": mxQNameMxUnknownPathType}
+
 # Register extensions.
 
 mx.RegExts("urn:onegasoft:Maxe/Ext",
-    "get-path-stat" , mx.ExtFunc, XGetPathStat  ,
-    "list-directory", mx.ExtFunc, XListDirectory,
-    "scan-directory", mx.ExtFunc, XScanDirectory)
+    "changed-since"       , mx.ExtFunc    , XChangedSince      ,
+    "disk-usage"          , mx.ExtFunc    , XDiskUsage         ,
+    "file-hash"           , mx.ExtFunc    , XFileHash          ,
+    "find-duplicates"     , mx.ExtFunc    , XFindDuplicates    ,
+    "get-path-stat"       , mx.ExtFunc    , XGetPathStat       ,
+    "get-stat-cache-stats", mx.ExtFunc    , XGetStatCacheStats ,
+    "invalidate-path-stat", mx.ExtFunc    , XInvalidatePathStat,
+    "list-directory"      , mx.ExtFunc    , XListDirectory     ,
+    "scan-directory"      , mx.ExtFunc    , XScanDirectory     ,
+    "stat-many"           , mx.ExtFunc    , XStatMany          )
 
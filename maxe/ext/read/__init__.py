@@ -23,12 +23,14 @@
 
 from __future__ import absolute_import
 
-import pdb       as pd; pd = pd
+import pdb        as pd; pd = pd
 
-import maxe.msg  as mm
-import maxe.path as mp
-import maxe.strm as ms
-import maxe.xml  as mx
+import maxe.cache as mca
+import maxe.dep   as md
+import maxe.msg   as mm
+import maxe.path  as mp
+import maxe.strm  as ms
+import maxe.xml   as mx
 
 # ============================================================================
 # DATA TYPES
@@ -42,15 +44,17 @@ import maxe.xml  as mx
 #   readParamCli: function to read parameters from CLI, (CliCtx): Param
 #   exts: filename extensions, [str].
 #   mimeTypes: MIME types, [str]
+#   sniffers: functions to recognize data, [(Text): bool], see 'AddSniffer'.
 #   Usage:
 #       AddFileExt(Reader, str)
 #       AddMimeType(Reader, str)
+#       AddSniffer(Reader, func)
 #       MakeReader(str, func, func, func, func): Reader
 #       RegReader(str, Reader)
 
 class Reader(object):
     __slots__ = "type", "readText", "readStrm", "readParamXArg", \
-            "readParamCli", "exts", "mimeTypes"
+            "readParamCli", "exts", "mimeTypes", "sniffers"
 
 # ============================================================================
 # PROCEDURES
@@ -71,6 +75,28 @@ def AddMimeType(reader, mimeTypeStr):
     RegReader(mimeTypeStr, reader)
     reader.mimeTypes.append(mimeTypeStr)
 
+# ----------------------------------------------------------------------------
+# AddSniffer(Reader, func)
+#   Add a function that recognizes the reader format by the head of the data,
+#   (Text): bool. The function gets the decoded head of a file, see
+#   'SniffReader', and must not assume it's complete.
+
+def AddSniffer(reader, sniff):
+    Sniffers.append((reader, sniff))
+    reader.sniffers.append(sniff)
+
+# ----------------------------------------------------------------------------
+# GetFileReader(mp.Path): Reader or None
+#   Get the reader for a file: by the file extension if there is a reader
+#   for it, else by sniffing the head of the file. None if no reader fits.
+
+def GetFileReader(path):
+    try:
+        reader = Readers[GetFmtXfrm(mp.GetPathExt(path))]
+    except KeyError:
+        reader = SniffReader(path)
+    return reader
+
 # ----------------------------------------------------------------------------
 # GetFmtXfrm(str): str
 #   Get an xfrm of a format name (reader name, file extension, MIME type).
@@ -78,6 +104,44 @@ def AddMimeType(reader, mimeTypeStr):
 def GetFmtXfrm(extStr):
     return extStr.lower()
 
+# ----------------------------------------------------------------------------
+# GetHeadText(bytes): Text or None
+#   Decode the head of a file to sniff the format. Use the BOM to tell UTF-16
+#   from UTF-8; return None for compressed or other binary data.
+
+def GetHeadText(head):
+    i = 0; n = len(BinMagics)
+    while i < n:
+        if head.startswith(BinMagics[i]):
+            return None
+        i += 1
+    if head.startswith(b"\xef\xbb\xbf"):
+        enc = "utf-8"; head = head[3:]
+    elif head.startswith(b"\xff\xfe"):
+        enc = "utf-16-le"; head = head[2:]
+    elif head.startswith(b"\xfe\xff"):
+        enc = "utf-16-be"; head = head[2:]
+    elif head.startswith(b"<\x00"):
+        enc = "utf-16-le"
+    elif head.startswith(b"\x00<"):
+        enc = "utf-16-be"
+    elif b"\x00" in head:
+        # Text in UTF-8 or in a single-byte encoding has no NULs.
+        return None
+    else:
+        enc = "utf-8"
+    # The head may end in the middle of a character.
+    return head.decode(enc, "replace")
+
+# ----------------------------------------------------------------------------
+# GetParamArgKey(XArg or None): tuple or None
+#   Get a hashable key of a reader parameter XArg, see 'ReadFileCached'.
+
+def GetParamArgKey(paramArg):
+    if paramArg is None:
+        return None
+    return tuple(mx.GetXArgAsOpts(paramArg))
+
 # ----------------------------------------------------------------------------
 # GetReader(str): Reader
 #   Get the reader.
@@ -90,6 +154,19 @@ def GetReader(fmt):
         raise Exception("Failed to find a reader for '%s'" % fmt)
     return reader
 
+# ----------------------------------------------------------------------------
+# GetXmlSizeApprox(Xml, int): int
+#   Get the approximate size of a parsed tree in memory: the size of the data
+#   plus a fixed size per node, see 'XmlNodeSize'.
+
+def GetXmlSizeApprox(xml, dataSize):
+    if mx.GetXmlType(xml) == mx.XmlDoc:
+        xml = xml.getroot()
+    nodeCount = 0
+    for _ in xml.iter():
+        nodeCount += 1
+    return dataSize + nodeCount * XmlNodeSize
+
 # ----------------------------------------------------------------------------
 # MakeReader(str, func, func, func, func): Reader
 #   Make a Reader.
@@ -104,6 +181,7 @@ def MakeReader(name, readStrm, readText, readParamXArg, readParamCli):
     reader.readParamCli = readParamCli
     reader.exts = []
     reader.mimeTypes = []
+    reader.sniffers = []
     return reader
 
 # ----------------------------------------------------------------------------
@@ -120,14 +198,43 @@ def ReadFile(reader, path, param):
         ms.DropStrm(strm)
     return xml
 
+# ----------------------------------------------------------------------------
+# ReadFileCached(Reader, mp.Path, XArg or None): Xml
+#   Read a file with the parameter given as XArg through the document cache,
+#   see 'DocCache'. The key is the real path, the reader, the parameter and
+#   the file mtime, size, and inode, so a changed file is read again.
+#
+#   Cached trees are shared between calls and must not be modified; XSLT
+#   cannot modify them, but Python code that calls this can.
+
+def ReadFileCached(reader, path, paramArg):
+    param = ReadParamXArg(reader, paramArg)
+    poStat = mp.GetPathStat(path).poStat
+    # A cached document is not read again, but is a dependency all the same.
+    md.RecordDep(md.DepTypeFile, mp.GetPathStr(path))
+    if DocCache.budget == 0 or poStat is None:
+        return ReadFile(reader, path, param)
+    key = (mp.GetPathXfrm(path), reader.type, GetParamArgKey(paramArg),
+            poStat.st_mtime, poStat.st_size, poStat.st_ino)
+    xml = mca.GetLruVal(DocCache, key)
+    if xml is None:
+        xml = ReadFile(reader, path, param)
+        mca.PutLruVal(DocCache, key, xml,
+                GetXmlSizeApprox(xml, poStat.st_size))
+    return xml
+
 # ----------------------------------------------------------------------------
 # ReadFileFromCli(mp.Path, str, CliCtx): mx.Xml
 #   Read file as XML given a command-line context.
 
 def ReadFileFromCli(path, fmt, cliCtx):
-    if not fmt:
-        fmt = mp.GetPathExt(path)
-    reader = GetReader(fmt)
+    if fmt:
+        reader = GetReader(fmt)
+    else:
+        reader = GetFileReader(path)
+        if reader is None:
+            raise Exception("Failed to find a reader for '%s'" % 
+                    mp.GetPathStr(path))
     # When calling from command line we always have command line context, but
     # not every reader needs it.
     if reader.readParamCli:
@@ -158,6 +265,47 @@ def RegReader(fmtStr, reader):
         raise Exception("There already exists a reader for '%s'" % fmtStr)
     Readers[fmtXfrm] = reader
 
+# ----------------------------------------------------------------------------
+# SniffHead(bytes): Reader or None
+#   Find the reader by the head of the data.
+
+def SniffHead(head):
+    text = GetHeadText(head); reader = None
+    if text is not None:
+        i = 0; n = len(Sniffers)
+        while i < n:
+            sniffer = Sniffers[i]; i += 1
+            if sniffer[1](text):
+                reader = sniffer[0]
+                break
+    return reader
+
+# ----------------------------------------------------------------------------
+# SniffReader(mp.Path): Reader or None
+#   Find the reader for a file by reading only its head (see 'SniffSize'),
+#   so that a file is never parsed just to find out it's in another format.
+#   Results are cached in 'SniffCache' by path, mtime, and size. It's an
+#   error if the path is not a file.
+
+def SniffReader(path):
+    if not mp.PathIsFile(path):
+        raise Exception("The input path '%s' does not exist or is not a file"
+                % mp.GetPathStr(path))
+    poStat = mp.GetPathStat(path).poStat
+    key = (mp.GetPathXfrm(path), poStat.st_mtime, poStat.st_size)
+    cached = mca.GetLruVal(SniffCache, key)
+    if cached is not None:
+        reader = cached[0]
+    else:
+        strm = ms.MakeIStrmFromPath(path)
+        try:
+            head = ms.ReadStrmHead(strm, SniffSize)
+        finally:
+            ms.DropStrm(strm)
+        reader = SniffHead(head)
+        mca.PutLruVal(SniffCache, key, (reader,), len(repr(key)))
+    return reader
+
 # ----------------------------------------------------------------------------
 # XReadFile(_, XArg, XArg?, XArg?): XArg(NSet)
 #   XPath function to read a file. 
@@ -171,13 +319,40 @@ def XReadFile(_, pathArg, fmtArg=None, paramArg=None):
             if fmt == "":
                 fmt = None
         if fmt is None:
-            fmt = mp.GetPathExt(path)
-        reader = GetReader(fmt)
-        result = ReadFile(reader, path, ReadParamXArg(reader, paramArg))
+            reader = GetFileReader(path)
+            if reader is None:
+                raise Exception("Failed to find a reader for '%s'" % 
+                        mp.GetPathStr(path))
+        else:
+            reader = GetReader(fmt)
+        result = ReadFileCached(reader, path, paramArg)
+        # lxml cannot return a document in a nodeset; return its element.
+        if mx.GetXmlType(result) == mx.XmlDoc:
+            result = result.getroot()
     except Exception as exc:
         result = mm.GetExcAsXml(exc)
     return [result]
 
+# ----------------------------------------------------------------------------
+# XGetDocCacheStats(_): Xml(Elt)
+#   XPath function to get the document cache counters, see 'DocCache'.
+#
+#       <maxe:doc-cache budget size count hits misses evictions>
+
+def XGetDocCacheStats(_):
+    try:
+        stats = mca.GetLruStats(DocCache)
+        result = mx.MakeElt(mxQNameMxDocCache)
+        mx.SetAttr(result, mxQNameBudget, str(stats.budget))
+        mx.SetAttr(result, mxQNameSize, str(stats.size))
+        mx.SetAttr(result, mxQNameCount, str(stats.count))
+        mx.SetAttr(result, mxQNameHits, str(stats.hits))
+        mx.SetAttr(result, mxQNameMisses, str(stats.misses))
+        mx.SetAttr(result, mxQNameEvictions, str(stats.evictions))
+    except Exception as exc:
+        result = mm.GetExcAsXml(exc)
+    return result
+
 # ----------------------------------------------------------------------------
 # XReadText(_, XArg, XArg, XArg?): XArg(NSet)
 #   XPath function to read a text. Return <maxe:text type> with contents.
@@ -201,9 +376,61 @@ def XReadText(_, textArg, fmtArg, paramArg=None):
 
 Readers = {}
 
+# ----------------------------------------------------------------------------
+# Sniffers: functions to recognize formats, [(Reader, func)]. See 'AddSniffer'.
+
+Sniffers = []
+
+# ----------------------------------------------------------------------------
+# SniffCache: results of 'SniffReader' by the path xfrm, mtime, and size,
+# (Reader or None,); the budget is in approximate bytes of the keys.
+
+SniffCache = mca.MakeLru(1 << 20)
+
+# ----------------------------------------------------------------------------
+# SniffSize: how many bytes to read to sniff the file format.
+
+SniffSize = 1024
+
+# ----------------------------------------------------------------------------
+# BinMagics: signatures of compressed and other binary data that readers
+# don't read: gzip, bzip2, xz, zip, zstd, 7z, [bytes].
+
+BinMagics = [b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00", b"PK\x03\x04",
+        b"\x28\xb5\x2f\xfd", b"7z\xbc\xaf\x27\x1c"]
+
+# ----------------------------------------------------------------------------
+# DocCache: parsed documents read by 'mext:read-file', see 'ReadFileCached'.
+# The cache lives as long as the process, so documents are shared between
+# transforms; the budget is in approximate bytes, see 'GetXmlSizeApprox'.
+
+DocCache = mca.MakeLru(64 << 20)
+
+# ----------------------------------------------------------------------------
+# XmlNodeSize: approximate memory size of a parsed node, see
+# 'GetXmlSizeApprox'.
+
+XmlNodeSize = 120
+
+# ----------------------------------------------------------------------------
+# mx.Ns, mx.QName instances.
+
+mxNs   = mx.GetNs("")
+mxNsMx = mx.GetNs("urn:onegasoft:Maxe")
+
+mxQNameMxDocCache = mx.GetQName(mxNsMx, "doc-cache")
+
+mxQNameBudget     = mx.GetQName(mxNs  , "budget"   )
+mxQNameCount      = mx.GetQName(mxNs  , "count"    )
+mxQNameEvictions  = mx.GetQName(mxNs  , "evictions")
+mxQNameHits       = mx.GetQName(mxNs  , "hits"     )
+mxQNameMisses     = mx.GetQName(mxNs  , "misses"   )
+mxQNameSize       = mx.GetQName(mxNs  , "size"     )
+
 # ----------------------------------------------------------------------------
 # Register extensions.
 
 mx.RegExts("urn:onegasoft:Maxe/Ext",
-    "read-file", mx.ExtFunc, XReadFile,
-    "read-text", mx.ExtFunc, XReadText)
+    "get-doc-cache-stats", mx.ExtFunc    , XGetDocCacheStats,
+    "read-file"          , mx.ExtFunc    , XReadFile        ,
+    "read-text"          , mx.ExtFuncPure, XReadText        )
@@ -21,17 +21,49 @@
 
 # ============================================================================
 
+import copy                 as pcp
+import hashlib              as phl
 import pdb                  as pd; pd = pd
+import re                   as pr
+import threading            as pth
 
+import docutils             as dc
 import docutils.frontend    as df
 import docutils.parsers.rst as dpr
 import docutils.utils       as du
 
+import maxe.cache           as mca
 import maxe.compat          as mc
 import maxe.ext.read        as mer
 import maxe.strm            as ms
 import maxe.xml             as mx
 
+# ---------------------------------------------------------------------------
+# GetDfCfg(): optparse.Values
+#   Get the default docutils document settings. Building them takes longer
+#   than parsing a small document, so they are built once; each document
+#   gets a shallow copy with its own list of dependencies.
+
+def GetDfCfg():
+    global DfCfg, RstCacheSaltStr
+    with DfCfgLock:
+        if DfCfg is None:
+            # Magic from help(du.new_document).
+            dfCfg = df.OptionParser(
+                    components=(dpr.Parser,)).get_default_values()
+            # The settings are part of the cache key; leave out the ones
+            # that are objects and do not change the result.
+            items = []
+            for nameStr, val in sorted(vars(dfCfg).items()):
+                if nameStr not in ("record_dependencies", "warning_stream"):
+                    items.append((nameStr, val))
+            RstCacheSaltStr = "%d\0%s\0%r" % (RstCacheFormat,
+                    dc.__version__, items)
+            DfCfg = dfCfg
+    dfCfg = pcp.copy(DfCfg)
+    dfCfg.record_dependencies = du.DependencyList()
+    return dfCfg
+
 # ---------------------------------------------------------------------------
 # GetDprParser(): dpr.Parser
 #   Get a docutils.parsers.rst.Parser instance. This is relatively slow call,
@@ -93,21 +125,37 @@ def GetRstXml(rst):
 
 # ----------------------------------------------------------------------------
 # ReadText(Text, _)
-#   Read reST text.
+#   Read reST text. The resulting XML is kept in 'RstCache' by a digest of
+#   the text, the docutils version, and the settings; a document that
+#   includes other files is not cached, because the text does not tell if
+#   they have changed.
 
 def ReadText(text, _):
+    dfCfg = GetDfCfg()
+    keyStr = phl.sha1(RstCacheSaltStr.encode("utf-8") + b"\0" +
+            text.encode("utf-8")).hexdigest()
+    data = mca.GetDiskCacheVal(RstCache, keyStr)
+    if data is not None:
+        try:
+            return mx.ParseXml(ms.MakeIStrmInMem(data),
+                    RstCacheReadParam).getroot()
+        except Exception:
+            pass # a damaged file; parse again and overwrite it
     # Get a parser.
     dprParser = GetDprParser()
-    # Get default document settings using magic from help(du.new_document).
-    dfCfg = df.OptionParser(components=(dpr.Parser,)).get_default_values()
     # Create a new document.
     duDoc = du.new_document(None, dfCfg)
     # Parse.
     dprParser.parse(text, duDoc)
     # Convert to XML (duDoc is an rst object too).
-    return GetRstXml(duDoc)
+    xml = GetRstXml(duDoc)
+    if not dfCfg.record_dependencies.list and RstCache.budget:
+        strm = ms.MakeOStrmInMem()
+        mx.WriteXml(strm, xml, mx.MakeSCfg())
+        mca.PutDiskCacheVal(RstCache, keyStr, ms.GetStrmData(strm))
+    return xml
 
-# Default dfCfg settings for docutils 0.16
+# Default dfCfg settings for docutils 0.16 (see 'GetDfCfg')
 
 # title                         :  None
 # generator                     :  None
@@ -161,6 +209,15 @@ def ReadText(text, _):
 # smartquotes_locales           :  None
 # character_level_inline_markup :  False
     
+# ----------------------------------------------------------------------------
+# SniffText(Text): bool
+#   Test if the head of the data looks like reStructuredText: has a section
+#   adornment line, an explicit markup start, or a field list item.
+
+def SniffText(text):
+    return not text.lstrip().startswith("<") and \
+            RstMarkRegEx.search(text) is not None
+
 # ----------------------------------------------------------------------------
 # ReadStrm(Strm, _)
 #   Read reST data.
@@ -171,12 +228,38 @@ def ReadStrm(strm, _):
 # ============================================================================
 # CODE
 
+# ----------------------------------------------------------------------------
+# DfCfg: default docutils document settings, optparse.Values; built on the
+# first call, see 'GetDfCfg'. DfCfgLock guards it.
+
+DfCfg = None
+DfCfgLock = pth.Lock()
+
 # ----------------------------------------------------------------------------
 # DprParser: docutils.parsers.rst.Parser instance. Initialization takes some
 # time, so it's initialized on the first call; see 'GetDprRarser'.
 
 DprParser = None
 
+# ----------------------------------------------------------------------------
+# RstCache: reST documents converted to XML, in the 'rst' subdirectory of the
+# cache directory, 256M by default; see 'ReadText'. RstCacheFormat is the
+# version of the conversion: change it when 'GetRstXml' changes. The salt
+# is the rest of the key, see 'GetDfCfg'. Cached XML is read back with
+# RstCacheReadParam.
+
+RstCache = mca.MakeDiskCache("rst", 256 << 20)
+RstCacheFormat = 1
+RstCacheSaltStr = None
+RstCacheReadParam = mx.MakeReadParam()
+
+# ----------------------------------------------------------------------------
+# RstMarkRegEx: regular expression to find typical reST markup, see
+# 'SniffText'.
+
+RstMarkRegEx = pr.compile(r"^(?:([=\-`:'\"~^_*+#])\1{2,}[ \t]*$|\.\. \S"
+        r"|:[A-Za-z][^:\n]*: )", pr.M)
+
 # ----------------------------------------------------------------------------
 # mx.Ns, mx.QName instances
 
@@ -190,3 +273,4 @@ NsXml = mx.GetNs("http://www.w3.org/XML/1998/namespace")
 Reader = mer.MakeReader("reStructuredText", ReadStrm, ReadText, None, None)
 mer.AddFileExt(Reader, ".rst")
 mer.AddMimeType(Reader, "text/x-rst")
+mer.AddSniffer(Reader, SniffText)
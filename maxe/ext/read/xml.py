@@ -42,22 +42,44 @@ def ReadParamCli(cliCtx):
     i = 0; n = len(cliCtx.paths)
     while i < n:
         mx.AddPathToReadParam(param, cliCtx.paths[i]); i += 1
+    i = 0; n = len(cliCtx.catalogs)
+    while i < n:
+        mx.AddCatalogToReadParam(param, cliCtx.catalogs[i]); i += 1
+    i = 0; n = len(cliCtx.readOpts)
+    while i < n:
+        nameStr, valStr = cliCtx.readOpts[i]; i += 1
+        mx.SetReadParamOpt(param, nameStr, valStr)
     return param
 
 # ----------------------------------------------------------------------------
 # ReadParamXArg(XArg): ReadParam
-#   Read a ReadParam from XArg.
-#   NOTE: no-op for now.
+#   Read a ReadParam from XArg: options as a string or attributes of an
+#   element, see 'mx.GetXArgAsOpts' and 'mx.ReadParamOpts'. E.g.:
+#
+#       mext:read-file($path, '', 'remove-blank-text huge-tree')
 
 def ReadParamXArg(xArg):
     param = mx.MakeReadParam()
+    opts = mx.GetXArgAsOpts(xArg); i = 0; n = len(opts)
+    while i < n:
+        nameStr, valStr = opts[i]; i += 1
+        mx.SetReadParamOpt(param, nameStr, valStr)
     return param
 
 # ----------------------------------------------------------------------------
-# ReadStrm(Strm, ReadParam): Xml
-#   Read XML from stream.
+# SniffText(Text): bool
+#   Test if the head of the data looks like XML.
+
+def SniffText(text):
+    return text.lstrip().startswith("<")
+
+# ----------------------------------------------------------------------------
+# ReadStrm(Strm, ReadParam or None): Xml
+#   Read XML from stream; use the default ReadParam if there's none.
 
 def ReadStrm(strm, param):
+    if param is None:
+        param = mx.MakeReadParam()
     return mx.ReadXml(strm, param)
 
 # ----------------------------------------------------------------------------
@@ -79,6 +101,7 @@ def ReadStrm(strm, param):
 Reader = mer.MakeReader("XML", ReadStrm, None, ReadParamXArg, ReadParamCli)
 mer.AddFileExt(Reader, ".xml")
 mer.AddMimeType(Reader, "text/xml")
+mer.AddSniffer(Reader, SniffText)
 
 
 
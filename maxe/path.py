@@ -26,6 +26,19 @@ from __future__ import absolute_import
 # ============================================================================
 # Data types
 
+# ----------------------------------------------------------------------------
+# DirEntry
+#   An entry of a directory listing, 'os.DirEntry' or a compatible object,
+#   see 'mc.ScanDir': 'name', 'path', 'is_dir()', 'is_file()', 'stat()'.
+#   The types come with the listing on most systems, so telling directories
+#   from files needs no stat; a stat is read on first use and kept. Stats
+#   follow symlinks, as 'ReadPoStat' does. DirEntries do not use the stat
+#   cache: they are fresh already.
+#
+# Usage:
+#   ListDirEntries(Path): [DirEntry]
+#   ReadEntryPoStat(DirEntry): os.stat_result or None
+
 # ----------------------------------------------------------------------------
 # Path
 #   A filesystem path.
@@ -49,9 +62,67 @@ class Path(object):
 class PathStat(object):
     __slots__ = "path", "poStat"
 
+# ----------------------------------------------------------------------------
+# StatCache
+#   A process-wide cache of stat results shared by all Paths. A Path keeps
+#   its own PathStat, but extension functions make new Paths on each call;
+#   the cache makes repeated stats of the same path cheap. On network file
+#   systems each stat is a round trip.
+#
+#   mode: when cached stats become stale, StatCacheMode.
+#   ttl: time to live in seconds for StatCacheModeTtl and the time to keep a
+#     parent directory mtime for StatCacheModeParent, float.
+#   entries: cached stats by normalized path: stat result, read time, and
+#     parent mtime, {str:(os.stat_result or None, float, float or None)}.
+#   parents: parent mtimes and read times, {str:(float, float)}.
+#   hits, misses: counters, int.
+#   lock: guards the counters and the updates, pth.Lock.
+#
+#   Nonexisting paths are cached too, as entries with no stat result.
+#
+# Usage:
+#   ClearStatCache()
+#   GetStatCacheCounts(): (int, int, int)
+#   InvalidatePathStat(Path)
+#   SetStatCacheMode(StatCacheMode, float)
+
+class StatCache(object):
+    __slots__ = "mode", "ttl", "entries", "parents", "hits", "misses", \
+            "lock"
+
+# ----------------------------------------------------------------------------
+# StatCacheMode: when cached stats become stale.
+#   Usage: SetStatCacheMode(StatCacheMode, float)
+
+StatCacheModeOff    = 0 # do not cache
+StatCacheModeRun    = 1 # until the next 'ExpireStatCache', e.g. one XSLT run
+StatCacheModeTtl    = 2 # for 'ttl' seconds
+StatCacheModeParent = 3 # while the parent directory mtime is the same
+
 # ============================================================================
 # Functions
 
+# ----------------------------------------------------------------------------
+# ClearStatCache()
+#   Drop all cached stats and reset the counters.
+
+def ClearStatCache():
+    with StatCacheInst.lock:
+        StatCacheInst.entries = {}
+        StatCacheInst.parents = {}
+        StatCacheInst.hits = 0
+        StatCacheInst.misses = 0
+
+# ----------------------------------------------------------------------------
+# ExpireStatCache()
+#   Drop the cached stats that are only valid for a single run (see
+#   'StatCacheModeRun'); this is done before each XSLT transform.
+
+def ExpireStatCache():
+    if StatCacheInst.mode == StatCacheModeRun:
+        with StatCacheInst.lock:
+            StatCacheInst.entries = {}
+
 # ----------------------------------------------------------------------------
 # GetCurPath(): Path
 #   Get the current path.
@@ -59,6 +130,13 @@ class PathStat(object):
 def GetCurPath():
     return MakePath(po.getcwd())
 
+# ----------------------------------------------------------------------------
+# GetEntryName(DirEntry): str
+#   Get the name of a DirEntry; the sort key of listings.
+
+def GetEntryName(entry):
+    return entry.name
+
 # ----------------------------------------------------------------------------
 # GetPathAtime(Path): int(UnixTime)
 #   Get path access time.
@@ -117,6 +195,14 @@ def GetPathStat(path):
         path.pathStat = ReadPathStat(path)
     return path.pathStat
 
+# ----------------------------------------------------------------------------
+# GetPathStatKey(str): str
+#   Get the key of a path string in the stat cache. This is not 'realpath'
+#   because resolving symlinks would take the stats we want to save.
+
+def GetPathStatKey(pathStr):
+    return pop.normcase(pop.abspath(pathStr))
+
 # ----------------------------------------------------------------------------
 # GetPathStem(Path): str
 #   Get the stem (the base name without extension) of the Path.
@@ -138,12 +224,69 @@ def GetPathStr(path):
 def GetPathXfrm(path):
     return pop.normcase(pop.realpath(path.pathStr))
 
+# ----------------------------------------------------------------------------
+# GetStatCacheCounts(): (int, int, int)
+#   Get the stat cache hits, misses, and the number of cached entries.
+
+def GetStatCacheCounts():
+    return (StatCacheInst.hits, StatCacheInst.misses,
+            len(StatCacheInst.entries))
+
+# ----------------------------------------------------------------------------
+# GetStatCacheParentMtime(str, float): float or None
+#   Get the mtime of a parent directory for 'StatCacheModeParent'. The mtime
+#   itself is kept for 'ttl' seconds, so siblings share one stat of their
+#   parent. The parent is stat'ed without holding the cache lock, so other
+#   threads can use the cache meanwhile.
+
+def GetStatCacheParentMtime(parentKey, now):
+    with StatCacheInst.lock:
+        parent = StatCacheInst.parents.get(parentKey)
+    if parent is not None and now - parent[1] <= StatCacheInst.ttl:
+        return parent[0]
+    try:
+        mtime = po.stat(parentKey).st_mtime
+    except OSError:
+        mtime = None
+    with StatCacheInst.lock:
+        StatCacheInst.parents[parentKey] = mtime, now
+    return mtime
+
+# ----------------------------------------------------------------------------
+# InvalidatePathStat(Path)
+#   Drop the cached stat of the Path, its own and shared; use after changing
+#   the file system. For 'StatCacheModeParent' the parent mtime is dropped
+#   too, since the change may have been adding or removing the path.
+
+def InvalidatePathStat(path):
+    path.pathStat = None
+    key = GetPathStatKey(path.pathStr)
+    with StatCacheInst.lock:
+        StatCacheInst.entries.pop(key, None)
+        StatCacheInst.parents.pop(pop.dirname(key), None)
+
 # ----------------------------------------------------------------------------
 # ListDir(Path): [str]
 #   List the Path directory.
 
 def ListDir(path):
-    return po.listdir(path.pathStr)
+    nameStrs = po.listdir(path.pathStr)
+    md.RecordDirDep(path.pathStr, nameStrs)
+    return nameStrs
+
+# ----------------------------------------------------------------------------
+# ListDirEntries(Path): [DirEntry]
+#   List the Path directory as DirEntries sorted by name.
+
+def ListDirEntries(path):
+    entries = list(mc.ScanDir(path.pathStr))
+    entries.sort(key=GetEntryName)
+    if md.DepRecInst.on or md.DepRecInst.captures:
+        nameStrs = []; i = 0; n = len(entries)
+        while i < n:
+            nameStrs.append(entries[i].name); i += 1
+        md.RecordDirDep(path.pathStr, nameStrs)
+    return entries
 
 # ----------------------------------------------------------------------------
 # MakePath(str): Path
@@ -200,21 +343,86 @@ def PathIsFile(path):
         result = False
     return result
 
+# ----------------------------------------------------------------------------
+# ReadEntryPoStat(DirEntry): os.stat_result or None
+#   Read stat of a DirEntry; None if it no longer exists or is a broken
+#   symlink.
+
+def ReadEntryPoStat(entry):
+    try:
+        poStat = entry.stat()
+    except OSError as error:
+        if error.errno == pe.ENOENT:
+            poStat = None
+        else:
+            raise
+    return poStat
+
 # ----------------------------------------------------------------------------
 # ReadPathStat(Path): PathStat
-#   Read PathStat from a Path.
+#   Read PathStat from a Path. Use the shared stat cache, if enabled.
 
 def ReadPathStat(path):
     pathStat = PathStat()
-    pathStat.path = path; path.pathStat = pathStat
+    pathStat.path = path
+    if StatCacheInst.mode == StatCacheModeOff:
+        pathStat.poStat = ReadPoStat(path.pathStr)
+    else:
+        pathStat.poStat = ReadPoStatCached(path.pathStr)
+    # Set it only when complete: other threads may use the same Path.
+    path.pathStat = pathStat
+    return pathStat
+
+# ----------------------------------------------------------------------------
+# ReadPoStat(str): os.stat_result or None
+#   Read stat of a path string; None if the path does not exist.
+
+def ReadPoStat(pathStr):
     try:
-        pathStat.poStat = po.stat(path.pathStr)
+        poStat = po.stat(pathStr)
     except OSError as error:
         if error.errno == pe.ENOENT:
-            pathStat.poStat = None
+            poStat = None
         else:
             raise
-    return pathStat
+    return poStat
+
+# ----------------------------------------------------------------------------
+# ReadPoStatCached(str): os.stat_result or None
+#   Read stat of a path string through the stat cache.
+
+def ReadPoStatCached(pathStr):
+    cache = StatCacheInst; key = GetPathStatKey(pathStr); now = pt.time()
+    parentMtime = None
+    if cache.mode == StatCacheModeParent:
+        parentMtime = GetStatCacheParentMtime(pop.dirname(key), now)
+    with cache.lock:
+        entry = cache.entries.get(key)
+        if entry is not None:
+            poStat, readTime, entryParentMtime = entry
+            if cache.mode == StatCacheModeRun \
+                    or cache.mode == StatCacheModeTtl \
+                    and now - readTime <= cache.ttl \
+                    or cache.mode == StatCacheModeParent \
+                    and parentMtime is not None \
+                    and parentMtime == entryParentMtime:
+                cache.hits += 1
+                return poStat
+        cache.misses += 1
+    poStat = ReadPoStat(pathStr)
+    with cache.lock:
+        cache.entries[key] = poStat, now, parentMtime
+    return poStat
+
+# ----------------------------------------------------------------------------
+# SetStatCacheMode(StatCacheMode, float)
+#   Set the shared stat cache mode and the time to live, see 'StatCache'.
+#   This drops all cached stats.
+
+def SetStatCacheMode(mode, ttl):
+    StatCacheInst.mode = mode
+    StatCacheInst.ttl = ttl
+    ClearStatCache()
 
 # CODE =======================================================================
 
@@ -222,3 +430,19 @@ import errno       as pe  # pe.ENOENT
 import os          as po  # getcwd, listdir, stat
 import os.path     as pop # join, splitext
 import stat        as pst # interpret po.stat
+import threading   as pth # Lock
+import time        as pt  # time
+
+import maxe.compat as mc  # ScanDir
+import maxe.dep    as md  # record listed directories
+
+# The shared stat cache; by default stats are kept for one XSLT run.
+
+StatCacheInst = StatCache()
+StatCacheInst.mode = StatCacheModeRun
+StatCacheInst.ttl = 1.0
+StatCacheInst.entries = {}
+StatCacheInst.parents = {}
+StatCacheInst.hits = 0
+StatCacheInst.misses = 0
+StatCacheInst.lock = pth.Lock()
@@ -23,14 +23,48 @@
 
 from __future__ import absolute_import
 
-import sys         as ps # stdin/out attributes
+import hashlib     as phl # stream digests
+import sys         as ps  # stdin/out attributes
+import tarfile     as ptf # tar archives
+import threading   as pth # archive writer thread
+import time        as pt  # archive entry timestamps
+import zipfile     as pz  # zip archives
 
-import maxe.compat as mc # streams in memory, stdin/out binary stream.
-import maxe.path   as mp # streams from paths
+import maxe.compat as mc  # streams in memory, stdin/out binary stream.
+import maxe.dep    as md  # record read files
+import maxe.path   as mp  # streams from paths
 
 # ============================================================================
 # Data types.
 
+# ----------------------------------------------------------------------------
+# Arch: output archive, a sink that writes many documents as entries of a 
+# single zip or tar stream. Entries are appended sequentially; creating one
+# archive is much cheaper than creating thousands of small files.
+
+#   type: archive type, ArchType*.
+#   arch: the archive, zipfile.ZipFile or tarfile.TarFile.
+#   queue: entries waiting for the writer thread, Queue or None.
+#   thread: writer thread, threading.Thread or None.
+#   error: exception raised in the writer thread or None.
+#
+# Usage:
+#   AddArchEntry(Arch, str, bytes)
+#   DropArch(Arch)
+# + MakeOArchFromPath(mp.Path, bool): Arch
+
+class Arch(object):
+    __slots__ = "type", "arch", "queue", "thread", "error"
+
+# ----------------------------------------------------------------------------
+# ArchType: archive type.
+#   Usage: Arch.type, GetArchType(mp.Path).
+
+ArchTypeZip    = 0
+ArchTypeTar    = 1
+ArchTypeTarGz  = 2
+ArchTypeTarBz2 = 3
+
 # ----------------------------------------------------------------------------
 # Strm: binary input or output stream. 
 
@@ -39,12 +73,16 @@ import maxe.path   as mp # streams from paths
 #
 # Usage:
 # - DropStrm(Strm)
+#   GetStrmData(Strm): bytes
+#   HashStrm(Strm, str, int or None): str
 # + MakeIStrmInMem(bytes): Strm
 # + MakeIStrmFromPath(mp.Path): Strm
 # + MakeIStrmFromStdin(): Strm
 # + MakeOStrmFromPath(mp.Path): Strm
 # + MakeOStrmFromStdoit(): Strm
+# + MakeOStrmInMem(): Strm
 #   ReadStrm(Strm): bytes
+#   ReadStrmHead(Strm, int): bytes
 
 class Strm(object):
     __slots__ = "type", "fhdl"
@@ -61,6 +99,34 @@ StrmTypeMem  = 3
 # ============================================================================
 # Functions.
 
+# ----------------------------------------------------------------------------
+# AddArchEntry(Arch, str, bytes)
+#   Add an entry to an archive. If the archive has a writer thread, pass the
+#   entry to the thread, else write (and compress) it right away. The name
+#   is normalized first, see 'GetArchEntryNameStr'.
+
+def AddArchEntry(arch, nameStr, data):
+    nameStr = GetArchEntryNameStr(nameStr)
+    if arch.queue is None:
+        WriteArchEntry(arch, nameStr, data)
+    else:
+        if arch.error is not None:
+            raise arch.error
+        arch.queue.put((nameStr, data))
+
+# ----------------------------------------------------------------------------
+# DropArch(Arch)
+#   Finish writing the archive and close it. Errors of the writer thread are
+#   raised here.
+
+def DropArch(arch):
+    if arch.thread is not None:
+        arch.queue.put(None)
+        arch.thread.join()
+    arch.arch.close()
+    if arch.error is not None:
+        raise arch.error
+
 # ----------------------------------------------------------------------------
 # DropStrm(Strm):
 #   Dispose a Strm.
@@ -69,6 +135,77 @@ def DropStrm(strm):
     if strm.type == StrmTypeFile:
         strm.fhdl.close()
 
+# ----------------------------------------------------------------------------
+# GetArchEntryNameStr(str): str
+#   Normalize the name of an archive entry so that it stays inside the
+#   directory the archive is extracted to: use '/' as the separator, strip
+#   leading '/', and drop '.' and empty parts. A name with '..' parts, a
+#   drive, or nothing left is an error.
+
+def GetArchEntryNameStr(nameStr):
+    partStrs = []; srcPartStrs = nameStr.replace("\\", "/").split("/")
+    i = 0; n = len(srcPartStrs)
+    while i < n:
+        partStr = srcPartStrs[i]; i += 1
+        if partStr == ".." or i == 1 and partStr.endswith(":"):
+            raise Exception("Invalid archive entry name '%s'" % nameStr)
+        if partStr and partStr != ".":
+            partStrs.append(partStr)
+    if not partStrs:
+        raise Exception("Invalid archive entry name '%s'" % nameStr)
+    return "/".join(partStrs)
+
+# ----------------------------------------------------------------------------
+# GetArchType(mp.Path): ArchType
+#   Get the archive type from the path name: '.zip', '.tar', '.tar.gz' or
+#   '.tgz', '.tar.bz2' or '.tbz2'.
+
+def GetArchType(path):
+    nameStr = mp.GetPathName(path).lower()
+    if nameStr.endswith(".zip"):
+        archType = ArchTypeZip
+    elif nameStr.endswith(".tar"):
+        archType = ArchTypeTar
+    elif nameStr.endswith(".tar.gz") or nameStr.endswith(".tgz"):
+        archType = ArchTypeTarGz
+    elif nameStr.endswith(".tar.bz2") or nameStr.endswith(".tbz2"):
+        archType = ArchTypeTarBz2
+    else:
+        raise Exception("Cannot tell the archive type of '%s'" %
+                mp.GetPathStr(path))
+    return archType
+
+# ----------------------------------------------------------------------------
+# GetStrmData(Strm): bytes
+#   Get data written into an out-Strm in memory.
+
+def GetStrmData(strm):
+    return strm.fhdl.getvalue()
+
+# ----------------------------------------------------------------------------
+# HashStrm(Strm, str, int or None): str
+#   Get the hex digest of the data of an IStrm, or of up to 'size' bytes of
+#   it, by a 'hashlib' algorithm, e.g. 'sha1' or 'sha256'. The data are read
+#   in chunks of 'HashChunkSize', so a file of any size takes little memory;
+#   'hashlib' releases the GIL on large chunks, so threads can hash several
+#   streams at once.
+
+def HashStrm(strm, algoStr, size):
+    try:
+        hashObj = phl.new(algoStr)
+    except ValueError:
+        raise Exception("Unknown hash algorithm '%s'" % algoStr)
+    while size is None or size > 0:
+        if size is None:
+            data = strm.fhdl.read(HashChunkSize)
+        else:
+            data = strm.fhdl.read(min(size, HashChunkSize))
+            size -= len(data)
+        if not data:
+            break
+        hashObj.update(data)
+    return hashObj.hexdigest()
+
 # ----------------------------------------------------------------------------
 # MakeIStrmInMem(bytes): Strm
 #   Make an input stream from bytes in memory.
@@ -90,6 +227,7 @@ def MakeIStrmFromPath(path):
     strm = Strm()
     strm.type = StrmTypeFile
     strm.fhdl = open(mp.GetPathStr(path), "rb")
+    md.RecordDep(md.DepTypeFile, mp.GetPathStr(path))
     return strm
 
 # ----------------------------------------------------------------------------
@@ -105,6 +243,42 @@ def MakeIStrmFromStdin():
     strm.fhdl = mc.GetStdinFhdl()
     return strm
 
+# ----------------------------------------------------------------------------
+# MakeOArchFromPath(mp.Path, bool): Arch
+#   Make an output archive. The archive type is defined by the path name (see
+#   'GetArchType'). If 'threaded' is true, entries are compressed and written
+#   by a separate writer thread, so the caller can prepare the next entry in
+#   the meantime.
+
+def MakeOArchFromPath(path, threaded):
+    if mp.PathExists(path) and not mp.PathIsFile(path):
+        raise Exception("The output path '%s' exists and is not a file" %
+                mp.GetPathStr(path))
+    arch = Arch()
+    arch.type = GetArchType(path)
+    pathStr = mp.GetPathStr(path)
+    if arch.type == ArchTypeZip:
+        arch.arch = pz.ZipFile(pathStr, "w", pz.ZIP_DEFLATED, True)
+    elif arch.type == ArchTypeTar:
+        arch.arch = ptf.open(pathStr, "w")
+    elif arch.type == ArchTypeTarGz:
+        arch.arch = ptf.open(pathStr, "w:gz")
+    else: # ArchTypeTarBz2
+        arch.arch = ptf.open(pathStr, "w:bz2")
+    mp.InvalidatePathStat(path)
+    arch.error = None
+    if threaded:
+        # Bound the queue so that a slow disk does not make us keep all the
+        # documents in memory.
+        arch.queue = mc.MakeQueue(ArchQueueSize)
+        arch.thread = pth.Thread(target=WriteArchEntries, args=(arch,))
+        arch.thread.daemon = True
+        arch.thread.start()
+    else:
+        arch.queue = None
+        arch.thread = None
+    return arch
+
 # ----------------------------------------------------------------------------
 # MakeOStrmFromPath(mp.Path): Strm
 #   Make an out-Strm from an mp.Path.
@@ -116,6 +290,7 @@ def MakeOStrmFromPath(path):
     strm = Strm()
     strm.type = StrmTypeFile
     strm.fhdl = open(mp.GetPathStr(path), "wb")
+    mp.InvalidatePathStat(path)
     return strm
 
 # ----------------------------------------------------------------------------
@@ -130,6 +305,17 @@ def MakeOStrmFromStdout():
         strm.type = StrmTypePipe
     strm.fhdl = mc.GetStdoutFhdl()
     return strm
+
+# ----------------------------------------------------------------------------
+# MakeOStrmInMem(): Strm
+#   Make an out-Strm that collects data in memory; see 'GetStrmData'.
+
+def MakeOStrmInMem():
+    strm = Strm()
+    strm.type = StrmTypeMem
+    strm.fhdl = mc.MakeOFhdlInMem()
+    return strm
+
 # ---------------------------------------------------------------------------
 # ReadStrm(Strm): bytes
 #   Read data from an IStrm.
@@ -137,6 +323,13 @@ def MakeOStrmFromStdout():
 def ReadStrm(strm):
     return strm.fhdl.read()
 
+# ---------------------------------------------------------------------------
+# ReadStrmHead(Strm, int): bytes
+#   Read up to 'size' bytes from the start of an IStrm.
+
+def ReadStrmHead(strm, size):
+    return strm.fhdl.read(size)
+
 # ----------------------------------------------------------------------------
 # ReadText(Strm, str): Text
 #   Read and decode a stream.
@@ -144,3 +337,56 @@ def ReadStrm(strm):
 def ReadText(strm, enc):
     return ReadStrm(strm).decode(enc)
 
+# ----------------------------------------------------------------------------
+# WriteArchEntries(Arch)
+#   Writer thread: write entries from the queue until it receives None. After
+#   an error keep draining the queue so that the producer does not block; the
+#   error is raised by 'AddArchEntry' or 'DropArch'.
+
+def WriteArchEntries(arch):
+    while True:
+        entry = arch.queue.get()
+        if entry is None:
+            break
+        if arch.error is None:
+            try:
+                WriteArchEntry(arch, entry[0], entry[1])
+            except Exception as exc:
+                arch.error = exc
+
+# ----------------------------------------------------------------------------
+# WriteArchEntry(Arch, str, bytes)
+#   Write an entry into an archive.
+
+def WriteArchEntry(arch, nameStr, data):
+    now = pt.time()
+    if arch.type == ArchTypeZip:
+        zipInfo = pz.ZipInfo(nameStr, pt.localtime(now)[:6])
+        zipInfo.compress_type = pz.ZIP_DEFLATED
+        zipInfo.external_attr = 0o644 << 16
+        arch.arch.writestr(zipInfo, data)
+    else:
+        tarInfo = ptf.TarInfo(nameStr)
+        tarInfo.size = len(data)
+        tarInfo.mtime = int(now)
+        tarInfo.mode = 0o644
+        arch.arch.addfile(tarInfo, mc.MakeFhdlInMem(data))
+
+# ----------------------------------------------------------------------------
+# WriteStrm(Strm, bytes)
+#   Write data to a stream.
+
+def WriteStrm(strm, data):
+    strm.fhdl.write(data)
+
+# CODE =======================================================================
+
+# ----------------------------------------------------------------------------
+# ArchQueueSize: how many entries may wait for the archive writer thread.
+
+ArchQueueSize = 64
+
+# ----------------------------------------------------------------------------
+# HashChunkSize: how many bytes 'HashStrm' reads at once.
+
+HashChunkSize = 1 << 20
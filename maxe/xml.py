@@ -80,8 +80,49 @@ class Ext(object):
 #   MakeExt(QName, ExtType, func)
 #   RegExts(str, str, ExtType, func, ...)
 
-ExtFunc = 0 # Extension function (XPath)
-ExtElt  = 1 # Extension element (XSLT)
+ExtFunc     = 0 # Extension function (XPath)
+ExtElt      = 1 # Extension element (XSLT)
+ExtFuncPure = 2 # Extension function (XPath) that has no side effects and
+                # returns the same result for the same arguments; results are
+                # memoized, see 'ExtMemo'.
+
+# ----------------------------------------------------------------------------
+# ExtMemoScope: how long memoized results of ExtFuncPure extensions are kept.
+# Usage:
+#   SetExtMemoScope(ExtMemoScope)
+
+ExtMemoScopeOff  = 0 # do not memoize
+ExtMemoScopeRun  = 1 # for one XSLT run, see 'ApplyXslt'
+ExtMemoScopeProc = 2 # for the life of the process
+
+# ----------------------------------------------------------------------------
+# Schema: a compiled schema, le.DTD, le.XMLSchema, or le.RelaxNG.
+# Usage:
+#   GetSchema(mp.Path, SchemaType): Schema
+#   MakeSchema(mp.Path, SchemaType): Schema
+#   ValidateXml(Xml, Schema): [le._LogEntry]
+
+# ----------------------------------------------------------------------------
+# SchemaType: schema language.
+# Usage:
+#   GetSchema(mp.Path, SchemaType): Schema
+#   GetSchemaType(mp.Path): SchemaType
+
+SchemaTypeDtd = 0 # DTD
+SchemaTypeXsd = 1 # W3C XML Schema
+SchemaTypeRng = 2 # RELAX NG in XML syntax
+
+# ----------------------------------------------------------------------------
+# IdIndex: how 'ReadXml' builds the ID table for the XSLT 'id()' function.
+#   'xml:id' attributes are always indexed by the parser.
+# Usage:
+#   ReadParam.ids: IdIndex
+#   IdIndexNames: {str:IdIndex}
+
+IdIndexValidate = 0 # validate against the DTD, the default
+IdIndexDtd      = 1 # load the DTD and index its ID attributes, no validation
+IdIndexAttrs    = 2 # index the attributes in 'ReadParam.idAttrs'
+IdIndexNone     = 3 # no other IDs
 
 # ----------------------------------------------------------------------------
 # Ns: an XML namespace.
@@ -131,7 +172,29 @@ class QName(object):
 # ----------------------------------------------------------------------------
 # ReadParam: parameters for reading XML.
 #   paths: resource paths, [mp.Path]
+#   hugeTree: allow very deep trees and very long text, bool.
+#   removeBlankText: discard ignorable whitespace text nodes, bool.
+#   resolveEntities: replace entities with their values, bool.
+#   noNetwork: forbid network access to load external resources, bool.
+#   collectIds: build the ID hash table, bool.
+#   compact: store short text directly in the node, bool.
+#   selects: projection paths, keep only matching subtrees, [str].
+#   ancestors: keep the ancestors of projected subtrees, bool.
+#   limit: stop after this many projected subtrees, at least 1, int or
+#     None.
+#   ids: how to build the ID table, IdIndex.
+#   idAttrs: names of ID attributes for IdIndexAttrs, e.g. 'id' or 'p:key',
+#     with prefixes as declared on the document element, [str].
+#   catalogs: OASIS XML catalog files, consulted before resource paths,
+#     [mp.Path].
+#
+#   The parser options have the same meaning and defaults as in lxml; they
+#   and the other options can be set by name with 'SetReadParamOpt', see
+#   'ReadParamOpts'. On projection see 'ReadXmlProj', on IDs see 'ReadXml'.
+#
 #   Usage:
+#       GetParser(ReadParam): le.XMLParser
+#       GetReadParamKey(ReadParam): tuple
 #       MakeReadParam(): ReadParam
 #       ReadXml(Strm, ReadParam): Xml
 #       ReadParamCli(maxe.__main__.Ctx): ReadParam
@@ -140,7 +203,9 @@ class QName(object):
 #       ReadText(Text, ReadParam): Xml
 
 class ReadParam(object):
-    __slots__ = "paths"
+    __slots__ = "paths", "hugeTree", "removeBlankText", "resolveEntities", \
+            "noNetwork", "collectIds", "compact", "selects", "ancestors", \
+            "limit", "ids", "idAttrs", "catalogs"
 
 # ----------------------------------------------------------------------------
 # SCfg: XML serialization configuration. Stores serialization parameters.
@@ -182,6 +247,7 @@ class SCfg(object):
 #
 # Usage:
 #   GetXArgType(XArg): XArgType
+#   GetXArgAsOpts(XArg): [(str, str)]
 #   GetXArtAsStr(XArg): str
 
 # ----------------------------------------------------------------------------
@@ -225,6 +291,32 @@ XArgStr  = 3 # lxml.etree._ElementStringResult,
 #   SetAttr(Xml, QName, str)
 #   WriteXml(Strm, Xml)
 
+# ----------------------------------------------------------------------------
+# XmlWriter: incremental XML writer. Writes elements to a stream as they are
+# produced, so that a large XML does not have to be built in memory first;
+# only the open elements are kept. The output is the same as of 'WriteXml'
+# for the whole tree: each element is serialized by lxml inside copies of
+# the open elements, so it reuses their namespace declarations, and then
+# cut out of their tags.
+#
+#   fhdl: file handle to write to.
+#   encoder: encodes the serialized text, codecs.IncrementalEncoder.
+#   elts: copies of the open elements with no content but the next open
+#     one, nested, innermost last, [le.Element].
+#   startLens: lengths of the start tags of 'elts', as serialized alone,
+#     [int].
+#   endStrs: end tags of 'elts', [str].
+#
+# Usage:
+#   BeginXmlWriterElt(XmlWriter, Xml(Elt))
+# - DropXmlWriter(XmlWriter)
+#   EndXmlWriterElt(XmlWriter)
+# + MakeXmlWriter(Strm, SCfg): XmlWriter
+#   WriteXmlWriterElt(XmlWriter, Xml(Elt))
+
+class XmlWriter(object):
+    __slots__ = "fhdl", "encoder", "elts", "startLens", "endStrs"
+
 # ----------------------------------------------------------------------------
 # XmlType XML object type
 # Usage:
@@ -316,6 +408,19 @@ def AddPath(ctx, path):
     else:
         ctx.paths.append(path)
 
+# ----------------------------------------------------------------------------
+# AddCatalogToReadParam(ReadParam, mp.Path)
+#   Add a catalog file to a ReadParam.
+
+def AddCatalogToReadParam(readParam, path):
+    i = 0; n = len(readParam.catalogs)
+    while i < n:
+        existingPath = readParam.catalogs[i]; i += 1
+        if mp.PathEq(existingPath, path):
+            break
+    else:
+        readParam.catalogs.append(path)
+
 # ----------------------------------------------------------------------------
 # AddPathToReadParam(ReadParam, mp.Path)
 #   Add a path to a ReadParam.
@@ -413,11 +518,38 @@ def AppendText(xml, childXml):
 
 # ----------------------------------------------------------------------------
 # ApplyXslt(Xslt, XsltParams, Xml): Xml
-#   Apply an XSLT.
+#   Apply an XSLT. Stats and extension results cached for a single run are
+#   dropped first (see 'mp.StatCacheModeRun' and 'ExtMemoScopeRun').
 
 def ApplyXslt(xslt, xsltParams, xml):
+    mp.ExpireStatCache()
+    ExpireExtMemo()
     return xslt.xslt(xml, **xsltParams.params)
 
+# ----------------------------------------------------------------------------
+# BeginXmlWriterElt(XmlWriter, Xml(Elt))
+#   Write the start tag of an element; the element is used only for its name
+#   and attributes. Its content follows until the matching 'EndXmlWriterElt'.
+
+def BeginXmlWriterElt(writer, elt):
+    copyElt = le.Element(elt.tag, dict(elt.attrib), elt.nsmap)
+    # Serialized empty: '<name attrs/>'.
+    str_ = GetXmlWriterEltStr(writer, copyElt)
+    if writer.elts:
+        writer.elts[-1].append(copyElt)
+    writer.fhdl.write(writer.encoder.encode(str_[:-2] + ">"))
+    writer.elts.append(copyElt)
+    writer.startLens.append(len(le.tostring(copyElt,
+            encoding="unicode")) - 1)
+    writer.endStrs.append("</%s>" % XmlWriterTagRe.match(str_).group(1))
+
+# ----------------------------------------------------------------------------
+# ClearExtMemo()
+#   Drop all memoized results of ExtFuncPure extensions.
+
+def ClearExtMemo():
+    mca.ClearLru(ExtMemo)
+
 # ---------------------------------------------------------------------------
 # CopySCfg(SCfg): SCfg
 #   Copy an SCfg.
@@ -443,6 +575,142 @@ def CopySCfg(sSCfg):
     tSCfg.ver    = sSCfg.ver
     return tSCfg
 
+# ----------------------------------------------------------------------------
+# CopyXArg(XArg): XArg
+#   Copy the nodes of an XPath extension result, so that a memoized result
+#   can be returned many times. Strings and other values are not copied.
+
+def CopyXArg(xArg):
+    if isinstance(xArg, list):
+        result = []; i = 0; n = len(xArg)
+        while i < n:
+            result.append(CopyXArg(xArg[i])); i += 1
+    elif isinstance(xArg, le._Element):
+        result = pcp.deepcopy(xArg)
+    else:
+        result = xArg
+    return result
+
+# ----------------------------------------------------------------------------
+# DelAttr(Xml(Elt), QName)
+#   Delete an XML element attribute, if it is set.
+
+def DelAttr(elt, qName):
+    elt.attrib.pop(qName.jcStr, None)
+
+# ----------------------------------------------------------------------------
+# DropXmlWriter(XmlWriter)
+#   Close all open elements and finish writing.
+
+def DropXmlWriter(writer):
+    while writer.elts:
+        EndXmlWriterElt(writer)
+    writer.fhdl.write(writer.encoder.encode("", True))
+
+# ----------------------------------------------------------------------------
+# EndXmlWriterElt(XmlWriter)
+#   Write the end tag of the last begun element.
+
+def EndXmlWriterElt(writer):
+    copyElt = writer.elts.pop(); writer.startLens.pop()
+    writer.fhdl.write(writer.encoder.encode(writer.endStrs.pop()))
+    if writer.elts:
+        writer.elts[-1].remove(copyElt)
+
+# ----------------------------------------------------------------------------
+# ExpireExtMemo()
+#   Drop the memoized results that are only kept for a single run (see
+#   'ExtMemoScopeRun').
+
+def ExpireExtMemo():
+    if CurExtMemoScope == ExtMemoScopeRun:
+        mca.ClearLru(ExtMemo)
+
+# ----------------------------------------------------------------------------
+# FindCatalogPath([mp.Path], str, str or None): mp.Path or None
+#   Find a local file by a URI or a system identifier and a public
+#   identifier in catalogs; None if no catalog has it. Catalog entries that
+#   point to non-local URIs are ignored: this never goes to the network.
+
+def FindCatalogPath(catalogPaths, uriStr, idStr):
+    i = 0; n = len(catalogPaths)
+    while i < n:
+        catalog = mct.GetCatalog(catalogPaths[i]); i += 1
+        foundStr = mct.ResolveCatalogEntity(catalog, uriStr, idStr)
+        if foundStr is None and uriStr:
+            foundStr = mct.ResolveCatalogUri(catalog, uriStr)
+        if foundStr is not None:
+            foundPath = GetUriFilePath(foundStr)
+            if foundPath is not None:
+                return foundPath
+    return None
+
+# ----------------------------------------------------------------------------
+# FindXmlDtdPath(Xml, ReadParam): mp.Path or None
+#   Find the DTD that the XML references: first in the catalogs, by the
+#   SYSTEM and PUBLIC identifiers, then by the SYSTEM identifier in the
+#   resource paths and relatively to the XML. None if the XML has no DTD or
+#   it is not found.
+
+def FindXmlDtdPath(xml, readParam):
+    if not xml.docinfo.internalDTD:
+        return None
+    dtdUrlStr = xml.docinfo.internalDTD.system_url
+    if readParam.catalogs:
+        dtdPath = FindCatalogPath(readParam.catalogs, dtdUrlStr,
+                xml.docinfo.internalDTD.external_id)
+        if dtdPath is not None:
+            return dtdPath
+    if not dtdUrlStr:
+        return None
+    dtdPath = FindResPath(readParam.paths, dtdUrlStr)
+    if dtdPath is None and xml.docinfo.URL:
+        # Try to find the DTD relatively to the XML.
+        # TODO: check if this works; using a stream may not have the URL.
+        xmlPath = mp.MakePath(xml.docinfo.URL)
+        xmlDir = mp.GetParentPath(xmlPath)
+        dtdSubpath = mp.MakeSubpath(xmlDir, *dtdUrlStr.split("/"))
+        if mp.PathIsFile(dtdSubpath):
+            dtdPath = dtdSubpath
+    return dtdPath
+
+# ----------------------------------------------------------------------------
+# FindResPath([mp.Path], str): mp.Path or None
+#   Find a file by a relative URI in resource paths, in their order; None if
+#   not found or if the URI is absolute. The names are looked up in the
+#   listings of the directories, see 'GetResDirNames', so a lookup takes a
+#   stat per directory on the way, whether the file is there or not, and a
+#   file added to an earlier resource path is found next time. URIs with
+#   '.', '..', or empty steps are looked up with a stat per resource path.
+
+def FindResPath(paths, uriStr):
+    if not paths or ":" in uriStr or uriStr.startswith("/"):
+        return None
+    uriStrs = uriStr.split("/")
+    if "" in uriStrs or "." in uriStrs or ".." in uriStrs:
+        i = 0; n = len(paths)
+        while i < n:
+            subpath = mp.MakeSubpath(paths[i], *uriStrs); i += 1
+            if mp.PathIsFile(subpath):
+                return subpath
+        return None
+    i = 0; n = len(paths); m = len(uriStrs)
+    while i < n:
+        dirPathStr = mp.GetPathStr(paths[i]); i += 1
+        j = 0
+        while j < m:
+            names = GetResDirNames(dirPathStr)
+            isDir = None if names is None else names.get(uriStrs[j])
+            if isDir is None:
+                break
+            dirPathStr = pop.join(dirPathStr, uriStrs[j]); j += 1
+            if j == m:
+                if not isDir:
+                    return mp.MakePath(dirPathStr)
+            elif not isDir:
+                break
+    return None
+
 # ----------------------------------------------------------------------------
 # GetAllExts(): [Ext]
 #   Get all extensions (to add to Ctx).
@@ -469,6 +737,39 @@ def GetBuiltinXslt(filename):
     ms.DropStrm(strm)
     return MakeXslt(xml)
 
+# ----------------------------------------------------------------------------
+# GetDtdIdAttrs(Schema): [(str, str)]
+#   Get the ID attributes that a DTD declares as (element name, attribute
+#   name); names have prefixes as in the DTD, e.g. 'p:item'.
+
+def GetDtdIdAttrs(dtd):
+    idAttrs = []
+    for eltDecl in dtd.iterelements():
+        for attrDecl in eltDecl.iterattributes():
+            if attrDecl.type == "id":
+                idAttrs.append((GetDtdName(eltDecl.prefix, eltDecl.name),
+                        GetDtdName(attrDecl.prefix, attrDecl.name)))
+    return idAttrs
+
+# ----------------------------------------------------------------------------
+# GetDtdName(str, str): str
+#   Get a name as it appears in a DTD by a prefix (or None) and local name.
+
+def GetDtdName(pfxStr, localNameStr):
+    if pfxStr:
+        return pfxStr + ":" + localNameStr
+    return localNameStr
+
+# ----------------------------------------------------------------------------
+# GetEltChildElts(Xml(Doc, Elt)): [Xml(Elt)]
+#   Get child elements of an element (or of the document element).
+
+def GetEltChildElts(xml):
+    if GetXmlType(xml) == XmlDoc:
+        xml = xml.getroot()
+    # lxml iterates over elements, comments, and processing instructions.
+    return [child for child in xml if isinstance(child.tag, str)]
+
 # ----------------------------------------------------------------------------
 # GetEltQName(Xml(Elt, Attr)): QName
 #   Get the QName of an element or an attribute.
@@ -489,6 +790,23 @@ def GetEltQName(xml):
         nsUriStr = ""; localNameStr = jcStr
     return GetQName(GetNs(nsUriStr), localNameStr)
 
+# ----------------------------------------------------------------------------
+# GetIdSchema(str, frozenset): Schema
+#   Get a schema made by 'MakeIdSchema' by the tag of the document element
+#   and the tags of the ID attributes. The schemas are cached per thread,
+#   as in 'GetSchema'.
+
+def GetIdSchema(rootTag, attrTags):
+    try:
+        schemas = IdSchemaPool.schemas
+    except AttributeError:
+        schemas = IdSchemaPool.schemas = {}
+    key = (rootTag, attrTags)
+    schema = schemas.get(key)
+    if schema is None:
+        schema = schemas[key] = MakeIdSchema(rootTag, attrTags)
+    return schema
+
 # ----------------------------------------------------------------------------
 # GetNs(Str(Uri)): Ns
 #   Get an Ns by the namespace URI.
@@ -500,6 +818,36 @@ def GetNs(uriStr):
         ns = Ns(); ns.uri = uriStr; ns.qNames = {}; UriStrToNs[uriStr] = ns
     return ns
 
+# ----------------------------------------------------------------------------
+# GetParser(ReadParam): le.XMLParser
+#   Get an XML parser for the ReadParam. Creating a parser is not free and
+#   lxml parsers can be reused, but not shared between threads, so parsers
+#   are pooled per thread and per set of options and resource paths.
+
+def GetParser(readParam):
+    try:
+        parsers = ParserPool.parsers
+    except AttributeError:
+        parsers = ParserPool.parsers = {}
+    key = GetReadParamKey(readParam)
+    try:
+        parser = parsers[key]
+    except KeyError:
+        parser = le.XMLParser(
+                huge_tree=readParam.hugeTree,
+                remove_blank_text=readParam.removeBlankText,
+                resolve_entities=readParam.resolveEntities,
+                no_network=readParam.noNetwork,
+                collect_ids=readParam.collectIds,
+                compact=readParam.compact,
+                load_dtd=readParam.ids == IdIndexDtd)
+        # The resolver gets its own copy of paths: the parser outlives the
+        # ReadParam.
+        parser.resolvers.add(Resolver(list(readParam.paths),
+                list(readParam.catalogs)))
+        parsers[key] = parser
+    return parser
+
 # ----------------------------------------------------------------------------
 # GetPkgRes(str): bytes
 #   Get a package resource.
@@ -530,6 +878,92 @@ def GetQName(ns, localNameStr):
         ns.qNames[localNameStr] = qName
     return qName
 
+# ----------------------------------------------------------------------------
+# GetReadParamKey(ReadParam): tuple
+#   Get a hashable key that tells ReadParams apart: two ReadParams with the
+#   same key read the same data the same way.
+
+def GetReadParamKey(readParam):
+    return (readParam.hugeTree, readParam.removeBlankText,
+            readParam.resolveEntities, readParam.noNetwork,
+            readParam.collectIds, readParam.compact,
+            tuple([mp.GetPathStr(path) for path in readParam.paths]),
+            tuple(readParam.selects), readParam.ancestors, readParam.limit,
+            readParam.ids, tuple(readParam.idAttrs),
+            tuple([mp.GetPathStr(path) for path in readParam.catalogs]))
+
+# ----------------------------------------------------------------------------
+# GetResDirNames(str): {str:bool} or None
+#   Get the files and directories in a resource directory, whether each is a
+#   directory by name; None if it's not a directory. The listing is kept in
+#   'ResDirs' and used while the mtime of the directory stays the same;
+#   a directory modified less than 'ResDirRacyTime' seconds ago is listed,
+#   but not kept: a change in the same tick of the clock would keep the
+#   mtime.
+
+def GetResDirNames(dirPathStr):
+    poStat = mp.GetPathStat(mp.MakePath(dirPathStr)).poStat
+    if poStat is None or not pst.S_ISDIR(poStat.st_mode):
+        ResDirs.pop(dirPathStr, None)
+        return None
+    resDir = ResDirs.get(dirPathStr)
+    if resDir is not None and resDir[0] == poStat.st_mtime:
+        names = resDir[1]
+        md.RecordDirDep(dirPathStr, names)
+        return names
+    names = {}
+    entries = mp.ListDirEntries(mp.MakePath(dirPathStr))
+    i = 0; n = len(entries)
+    while i < n:
+        entry = entries[i]; i += 1
+        if entry.is_dir():
+            names[entry.name] = True
+        elif entry.is_file():
+            names[entry.name] = False
+    if poStat.st_mtime < pti.time() - ResDirRacyTime:
+        ResDirs[dirPathStr] = (poStat.st_mtime, names)
+    else:
+        ResDirs.pop(dirPathStr, None)
+    return names
+
+# ----------------------------------------------------------------------------
+# GetSchema(mp.Path, SchemaType): Schema
+#   Get a compiled schema. Schemas are compiled once and cached by the real
+#   path and checked by the file mtime and size. lxml validators keep their
+#   error log and cannot be shared between threads, so the cache is per
+#   thread.
+
+def GetSchema(path, schemaType):
+    try:
+        schemas = SchemaPool.schemas
+    except AttributeError:
+        schemas = SchemaPool.schemas = {}
+    poStat = mp.GetPathStat(path).poStat
+    if poStat is None:
+        raise Exception("Cannot find the schema '%s'" % mp.GetPathStr(path))
+    md.RecordDep(md.DepTypeFile, mp.GetPathStr(path))
+    key = (mp.GetPathXfrm(path), schemaType)
+    stamp = (poStat.st_mtime, poStat.st_size)
+    cached = schemas.get(key)
+    if cached is not None and cached[0] == stamp:
+        schema = cached[1]
+    else:
+        schema = MakeSchema(path, schemaType)
+        schemas[key] = (stamp, schema)
+    return schema
+
+# ----------------------------------------------------------------------------
+# GetSchemaType(mp.Path): SchemaType
+#   Get the schema type by the file name extension: '.dtd', '.xsd', '.rng'.
+
+def GetSchemaType(path):
+    try:
+        schemaType = SchemaTypes[mp.GetPathExt(path).lower()]
+    except KeyError:
+        raise Exception("Unknown schema type of '%s'; expected a '.dtd', "
+                "'.xsd', or '.rng' file" % mp.GetPathStr(path))
+    return schemaType
+
 # ----------------------------------------------------------------------------
 # GetSCfgOfXml(Xml(Doc)): SCfg
 #   Get the SCfg of an Xml(Doc).
@@ -653,6 +1087,53 @@ def GetSCfgOfXslt(xslt):
             sCfg.ver = version
     return sCfg
 
+# ----------------------------------------------------------------------------
+# GetUriFilePath(str): mp.Path or None
+#   Get the path of an absolute URI of a local file, with or without the
+#   'file://' scheme; None if it's not such URI or the file does not exist.
+
+def GetUriFilePath(uriStr):
+    if uriStr.startswith("file://"):
+        uriStr = mc.UnquoteUriStr(uriStr[7:])
+    if not pop.isabs(uriStr):
+        return None
+    path = mp.MakePath(uriStr)
+    if not mp.PathIsFile(path):
+        return None
+    return path
+
+# ----------------------------------------------------------------------------
+# GetXArgAsInt(XArg): int
+#   Get the XArg as an integer: a number, or a string or a node whose text
+#   is one.
+
+def GetXArgAsInt(xArg):
+    if GetXArgType(xArg) == XArgNum:
+        if xArg != xArg or xArg in (float("inf"), float("-inf")):
+            raise Exception("Expected an integer, got '%s'" % xArg)
+        return int(xArg)
+    str_ = GetXArgAsStr(xArg)
+    try:
+        return int(str_.strip())
+    except ValueError:
+        raise Exception("Expected an integer, got '%s'" % str_)
+
+# ----------------------------------------------------------------------------
+# GetXArgAsOpts(XArg): [(str, str)]
+#   Get the XArg as a list of options, name and value. The XArg is either a
+#   string in the 'ParseOptStr' format or a single element whose attributes
+#   are options, e.g. 'huge-tree remove-blank-text=yes' or
+#   '<opts huge-tree="yes" remove-blank-text="yes"/>'.
+
+def GetXArgAsOpts(xArg):
+    xArgType = GetXArgType(xArg)
+    if xArgType == XArgNSet and len(xArg) == 1 \
+            and GetXmlType(xArg[0]) == XmlElt:
+        opts = list(xArg[0].attrib.items())
+    else:
+        opts = ParseOptStr(GetXArgAsStr(xArg))
+    return opts
+
 # ----------------------------------------------------------------------------
 # GetXArgAsPath(XArg): mp.Path
 #   Get XArg as path.
@@ -683,6 +1164,46 @@ def GetXArgAsStr(xArg):
             raise Exception("Cannot convert XmlType %d to string." % xArgType)
     return result
 
+# ----------------------------------------------------------------------------
+# GetXArgKey(XArg): tuple
+#   Get a hashable key of an XPath extension argument, see 'ExtMemo'. Nodes
+#   are compared by their serialized XML, strings by their text, so equal
+#   arguments give equal keys no matter where they come from.
+
+def GetXArgKey(xArg):
+    if isinstance(xArg, list):
+        nodeKeys = []; i = 0; n = len(xArg)
+        while i < n:
+            node = xArg[i]; i += 1
+            if isinstance(node, le._Element):
+                nodeKeys.append(le.tostring(node, with_tail=False))
+            else:
+                nodeKeys.append((GetXmlType(node), mc.GetAsText(node)))
+        result = (XArgNSet, tuple(nodeKeys))
+    elif isinstance(xArg, bool):
+        result = (XArgBool, xArg)
+    elif isinstance(xArg, float):
+        result = (XArgNum, xArg)
+    else:
+        result = (XArgStr, mc.GetAsText(xArg))
+    return result
+
+# ----------------------------------------------------------------------------
+# GetXArgSizeApprox(XArg): int
+#   Get the approximate size of an XPath extension argument or result in
+#   memory: the length of serialized nodes and of other values as text.
+
+def GetXArgSizeApprox(xArg):
+    if isinstance(xArg, list):
+        size = 0; i = 0; n = len(xArg)
+        while i < n:
+            size += GetXArgSizeApprox(xArg[i]); i += 1
+    elif isinstance(xArg, le._Element):
+        size = len(le.tostring(xArg, with_tail=False))
+    else:
+        size = len(mc.GetAsText(xArg))
+    return size
+
 # ----------------------------------------------------------------------------
 # GetXArgType(XArg): XArgType
 #   Get the type of an argument passed to an XPath function.
@@ -698,6 +1219,18 @@ def GetXArgType(arg):
         result = XArgStr
     return result
 
+# ----------------------------------------------------------------------------
+# GetXmlDclStr(str or None): str
+#   Get the XML declaration and the line break after it, as 'WriteXml'
+#   writes them in this encoding.
+
+def GetXmlDclStr(encStr):
+    fhdl = mc.MakeOFhdlInMem()
+    le.Element("x").getroottree().write(fhdl, encoding=encStr,
+            xml_declaration=True)
+    dclStr = fhdl.getvalue().decode(encStr or "ascii")
+    return dclStr[:dclStr.index("?>") + 2] + "\n"
+
 # ----------------------------------------------------------------------------
 # GetXmlEnc(Xml): str or None
 #   Get encoding that is inherent to this XML.
@@ -734,6 +1267,54 @@ def GetXmlType(xml):
         raise Exception("Unexpected XML object type %s" % type(xml).__name__)
     return result
 
+# ----------------------------------------------------------------------------
+# GetXmlWriterEltStr(XmlWriter, Xml(Elt)): str
+#   Serialize an element inside the open elements of an XmlWriter, i.e.
+#   without the namespace declarations they already have. An element that
+#   is a part of another tree is copied first.
+
+def GetXmlWriterEltStr(writer, elt):
+    if not writer.elts:
+        return le.tostring(elt, encoding="unicode", with_tail=False)
+    if elt.getparent() is not None:
+        elt = pcp.deepcopy(elt)
+    parentElt = writer.elts[-1]
+    parentElt.append(elt)
+    try:
+        str_ = le.tostring(parentElt, encoding="unicode",
+                with_tail=False)
+    finally:
+        parentElt.remove(elt)
+    return str_[writer.startLens[-1]:len(str_) - len(writer.endStrs[-1])]
+
+# ----------------------------------------------------------------------------
+# IndexXmlIds(Xml, [str])
+#   Build the ID table of an XML without validating it against its own DTD.
+#   The ID attributes are given by name, with a prefix as declared on the
+#   document element, e.g. 'id' or 'p:key', and are IDs on any element.
+#   lxml has no way to add IDs directly and validation against a DTD adds
+#   them, but a DTD has to declare every element and attribute: lxml makes
+#   each validation error with the path of the node and on large documents
+#   the errors cost more than the full validation. XML Schema validation
+#   adds IDs as well, and a schema that declares only the document element
+#   with any content and the ID attributes as global attributes is valid for
+#   any XML with that document element; see 'MakeIdSchema'.
+
+def IndexXmlIds(xml, attrNames):
+    root = xml.getroot()
+    attrTags = set()
+    for attrName in attrNames:
+        pfxStr, _, localNameStr = attrName.rpartition(":")
+        if not pfxStr:
+            attrTags.add(localNameStr)
+        elif pfxStr != "xml" and pfxStr in root.nsmap:
+            # 'xml:id' is indexed by the parser.
+            attrTags.add("{%s}%s" % (root.nsmap[pfxStr], localNameStr))
+    if attrTags:
+        # The result does not matter: invalid or duplicate IDs are reported,
+        # but the valid ones are still added.
+        GetIdSchema(root.tag, frozenset(attrTags)).validate(xml)
+
 # ----------------------------------------------------------------------------
 # Insert(Xml(Elt), Xml(Elt, Pi, Cmnt), int)
 #    Insert child XML node.
@@ -762,7 +1343,7 @@ def MakeCtx():
     ctx.nsPfxs = []
     ctx.exts = []
     ctx.parser = le.XMLParser(dtd_validation=True)
-    ctx.parser.resolvers.add(Resolver(ctx))
+    ctx.parser.resolvers.add(Resolver(ctx.paths, []))
     return ctx
 
 # ----------------------------------------------------------------------------
@@ -788,11 +1369,80 @@ def MakeExt(qName, extType, func):
         # else, like '__init__()' or that this may be of any use, in Maxe we
         # just register a function and create a temporary class and instance
         # on the fly.
-        xsltExtSubclass = type("Ext", (le.XSLTExtension,), execute=func)
+        xsltExtSubclass = type("Ext", (le.XSLTExtension,),
+                {"execute": func})
         func = xsltExtSubclass()
+    elif extType == ExtFuncPure:
+        func = MakeExtFuncPure(qName, func)
     ext.func = func
     return ext
 
+# ----------------------------------------------------------------------------
+# MakeExtFuncPure(QName, func): func
+#   Wrap an ExtFuncPure function to memoize its results by its arguments.
+#   The XPath context is not a part of the key; a pure function must not
+#   depend on it, nor on the file system. Nodes of memoized results are
+#   copied on each return, see 'CopyXArg'.
+
+def MakeExtFuncPure(qName, func):
+    def CallExtFuncPure(leCtx, *xArgs):
+        if CurExtMemoScope == ExtMemoScopeOff:
+            return func(leCtx, *xArgs)
+        xArgKeys = []; i = 0; n = len(xArgs)
+        while i < n:
+            xArgKeys.append(GetXArgKey(xArgs[i])); i += 1
+        key = (qName, tuple(xArgKeys))
+        result = mca.GetLruVal(ExtMemo, key)
+        if result is None:
+            result = func(leCtx, *xArgs)
+            mca.PutLruVal(ExtMemo, key, result,
+                    len(repr(key)) + GetXArgSizeApprox(result))
+        return CopyXArg(result)
+    return CallExtFuncPure
+
+# ----------------------------------------------------------------------------
+# MakeIdSchema(str, frozenset): Schema
+#   Make an XML Schema to add IDs, see 'IndexXmlIds': it declares the
+#   document element with mixed content of any elements and any attributes,
+#   both validated if there is a declaration, and the ID attributes as
+#   global attributes of the type 'xs:ID'. A schema has one target
+#   namespace, so there is a schema document per namespace; the first one
+#   imports the rest through 'IdSchemaResolver'.
+
+def MakeIdSchema(rootTag, attrTags):
+    rootQName = le.QName(rootTag)
+    docs = {rootQName.namespace: le.Element(XsdTags["schema"], nsmap=XsdNsMap)}
+    for attrTag in sorted(attrTags):
+        attrQName = le.QName(attrTag)
+        doc = docs.get(attrQName.namespace)
+        if doc is None:
+            doc = docs[attrQName.namespace] = le.Element(XsdTags["schema"],
+                    nsmap=XsdNsMap)
+        le.SubElement(doc, XsdTags["attribute"], name=attrQName.localname,
+                type="xs:ID")
+    datas = {}
+    rootDoc = docs.pop(rootQName.namespace)
+    for uriStr in sorted(docs, key=str):
+        urlStr = "maxe-ids:%d" % len(datas)
+        importElt = le.Element(XsdTags["import"], schemaLocation=urlStr)
+        if uriStr is not None:
+            docs[uriStr].set("targetNamespace", uriStr)
+            importElt.set("namespace", uriStr)
+        rootDoc.insert(len(datas), importElt)
+        datas[urlStr] = le.tostring(docs[uriStr])
+    if rootQName.namespace is not None:
+        rootDoc.set("targetNamespace", rootQName.namespace)
+    typeElt = le.SubElement(le.SubElement(rootDoc, XsdTags["element"],
+            name=rootQName.localname), XsdTags["complexType"], mixed="true")
+    le.SubElement(le.SubElement(typeElt, XsdTags["sequence"]),
+            XsdTags["any"], processContents="lax", minOccurs="0",
+            maxOccurs="unbounded")
+    le.SubElement(typeElt, XsdTags["anyAttribute"], processContents="lax")
+    parser = le.XMLParser()
+    parser.resolvers.add(IdSchemaResolver(datas))
+    return le.XMLSchema(le.fromstring(le.tostring(rootDoc), parser,
+            base_url="maxe-ids:root"))
+
 # ----------------------------------------------------------------------------
 # MakeReadParam(): ReadParam
 #   Make a ReadParam.
@@ -800,6 +1450,18 @@ def MakeExt(qName, extType, func):
 def MakeReadParam():
     readParam = ReadParam()
     readParam.paths = []
+    readParam.hugeTree = False
+    readParam.removeBlankText = False
+    readParam.resolveEntities = True
+    readParam.noNetwork = True
+    readParam.collectIds = True
+    readParam.compact = True
+    readParam.selects = []
+    readParam.ancestors = False
+    readParam.limit = None
+    readParam.ids = IdIndexValidate
+    readParam.idAttrs = []
+    readParam.catalogs = []
     return readParam
 
 # ----------------------------------------------------------------------------
@@ -827,6 +1489,20 @@ def MakeSCfg():
     sCfg.ver    = "1.0"
     return sCfg
 
+# ----------------------------------------------------------------------------
+# MakeSchema(mp.Path, SchemaType): Schema
+#   Compile a schema; see 'GetSchema' for the cached version.
+
+def MakeSchema(path, schemaType):
+    pathStr = mp.GetPathStr(path)
+    if schemaType == SchemaTypeDtd:
+        schema = le.DTD(pathStr)
+    elif schemaType == SchemaTypeXsd:
+        schema = le.XMLSchema(le.parse(pathStr))
+    else: # SchemaTypeRng
+        schema = le.RelaxNG(le.parse(pathStr))
+    return schema
+
 # ----------------------------------------------------------------------------
 # MakeXslt(Xml): Xslt
 #   Make an XSLT.
@@ -848,12 +1524,129 @@ def MakeXsltParams():
     xsltParams = XsltParams()
     xsltParams.params = {}
     return xsltParams
+
+# ----------------------------------------------------------------------------
+# MakeXmlWriter(Strm, SCfg): XmlWriter
+#   Make an incremental XML writer. Only the XML method is supported.
+
+def MakeXmlWriter(strm, sCfg):
+    if sCfg.mtd != "xml":
+        raise Exception("Cannot write method '%s' incrementally" % sCfg.mtd)
+    writer = XmlWriter()
+    writer.fhdl = strm.fhdl
+    writer.encoder = pcd.getincrementalencoder(sCfg.enc or "ascii")(
+            "xmlcharrefreplace")
+    writer.elts = []
+    writer.startLens = []
+    writer.endStrs = []
+    if sCfg.dcl:
+        writer.fhdl.write(writer.encoder.encode(GetXmlDclStr(sCfg.enc)))
+    return writer
+
+# ----------------------------------------------------------------------------
+# GetProjCopy({le.Element:le.Element}, le.Element): le.Element
+#   Get a shallow copy of an ancestor of a projected subtree, see
+#   'ReadXmlProj'. Create copies of the element and its ancestors if needed.
+
+def GetProjCopy(copies, elt):
+    try:
+        eltCopy = copies[elt]
+    except KeyError:
+        parentCopy = GetProjCopy(copies, elt.getparent())
+        eltCopy = le.SubElement(parentCopy, elt.tag, dict(elt.attrib),
+                elt.nsmap)
+        copies[elt] = eltCopy
+    return eltCopy
+
+# ----------------------------------------------------------------------------
+# ParseOptStr(str): [(str, str)]
+#   Parse options from a string: whitespace-separated 'name' or 'name=value'
+#   items. A name without a value gets the value None.
+
+def ParseOptStr(optStr):
+    opts = []; items = optStr.split(); i = 0; n = len(items)
+    while i < n:
+        item = items[i]; i += 1
+        nameStr, eq, valStr = item.partition("=")
+        if not eq:
+            valStr = None
+        opts.append((nameStr, valStr))
+    return opts
+
+# ----------------------------------------------------------------------------
+# ParseXml(Strm, ReadParam): Xml
+#   Parse XML as is; unlike 'ReadXml' do not validate it.
+
+def ParseXml(strm, readParam):
+    return le.parse(strm.fhdl, GetParser(readParam))
+
+# ----------------------------------------------------------------------------
+# ParseProjPathStr(str): [(bool, [str])]
+#   Parse a projection path (see 'ReadXmlProj') into alternatives: whether
+#   the alternative matches from the root and its steps.
+
+def ParseProjPathStr(pathStr):
+    projPaths = []; altStrs = pathStr.split("|"); i = 0; n = len(altStrs)
+    while i < n:
+        altStr = altStrs[i].strip(); i += 1
+        isAbs = altStr.startswith("/")
+        steps = [step for step in altStr.strip("/").split("/") if step]
+        if not steps:
+            raise Exception("Empty projection path in '%s'" % pathStr)
+        projPaths.append((isAbs, steps))
+    return projPaths
+
+# ----------------------------------------------------------------------------
+# ProjPathsMatch([(bool, [str])], [str]): bool
+#   Test if the tags of open elements, outermost first, match any of the
+#   projection paths.
+
+def ProjPathsMatch(projPaths, tags):
+    i = 0; n = len(projPaths); tagCount = len(tags)
+    while i < n:
+        isAbs, steps = projPaths[i]; i += 1
+        stepCount = len(steps)
+        if stepCount > tagCount or isAbs and stepCount != tagCount:
+            continue
+        j = 1
+        while j <= stepCount:
+            step = steps[-j]; tag = tags[-j]; j += 1
+            if step != "*" and step != tag and \
+                    step != tag.rpartition("}")[2]:
+                break
+        else:
+            return True
+    return False
+
+# ----------------------------------------------------------------------------
+# ReadResData(mp.Path): bytes or None
+#   Read the data of a resource file through 'ResDataCache'; the data is
+#   read again if the file mtime or size change. None if the file is gone.
+
+def ReadResData(path):
+    poStat = mp.GetPathStat(path).poStat
+    if poStat is None:
+        return None
+    md.RecordDep(md.DepTypeFile, mp.GetPathStr(path))
+    key = (mp.GetPathStr(path), poStat.st_mtime, poStat.st_size)
+    data = mca.GetLruVal(ResDataCache, key)
+    if data is None:
+        strm = ms.MakeIStrmFromPath(path)
+        try:
+            data = strm.fhdl.read()
+        finally:
+            ms.DropStrm(strm)
+        mca.PutLruVal(ResDataCache, key, data, len(data))
+    return data
+
 # ----------------------------------------------------------------------------
 # ReadXml(Strm, ReadParam): Xml
 #   Read XML.
 
 def ReadXml(strm, readParam):
-    xml = le.parse(strm.fhdl)
+    if readParam.selects:
+        return ReadXmlProj(strm, readParam)
+    xml = ParseXml(strm, readParam)
     # Test if XML references a DTD and if yes, validate it to make the 'id()'
     # function in XSLT work. The 'dtd_validation' parameter for 'parse()' is
     # not a good fit, because it errs if the document has no DTD to begin
@@ -870,30 +1663,95 @@ def ReadXml(strm, readParam):
 
     # TODO: test how a partial DTD works, try to find out when 'externalDTD'
     # gets set, test what happens if a DTD includes other DTDs. 
-    # TODO: think how to use catalogs.
-    if xml.docinfo.internalDTD:
-        dtdPathStrs = xml.docinfo.internalDTD.system_url.split("/")
-        # Search for the DTD.
-        i = 0; n = len(readParam.paths); dtd = None
-        while i < n:
-            path = readParam.paths[i]; i += 1
-            dtdSubpath = mp.MakeSubpath(path, *dtdPathStrs)
-            if mp.PathExists(dtdSubpath) and mp.PathIsFile(dtdSubpath):
-                dtd = le.DTD(mp.GetPathStr(dtdSubpath))
-                break
-        else:
-            # Try to find the DTD relatively to the XML.
-            # TODO: check if this works; using a stream may not have the URL.
-            xmlPath = mp.MakePath(xml.docinfo.URL)
-            xmlDir = mp.GetParentPath(xmlPath)
-            dtdSubpath = mp.MakeSubpath(xmlDir, *dtdPathStrs)
-            if mp.PathExists(dtdSubpath) and mp.PathIsFile(dtdSubpath):
-                dtd = le.DTD(mp.GetPathStr(dtdSubpath))
-        if dtd is not None:
-            dtd.validate(xml)
-        # TODO: warn or err if the DTD is not found.
+
+    # Validation checks the content model as well and on large documents
+    # this costs more than parsing. If only 'id()' matters, 'ids' tells to
+    # skip it: with IdIndexDtd the parser loads the DTD itself (through the
+    # Resolver, so the DTD data is cached) and adds the IDs as it parses;
+    # with IdIndexAttrs the IDs are the attributes listed in 'idAttrs'.
+    if readParam.ids == IdIndexValidate:
+        dtdPath = FindXmlDtdPath(xml, readParam)
+        if dtdPath is not None:
+            GetSchema(dtdPath, SchemaTypeDtd).validate(xml)
+    elif readParam.ids == IdIndexDtd:
+        if xml.docinfo.externalDTD is None:
+            # The parser did not find the DTD; it may be relative to the XML
+            # that was read from a stream.
+            dtdPath = FindXmlDtdPath(xml, readParam)
+            if dtdPath is not None:
+                IndexXmlIds(xml, [attrName for _, attrName in GetDtdIdAttrs(
+                        GetSchema(dtdPath, SchemaTypeDtd))])
+    elif readParam.ids == IdIndexAttrs:
+        IndexXmlIds(xml, readParam.idAttrs)
+    # TODO: warn or err if the DTD is not found.
     return xml
 
+# ----------------------------------------------------------------------------
+# ReadXmlProj(Strm, ReadParam): Xml
+#   Read a projection of XML: only the subtrees that match 'selects', and,
+#   if 'ancestors' is set, shallow copies of their ancestors. The document is
+#   parsed incrementally; everything else is discarded as soon as it's parsed
+#   and parsing stops after 'limit' subtrees. The result is a document with a
+#   shallow copy of the original root element that contains the subtrees.
+#
+#   A projection path is a '|'-separated list of alternatives; each is a
+#   '/'-separated list of steps. A path that starts with '/' matches from the
+#   root, else it matches at any depth. A step is a local name, a name in
+#   James Clark notation, or '*'. E.g.: 'title', 'head/meta|body/h1',
+#   '/doc/*/title'.
+#
+#   lxml cannot parse incrementally with a given parser, so the parser has
+#   the options of 'GetParser' and a Resolver of its own: entities and the
+#   DTD are resolved as in a full read.
+
+def ReadXmlProj(strm, readParam):
+    projPaths = []; i = 0; n = len(readParam.selects)
+    while i < n:
+        projPaths.extend(ParseProjPathStr(readParam.selects[i])); i += 1
+    leEvts = le.iterparse(strm.fhdl, events=("start", "end"),
+            huge_tree=readParam.hugeTree,
+            remove_blank_text=readParam.removeBlankText,
+            resolve_entities=readParam.resolveEntities,
+            no_network=readParam.noNetwork,
+            collect_ids=readParam.collectIds,
+            compact=readParam.compact,
+            load_dtd=readParam.ids == IdIndexDtd)
+    leEvts.resolvers.add(Resolver(list(readParam.paths),
+            list(readParam.catalogs)))
+    # tags: tags of open elements; projElt: the subtree being kept, if any;
+    # copies: ancestor copies, {le.Element:le.Element}.
+    tags = []; projElt = None; resElt = None; copies = {}; count = 0
+    for leEvt, elt in leEvts:
+        if leEvt == "start":
+            tags.append(elt.tag)
+            if resElt is None:
+                resElt = le.Element(elt.tag, dict(elt.attrib), elt.nsmap)
+                copies[elt] = resElt
+            if projElt is None and ProjPathsMatch(projPaths, tags):
+                projElt = elt
+            continue
+        tags.pop()
+        if elt is projElt:
+            if readParam.ancestors:
+                parentElt = GetProjCopy(copies, elt.getparent())
+            else:
+                parentElt = resElt
+            eltCopy = pcp.deepcopy(elt); eltCopy.tail = None
+            parentElt.append(eltCopy)
+            projElt = None; count += 1
+        elif projElt is not None:
+            # Inside a kept subtree.
+            continue
+        # Discard the parsed element and its preceding siblings.
+        elt.clear()
+        parentElt = elt.getparent()
+        if parentElt is not None:
+            while elt.getprevious() is not None:
+                del parentElt[0]
+        if readParam.limit is not None and count >= readParam.limit:
+            break
+    return resElt.getroottree()
+
 # ----------------------------------------------------------------------------
 # RegExts(str, str, ExtType, func, str, ExtType, func...)
 #   Register XPath and XSLT extensions. The function takes the namespace URI
@@ -913,6 +1771,74 @@ def RegExts(uriStr, *args):
                     (localNameStr, uriStr))
         Exts[qName] = MakeExt(qName, extType, func)
 
+# ----------------------------------------------------------------------------
+# SetExtMemoScope(ExtMemoScope)
+#   Set how long memoized results of ExtFuncPure extensions are kept; this
+#   drops the results memoized so far.
+
+def SetExtMemoScope(scope):
+    global CurExtMemoScope
+    CurExtMemoScope = scope
+    mca.ClearLru(ExtMemo)
+
+# ----------------------------------------------------------------------------
+# SetReadParamOpt(ReadParam, str, str)
+#   Set a ReadParam option by name. For options in 'ReadParamOpts' the value
+#   is 'yes', 'no', or None that means 'yes'. 'select' adds a projection path
+#   and may repeat, 'catalog' adds a catalog file and may repeat, 'limit'
+#   takes a number, 'ids' takes a name from 'IdIndexNames', 'id-attrs' takes
+#   comma-separated attribute names and implies 'ids=attrs'.
+
+def SetReadParamOpt(readParam, nameStr, valStr):
+    if nameStr == "select":
+        if not valStr:
+            raise Exception("Expected a path for the XML reading option "
+                    "'select'")
+        readParam.selects.append(valStr)
+        return
+    if nameStr == "limit":
+        try:
+            limit = int(valStr)
+        except (TypeError, ValueError):
+            limit = 0
+        if limit < 1:
+            raise Exception("Expected a positive number for the XML reading "
+                    "option 'limit'")
+        readParam.limit = limit
+        return
+    if nameStr == "catalog":
+        if not valStr:
+            raise Exception("Expected a path for the XML reading option "
+                    "'catalog'")
+        AddCatalogToReadParam(readParam, mp.MakePath(valStr))
+        return
+    if nameStr == "ids":
+        try:
+            readParam.ids = IdIndexNames[valStr]
+        except KeyError:
+            raise Exception("Expected one of %s for the XML reading option "
+                    "'ids'" % ", ".join(sorted(IdIndexNames)))
+        return
+    if nameStr == "id-attrs":
+        if not valStr:
+            raise Exception("Expected attribute names for the XML reading "
+                    "option 'id-attrs'")
+        readParam.idAttrs = valStr.split(",")
+        readParam.ids = IdIndexAttrs
+        return
+    try:
+        attrName = ReadParamOpts[nameStr]
+    except KeyError:
+        raise Exception("Unknown XML reading option '%s'" % nameStr)
+    if valStr is None or valStr == "yes":
+        val = True
+    elif valStr == "no":
+        val = False
+    else:
+        raise Exception("Expected 'yes' or 'no' for the XML reading option "
+                "'%s'" % nameStr)
+    setattr(readParam, attrName, val)
+
 # ----------------------------------------------------------------------------
 # SetAttr(xml, QName, str)
 #   Set XML element attribute.
@@ -920,6 +1846,17 @@ def RegExts(uriStr, *args):
 def SetAttr(xml, qName, strVal):
     xml.set(qName.jcStr, strVal)
 
+# ----------------------------------------------------------------------------
+# ValidateXml(Xml, Schema): [le._LogEntry]
+#   Validate XML against a schema; get validation errors.
+
+def ValidateXml(xml, schema):
+    if schema.validate(xml):
+        errors = []
+    else:
+        errors = list(schema.error_log)
+    return errors
+
 # ---------------------------------------------------------------------------
 # WriteXml(Strm, Xml, SCfg)
 #   Write XML to stream according to serialization settings.
@@ -983,58 +1920,190 @@ def WriteXml(strm, xml, sCfg):
     tElt = le.Element("tmp"); tDoc = tElt.getroottree(); tDoc._setroot(elt)
     tDoc.write(strm.fhdl, encoding=leEnc, method=leMtd, xml_declaration=leDcl)
 
+# ----------------------------------------------------------------------------
+# WriteXmlWriterElt(XmlWriter, Xml(Elt))
+#   Write a complete element.
+
+def WriteXmlWriterElt(writer, elt):
+    writer.fhdl.write(writer.encoder.encode(GetXmlWriterEltStr(writer, elt)))
+
 # CODE =======================================================================
 
-import re          as pr # to parse QNames in James Clark notation.
-import pkgutil     as pp # load package resources
+import codecs      as pcd # incremental encoders
+import copy        as pcp # copy projected subtrees and memoized results
+import os.path     as pop # isabs
+import re          as pr  # to parse QNames in James Clark notation.
+import pkgutil     as pp  # load package resources
+import stat        as pst # S_ISDIR
+import threading   as pth # per-thread parser pools
+import time        as pti # time
 
 import lxml.etree  as le # core backend
 
-import maxe.compat as mc # GetDictVals
-import maxe.path   as mp # paths
-import maxe.strm   as ms # streams
+import maxe.cache   as mca # caches
+import maxe.catalog as mct # XML catalogs
+import maxe.compat  as mc  # GetDictVals
+import maxe.dep     as md  # record dependencies served from caches
+import maxe.path    as mp  # paths
+import maxe.strm    as ms  # streams
+
+# ----------------------------------------------------------------------------
+# IdSchemaResolver
+#   Adapter to resolve the schema documents that 'MakeIdSchema' imports;
+#   'datas' maps their URLs to data, {str:bytes}.
+
+class IdSchemaResolver(le.Resolver):
+    def __init__(self, datas):
+        self.datas = datas
+    def resolve(self, urlStr, idStr, leCtx):
+        data = self.datas.get(urlStr)
+        if data is None:
+            return None
+        return self.resolve_string(data, leCtx)
 
 # ----------------------------------------------------------------------------
 # Resolver
 #   Adapter to resolve URIs for lxml.etree.XMLParser.
 
+#   URIs are looked up in catalogs, see 'FindCatalogPath', then relative
+#   URIs in resource paths, see 'FindResPath'. Local files are returned from
+#   'ResDataCache': lxml does not let a resolver return a parsed document,
+#   but this saves reading the same lookup tables of 'document()' and DTDs
+#   again in each transform.
+
 class Resolver(le.Resolver):
-    def __init__(self, ctx):
-        self.ctx = ctx
+    def __init__(self, paths, catalogs):
+        self.paths = paths
+        self.catalogs = catalogs
     def resolve(self, uriStr, idStr, leCtx):
-        i = 0; n = len(self.ctx.paths); foundPath = None
-        while i < n:
-            subpath = mp.MakeSubpath(self.ctx.paths[i], uriStr.split("/"))
-            if mp.PathExists(subpath):
-                foundPath = subpath
-                break
-            i += 1
-        if foundPath:
-            leResult = self.resolve_filename(mp.GetPathStr(foundPath))
+        foundPath = None
+        if self.catalogs:
+            foundPath = FindCatalogPath(self.catalogs, uriStr, idStr)
+        if foundPath is None:
+            foundPath = FindResPath(self.paths, uriStr)
+        if foundPath is None:
+            foundPath = GetUriFilePath(uriStr)
+        data = None if foundPath is None else ReadResData(foundPath)
+        if data is not None:
+            leResult = self.resolve_string(data, leCtx,
+                    base_url=mp.GetPathStr(foundPath))
         else:
             leResult = None # causes lxml to try the next resolver
         return leResult
 
+# ----------------------------------------------------------------------------
+# CurExtMemoScope: the current ExtMemoScope, see 'SetExtMemoScope'.
+
+CurExtMemoScope = ExtMemoScopeRun
+
 # ----------------------------------------------------------------------------
 # DefaultCtx: the default Ctx.
 # TODO: consider to remove.
 
 DefaultCtx = MakeCtx()
 
+# ----------------------------------------------------------------------------
+# ExtMemo: memoized results of ExtFuncPure extensions by the extension QName
+# and argument keys, (QName, tuple):XArg. See 'MakeExtFuncPure'. The budget
+# is in approximate bytes, see 'GetXArgSizeApprox'.
+
+ExtMemo = mca.MakeLru(64 << 20)
+
 # ----------------------------------------------------------------------------
 # Exts: Registered XPath and XSLT extensions, {QName:Ext}.
 Exts = {}
 
+# ----------------------------------------------------------------------------
+# IdIndexNames: IdIndex by name, {str:IdIndex}. See 'SetReadParamOpt'.
+
+IdIndexNames = {
+    "validate": IdIndexValidate,
+    "dtd"     : IdIndexDtd,
+    "attrs"   : IdIndexAttrs,
+    "none"    : IdIndexNone}
+
+# ----------------------------------------------------------------------------
+# IdSchemaPool: per-thread caches of schemas made by 'MakeIdSchema', '.schemas'
+# is {(str, frozenset):Schema}. See 'GetIdSchema'.
+
+IdSchemaPool = pth.local()
+
 # ----------------------------------------------------------------------------
 # JcRegEx: a regular expression to read strings in James Clark notation.
 
 JcRegEx = pr.compile("^\{([^\}]*)\}(.+)")
 
+# ----------------------------------------------------------------------------
+# ParserPool: per-thread pools of parsers, '.parsers' is
+# {GetReadParamKey(ReadParam):le.XMLParser}. See 'GetParser'.
+
+ParserPool = pth.local()
+
+# ----------------------------------------------------------------------------
+# ReadParamOpts: ReadParam options by name, {str:str}. See 'SetReadParamOpt'.
+
+ReadParamOpts = {
+    "huge-tree"        : "hugeTree",
+    "remove-blank-text": "removeBlankText",
+    "resolve-entities" : "resolveEntities",
+    "no-network"       : "noNetwork",
+    "collect-ids"      : "collectIds",
+    "compact"          : "compact",
+    "ancestors"        : "ancestors"}
+
+# ----------------------------------------------------------------------------
+# ResDataCache: data of resource files found by 'Resolver', see
+# 'ReadResData'. Lives as long as the process.
+
+ResDataCache = mca.MakeLru(16 << 20)
+
+# ----------------------------------------------------------------------------
+# ResDirs: listings of resource directories by their paths: the mtime and
+# whether each name is a directory, {str:(float, {str:bool})}. See
+# 'GetResDirNames'. ResDirRacyTime: directories modified less than this
+# many seconds ago are not kept.
+
+ResDirs = {}
+ResDirRacyTime = 2.0
+
+# ----------------------------------------------------------------------------
+# SchemaPool: per-thread caches of compiled schemas, '.schemas' is
+# {(str, SchemaType):((mtime, size), Schema)}. See 'GetSchema'.
+
+SchemaPool = pth.local()
+
+# ----------------------------------------------------------------------------
+# SchemaTypes: schema types by file name extension, {str:SchemaType}.
+
+SchemaTypes = {
+    ".dtd": SchemaTypeDtd,
+    ".xsd": SchemaTypeXsd,
+    ".rng": SchemaTypeRng}
+
 # ----------------------------------------------------------------------------
 # UriStrToNs: Mapping of URI string to Ns, {str:Ns}. See 'GetNs'.
 
 UriStrToNs = {}
 
+# ----------------------------------------------------------------------------
+# XsdNsMap: the namespace map of XML Schema documents, {str:str}; the 'xs'
+# prefix is also used in type names, e.g. 'xs:ID'. See 'MakeIdSchema'.
+
+XsdNsMap = {"xs": "http://www.w3.org/2001/XMLSchema"}
+
+# ----------------------------------------------------------------------------
+# XsdTags: tags of XML Schema elements by local name, {str:str}.
+
+XsdTags = dict((localNameStr, "{%s}%s" % (XsdNsMap["xs"], localNameStr))
+        for localNameStr in ("any", "anyAttribute", "attribute",
+                "complexType", "element", "import", "schema", "sequence"))
+
+# ----------------------------------------------------------------------------
+# XmlWriterTagRe: a regular expression to read the name of a serialized
+# start tag, see 'BeginXmlWriterElt'.
+
+XmlWriterTagRe = pr.compile(r"<([^\s/>]+)")
+
 # ----------------------------------------------------------------------------
 # Nses and QNames
 
@@ -0,0 +1,108 @@
+# coding: utf-8
+#
+# bench.py: compare the ways 'ReadXml' builds the ID table.
+#
+# Copyright (C) 2020 Mikhail Edoshin.
+#
+# This file is part of Maxe.
+#
+# Maxe is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Maxe is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Maxe.  If not, see <https://www.gnu.org/licenses/>.
+
+# Usage: python3 test/ids/bench.py [number of sections]
+#
+# Make a document with 'bench.dtd' in 'out/ids', read it with each IdIndex
+# and print the best processor time of five reads. With 'dtd' the parser
+# loads the DTD from a file, but a read from a stream has no URL, so the
+# parser does not find the DTD and 'IndexXmlIds' builds the ID table. The
+# times are only printed; exit with an error if a mode does not index IDs.
+
+# ============================================================================
+
+import os      as po  # makedirs
+import os.path as pop # isdir
+import shutil  as psh # copy
+import sys     as ps  # argv, exit
+import time    as pt  # process_time
+
+import maxe.path as mp # paths
+import maxe.strm as ms # streams
+import maxe.xml  as mx # XML
+
+# ----------------------------------------------------------------------------
+# MakeBenchData(int): bytes
+#   Make the document: sections with paragraphs, lists, notes, and links to
+#   the preceding sections.
+
+def MakeBenchData(secCount):
+    strs = ["<!DOCTYPE doc SYSTEM \"bench.dtd\">\n<doc><title>Bench</title>"]
+    i = 0
+    while i < secCount:
+        strs.append("<sec id=\"s%d\"><title>Section <em>%d</em></title>"
+                "<para>Text with <code>code</code> and a <link ref=\"s%d\">"
+                "link</link>.</para><list><item><para>One</para></item>"
+                "<item><para>Two <em>2</em></para></item></list>"
+                "<note><para>Note</para></note><para>More text.</para>"
+                "</sec>" % (i, i, i // 2))
+        i += 1
+    strs.append("</doc>")
+    return "".join(strs).encode("utf-8")
+
+# ----------------------------------------------------------------------------
+# TimeRead(bytes, ReadParam, bool): float
+#   Get the best processor time of five reads, from a file or a stream.
+
+def TimeRead(data, readParam, fromFile):
+    bestTime = None
+    i = 0
+    while i < 5:
+        startTime = pt.process_time()
+        if fromFile:
+            strm = ms.MakeIStrmFromPath(mp.MakePath("out/ids/bench.xml"))
+        else:
+            strm = ms.MakeIStrmInMem(data)
+        xml = mx.ReadXml(strm, readParam)
+        ms.DropStrm(strm)
+        time = pt.process_time() - startTime
+        if bestTime is None or time < bestTime:
+            bestTime = time
+        i += 1
+    if len(xml.getroot().xpath("id('s0 s1')")) != 2:
+        raise Exception("IDs are not indexed")
+    return bestTime
+
+# ============================================================================
+
+secCount = int(ps.argv[1]) if len(ps.argv) > 1 else 20000
+data = MakeBenchData(secCount)
+if not pop.isdir("out/ids"):
+    po.makedirs("out/ids")
+psh.copy("test/ids/bench.dtd", "out/ids/bench.dtd")
+fhdl = open("out/ids/bench.xml", "wb")
+fhdl.write(data)
+fhdl.close()
+for nameStr, optStr, fromFile in (
+        ("validate", "validate", True),
+        ("dtd", "dtd", True),
+        ("dtd, stream", "dtd", False),
+        ("attrs", "attrs", True)):
+    readParam = mx.MakeReadParam()
+    readParam.paths.append(mp.MakePath("test/ids"))
+    mx.SetReadParamOpt(readParam, "ids", optStr)
+    readParam.idAttrs = ["id"]
+    try:
+        time = TimeRead(data, readParam, fromFile)
+    except Exception as exc:
+        print("%-12s %s" % (nameStr, exc))
+        ps.exit(1)
+    print("%-12s %.3f" % (nameStr, time))